@@ -3,37 +3,60 @@ import numpy as np
 from struct import unpack
 from subprocess import IDLE_PRIORITY_CLASS
 import tempfile
+import threading
 import time
 import typing as T
+from concurrent.futures import ThreadPoolExecutor
 from xml.dom import NotFoundErr
 import requests
+from requests.adapters import HTTPAdapter
+
+# every request to the Alpaca server is a short HTTP round trip: independent properties are
+# fetched side by side, each device keeps a pool of keep-alive connections
+MAX_CONCURRENT_REQUESTS = 8
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix="alpaca")
+
+def _make_session() -> requests.Session:
+  session = requests.Session()
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONCURRENT_REQUESTS)
+  session.mount('http://', adapter)
+  return session
 
 class AscomDevice:
+  # seconds a property value is reused; properties not listed are always fetched
+  TTL = {'connected': 2.0, 'name': 60.0, 'description': 60.0}
+
   def __init__(self, deviceType: str, devNameKeyword: str):
     self.deviceType = deviceType
     self.url_root = f'http://localhost:11111/api/v1/{self.deviceType}'
     self.client_id = 0
-    self.session = requests.Session()
+    self.session = _make_session()
+    self._cache = {}
+    self._cache_lock = threading.Lock()
 
-    for devno in range(10):
-      self.devno = devno
-      try:
-        if self._get('connected') == True:
-          name = self._get('name')
-          if devNameKeyword.lower() in name.lower():
-            self.name = name
-            return
-
-      except RuntimeError as err:
-        pass
+    # probe all device numbers at once, take the first that matches
+    for devno, name in enumerate(_executor.map(self._probe, range(10))):
+      if name is not None and devNameKeyword.lower() in name.lower():
+        self.devno = devno
+        self.name = name
+        return
     raise NotFoundErr("Device not found")
 
+  def _probe(self, devno: int) -> T.Optional[str]:
+    """ Name of a connected device at devno, None when there is none """
+    try:
+      if self._request(devno, 'connected') == True:
+        return self._request(devno, 'name')
+    except (RuntimeError, requests.RequestException):
+      pass
+    return None
+
   def close(self):
     self.session.close()
     self.session = None
 
-  def _get(self, cmd: str, defaultVal = None) -> T.Any:
-    r = self.session.get(f'{self.url_root}/{self.devno}/{cmd}', params={"ClientID": self.client_id})
+  def _request(self, devno: int, cmd: str, defaultVal = None) -> T.Any:
+    r = self.session.get(f'{self.url_root}/{devno}/{cmd}', params={"ClientID": self.client_id})
     if r.status_code != 200:
       raise RuntimeError(r.status_code)
     data = r.json()
@@ -43,10 +66,30 @@ class AscomDevice:
       raise RuntimeError(data['ErrorMessage'])
     return data['Value']
 
+  def _get(self, cmd: str, defaultVal = None) -> T.Any:
+    ttl = self.TTL.get(cmd)
+    if ttl is not None:
+      with self._cache_lock:
+        cached = self._cache.get(cmd)
+      if cached is not None and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    value = self._request(self.devno, cmd, defaultVal)
+    if ttl is not None:
+      with self._cache_lock:
+        self._cache[cmd] = (time.monotonic(), value)
+    return value
+
+  def _get_many(self, *cmds: str) -> T.List[T.Any]:
+    """ Fetch several properties concurrently: one round trip instead of one per property """
+    return list(_executor.map(self._get, cmds))
+
   def _put(self, cmd: str, val: dict) -> T.Any:
     data={"ClientID": self.client_id}
     data.update(val)
     r = self.session.put(f'{self.url_root}/{self.devno}/{cmd}', data=data)
+    # the device state changed: cached properties may be stale
+    with self._cache_lock:
+      self._cache.clear()
     if r.status_code != 200:
       raise RuntimeError(f"{r.status_code}: {r.content}")
     data = r.json()
@@ -62,4 +105,3 @@ class AscomDevice:
     if not hasattr(self,'_description'):
       self._description = self._get('description')
     return self._description
-
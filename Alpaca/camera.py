@@ -6,6 +6,7 @@ from subprocess import IDLE_PRIORITY_CLASS
 import tempfile
 import time
 import typing as T
+import logging
 
 from Alpaca.alpaca_base import AscomDevice
 
@@ -21,12 +22,46 @@ class ASCOMImageArrayElementTypes(IntEnum):
   UInt16 = 8
   UInt32 = 9
 
+ELEMENT_DTYPES = {
+  ASCOMImageArrayElementTypes.Byte: np.uint8,
+  ASCOMImageArrayElementTypes.Int16: np.int16,
+  ASCOMImageArrayElementTypes.UInt16: np.uint16,
+  ASCOMImageArrayElementTypes.Int32: np.int32,
+  ASCOMImageArrayElementTypes.UInt32: np.uint32,
+  ASCOMImageArrayElementTypes.Int64: np.int64,
+  ASCOMImageArrayElementTypes.UInt64: np.uint64,
+  ASCOMImageArrayElementTypes.Single: np.float32,
+  ASCOMImageArrayElementTypes.Double: np.double,
+}
+
+# large enough to keep the socket busy, small enough that urllib3's temporary copy stays in cache
+CHUNK_SIZE = 1 << 20
+
+def _read_into(stream, view: memoryview):
+  """ Fill view from a file-like stream in chunks """
+  n = 0
+  while n < len(view):
+    k = stream.readinto(view[n:n + CHUNK_SIZE])
+    if not k:
+      raise RuntimeError(f"Image download truncated at {n} of {len(view)} bytes")
+    n += k
+
+def _read_exact(stream, size: int) -> bytes:
+  buf = bytearray(size)
+  _read_into(stream, memoryview(buf))
+  return bytes(buf)
+
 class Camera(AscomDevice):
-  def __init__(self, name):
+  TTL = {**AscomDevice.TTL, 'ccdtemperature': 0.5, 'coolerpower': 0.5, 'cooleron': 1.0, 'setccdtemperature': 1.0}
+
+  def __init__(self, name, gzip: bool = False):
+    """ gzip: ask for compressed image downloads; pays off over Wi-Fi, costs server CPU on a wired link """
     super().__init__("camera", name)
-    self._egain = self._get("electronsperadu")
-    self._pixelSize = [self._get("pixelsizex"), self._get("pixelsizey")]
-    self._sensortype = self._get("sensortype")
+    self.gzip = gzip
+    self._subframe = None
+    self._egain, pixelsizex, pixelsizey, self._sensortype = self._get_many("electronsperadu", "pixelsizex", "pixelsizey", "sensortype")
+    self._pixelSize = [pixelsizex, pixelsizey]
+    self._rx_buffer = None
 
   def isSimulator(self):
     return False
@@ -190,6 +225,35 @@ class Camera(AscomDevice):
     self._bin = val
 
 
+  """ Transfer """
+  @property
+  def sensor_size(self) -> T.Tuple[int, int]:
+    if not hasattr(self, '_sensor_size'):
+      self._sensor_size = (self._get('cameraxsize'), self._get('cameraysize'))
+    return self._sensor_size
+
+  def set_transfer(self, binning: int = 1, subframe: float = 1.0) -> T.Tuple[int, int]:
+    """ Bin and crop on the server, so only the pixels needed cross the network
+    subframe: centered fraction of the sensor width and height
+    Returns the subframe origin in sensor pixels
+    """
+    if self.binning != binning:
+      self.binning = binning
+      # drivers reset the subframe with the binning
+      self._subframe = None
+    w, h = self.sensor_size[0] // binning, self.sensor_size[1] // binning
+    # even sizes and offsets keep the Bayer phase of a color sensor
+    numx, numy = int(w * subframe) & ~1, int(h * subframe) & ~1
+    startx, starty = ((w - numx) // 2) & ~1, ((h - numy) // 2) & ~1
+    if self._subframe != (startx, starty, numx, numy):
+      self._put('numx', {'NumX': numx})
+      self._put('numy', {'NumY': numy})
+      self._put('startx', {'StartX': startx})
+      self._put('starty', {'StartY': starty})
+      self._subframe = (startx, starty, numx, numy)
+    return startx * binning, starty * binning
+
+
   """ Capture """ 
   def start_exposure(self, duration: float, light: bool = True):
     self._put('startexposure', {'Duration': duration, 'Light': light})
@@ -198,52 +262,55 @@ class Camera(AscomDevice):
   def imageready(self) -> bool:
     return self._get('imageready')
 
-  def downloadimage(self) -> str:
+  def _receive_buffer(self, dtype, shape) -> np.ndarray:
+    """ Download buffer in transmission order, reused while the frame format stays the same """
+    if self._rx_buffer is None or self._rx_buffer.dtype != dtype or self._rx_buffer.shape != shape:
+      self._rx_buffer = np.empty(shape, dtype=dtype)
+    return self._rx_buffer
+
+  def downloadimage(self) -> np.ndarray:
+    """ Download the last image as ImageBytes
+    The body is streamed into a preallocated buffer, then transposed once into a contiguous
+    (height, width) array that is owned by the caller
+    """
     url = f'{self.url_root}/{self.devno}/imagearray'
-    with self.session.get(url, headers={'Accept': "application/imagebytes"}) as r:
-      buffer = r.content
+    start = time.time()
+    headers = {'Accept': "application/imagebytes", 'Accept-Encoding': "gzip" if self.gzip else "identity"}
+    with self.session.get(url, headers=headers, stream=True) as r:
+      if r.status_code != 200:
+        raise RuntimeError(r.status_code)
+      r.raw.decode_content = True
+      metadata = _read_exact(r.raw, 44)
       metdataVersion, errorNumber,\
         clientTransactionId, serverTransactionId,\
         dataStart, imageElementType,\
         transmissionElementType, rank,\
-        dimension1, dimension2, dimension3 =  unpack('llLLlllllll', buffer[:44])
-      print(metdataVersion, errorNumber,\
-        clientTransactionId, serverTransactionId,\
-        dataStart, imageElementType,\
-        transmissionElementType, rank,\
-        dimension1, dimension2, dimension3)
+        dimension1, dimension2, dimension3 =  unpack('<llLLlllllll', metadata)
 
       assert(metdataVersion == 1)
       if errorNumber != 0:
-        raise RuntimeError(f"Error downloading image: {errorNumber}")
+        raise RuntimeError(f"Error downloading image: {errorNumber}: {r.raw.read().decode(errors='replace')}")
       assert(rank == 2)
       assert(imageElementType == 2)
 
-      if transmissionElementType == ASCOMImageArrayElementTypes.Byte:
-        baseType = np.uint8
-      elif transmissionElementType == ASCOMImageArrayElementTypes.Double:
-        baseType = np.double
-      elif transmissionElementType == ASCOMImageArrayElementTypes.Int16:
-        baseType = np.int16
-      elif transmissionElementType == ASCOMImageArrayElementTypes.Int32:
-        baseType = np.int32
-      elif transmissionElementType == ASCOMImageArrayElementTypes.Int64:
-        baseType = np.int64
-      elif transmissionElementType == ASCOMImageArrayElementTypes.Single:
-        baseType = np.float32
-      elif transmissionElementType == ASCOMImageArrayElementTypes.UInt16:
-        baseType = np.uint16
-      elif transmissionElementType == ASCOMImageArrayElementTypes.UInt32:
-        baseType = np.uint32
-      elif transmissionElementType == ASCOMImageArrayElementTypes.UInt64:
-        baseType = np.uint64
-      else:
+      if transmissionElementType not in ELEMENT_DTYPES:
         raise ValueError(f"Unexpected ASCOM transmission type: {transmissionElementType}")
-
-      dt = np.dtype(baseType).newbyteorder('little')
-      img = np.frombuffer(buffer[dataStart:], dtype=dt).reshape((dimension1, dimension2)).T
-
-      return img
+      dt = np.dtype(ELEMENT_DTYPES[transmissionElementType]).newbyteorder('little')
+
+      _read_exact(r.raw, dataStart - 44)
+      buffer = self._receive_buffer(dt, (dimension1, dimension2))
+      _read_into(r.raw, memoryview(buffer).cast('B'))
+
+    if buffer.dtype.kind in 'iu' and buffer.dtype.itemsize > 2 and buffer.min() >= 0 and buffer.max() <= 0xffff:
+      # servers that send 32 bit elements for 16 bit sensors: narrow while transposing
+      img = np.empty(buffer.T.shape, dtype=np.uint16)
+      np.copyto(img, buffer.T, casting='unsafe')
+    else:
+      img = np.ascontiguousarray(buffer.T)
+    elapsed = time.time() - start
+    logging.info(f"Downloaded {buffer.shape[0]}x{buffer.shape[1]} {ASCOMImageArrayElementTypes(transmissionElementType).name}, "
+                 f"{buffer.nbytes / 1e6:.1f} MB in {elapsed:.2f} sec ({buffer.nbytes / 1e6 / max(elapsed, 1e-6):.1f} MB/s)")
+    return img
 
 
 if __name__ == "__main__":
@@ -13,15 +13,26 @@ from astropy.coordinates import ICRS
 from Alpaca.alpaca_base import AscomDevice
 
 class Mount(AscomDevice):
+    TTL = {**AscomDevice.TTL, 'sitelatitude': 60.0, 'sitelongitude': 60.0}
+
     def __init__(self, devNameKeyword: str):
         super().__init__("telescope", devNameKeyword)
 
     @property
     def coordinates(self) -> SkyCoord:
-        ra = self._get("rightascension")
-        dec = self._get("declination")
+        ra, dec = self._get_many("rightascension", "declination")
         return SkyCoord(ra * u.hour, dec * u.degree, frame=ICRS)
 
+    def status(self) -> dict:
+        """ Tracking, parked and slewing flags and coordinates, fetched in one round trip """
+        tracking, atpark, slewing, ra, dec = self._get_many("tracking", "atpark", "slewing", "rightascension", "declination")
+        return {
+            "tracking": tracking,
+            "atpark": atpark,
+            "slewing": slewing,
+            "coordinates": SkyCoord(ra * u.hour, dec * u.degree, frame=ICRS)
+        }
+
     @property
     def site_lat(self):
         return self._get("sitelatitude")
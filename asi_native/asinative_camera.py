@@ -4,6 +4,7 @@ from enum import IntEnum
 import time
 from pathlib import Path
 import logging
+import threading
 
 
 library_file = Path(__file__).parent/"lib/x64/ASICamera2.dll"
@@ -17,6 +18,80 @@ class SensorType(IntEnum):
   CMYG2=4
   LRGB=5
 
+class _VideoStream:
+  """ Reads video frames as fast as the camera sends them into a ring of preallocated buffers
+
+  The reader thread always fills a slot that is neither the newest frame nor being copied out,
+  so get_video_data never waits for the consumer and the SDK never allocates. A consumer that
+  falls behind gets the newest frame and the ones in between are dropped.
+  """
+
+  def __init__(self, camera, dtype, shape, durationSec, ring_size=3):
+    self.camera = camera
+    self.dtype = dtype
+    self.shape = shape
+    size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+    self._ring = [bytearray(size) for _ in range(max(ring_size, 3))]
+    self._cond = threading.Condition()
+    self._newest = None
+    self._reading = None
+    self._seq = 0
+    self._taken = 0
+    self._running = True
+    self.error = None
+    self._timeout_ms = int(2 * durationSec * 1000 + 500)
+    self.camera.start_video_capture()
+    self._thread = threading.Thread(target=self._run, name="asi_video", daemon=True)
+    self._thread.start()
+
+  def _run(self):
+    slot = 0
+    while self._running:
+      try:
+        self.camera.get_video_data(self._timeout_ms, self._ring[slot])
+      except asi.ZWO_IOError as e:
+        # timeouts while the exposure is longer than expected
+        logging.debug(f"Video frame: {e}")
+        continue
+      except Exception as e:
+        logging.error(f"Video capture failed: {e}")
+        with self._cond:
+          self.error = e
+          self._running = False
+          self._cond.notify_all()
+        return
+      with self._cond:
+        self._newest = slot
+        self._seq += 1
+        self._cond.notify()
+        slot = next(i for i in range(len(self._ring)) if i != self._newest and i != self._reading)
+
+  def latest(self, timeout=None):
+    with self._cond:
+      if not self._cond.wait_for(lambda: self._seq > self._taken or not self._running, timeout) or not self._running:
+        if self.error is not None:
+          raise RuntimeError(f"Video capture failed: {self.error}")
+        return None
+      dropped = self._seq - self._taken - 1
+      self._taken = self._seq
+      self._reading = self._newest
+      buf = self._ring[self._reading]
+    try:
+      # the only copy: the frame handed on must outlive the slot
+      img = np.frombuffer(buf, dtype=self.dtype).reshape(self.shape).copy()
+    finally:
+      with self._cond:
+        self._reading = None
+    return img, dropped
+
+  def stop(self):
+    with self._cond:
+      self._running = False
+      self._cond.notify_all()
+    self._thread.join()
+    self.camera.stop_video_capture()
+
+
 class ASINativeCamera():
     
   def __init__(self, cameraModel) -> None:
@@ -51,9 +126,10 @@ class ASINativeCamera():
     self.camera.set_image_type(asi.ASI_IMG_RAW16)
     self.gain = 121
     self.offset = 30
-    self._buffer = None
+    self._video = None
 
   def close(self):
+    self.stop_video()
     self._connected = False
     self.camera.close()
 
@@ -101,6 +177,16 @@ class ASINativeCamera():
   def binning(self, value: int):
     self.camera.set_roi(bins=value)
 
+  def set_transfer(self, binning: int = 1, subframe: float = 1.0):
+    """ Centered ROI read out by the camera; returns its origin in sensor pixels """
+    w, h = self.camera_info['MaxWidth'] // binning, self.camera_info['MaxHeight'] // binning
+    # the SDK wants widths in multiples of 8 and heights in multiples of 2
+    width, height = int(w * subframe) & ~7, int(h * subframe) & ~1
+    start_x, start_y = ((w - width) // 2) & ~1, ((h - height) // 2) & ~1
+    if tuple(self.camera.get_roi()) != (start_x, start_y, width, height) or self.binning != binning:
+      self.camera.set_roi(start_x=start_x, start_y=start_y, width=width, height=height, bins=binning)
+    return start_x * binning, start_y * binning
+
   """ Gain """
   @property
   def gain(self):
@@ -179,23 +265,53 @@ class ASINativeCamera():
     else:
       raise ValueError(f"Exposure failed: {exp_stat}")
 
-  def downloadimage(self):
-    data = self.camera.get_data_after_exposure(self._buffer)
+  def _frame_format(self):
+    """ dtype and shape of the frames of the current ROI and image type """
     whbi = self.camera.get_roi_format()
     shape = [whbi[1], whbi[0]]
     if whbi[3] == asi.ASI_IMG_RAW8 or whbi[3] == asi.ASI_IMG_Y8:
-        img = np.frombuffer(data, dtype=np.uint8)
+        dtype = np.uint8
     elif whbi[3] == asi.ASI_IMG_RAW16:
-        img = np.frombuffer(data, dtype=np.uint16)
+        dtype = np.uint16
     elif whbi[3] == asi.ASI_IMG_RGB24:
-        img = np.frombuffer(data, dtype=np.uint8)
+        dtype = np.uint8
         shape.append(3)
     else:
         raise ValueError('Unsupported image type')
-    self._buffer = data
-    img = img.reshape(shape)
+    return dtype, shape
+
+  def downloadimage(self):
+    # a new buffer for every frame: the frame is still queued for analysis and writing while
+    # the next one downloads, a reused buffer would be overwritten under it
+    data = self.camera.get_data_after_exposure(None)
+    dtype, shape = self._frame_format()
+    img = np.frombuffer(data, dtype=dtype).reshape(shape)
     return img
 
+  """ Video """
+  def start_video(self, durationSec: float, raw8: bool = True, ring_size: int = 3):
+    """ Keep the camera streaming frames of durationSec until stop_video()
+    raw8: 8 bit frames, twice the frame rate over USB of 16 bit ones
+    """
+    self.stop_video()
+    self.camera.set_image_type(asi.ASI_IMG_RAW8 if raw8 else asi.ASI_IMG_RAW16)
+    self.camera.set_control_value(asi.ASI_EXPOSURE, int(durationSec * 1e6))
+    self._video = _VideoStream(self.camera, *self._frame_format(), durationSec, ring_size)
+
+  def get_video_frame(self, timeout: float = None):
+    """ Newest frame not returned yet as (img, dropped); waits up to timeout seconds, None on timeout
+    dropped counts the frames that arrived since the previous call and were skipped
+    """
+    if self._video is None:
+      raise RuntimeError("Video capture not started")
+    return self._video.latest(timeout)
+
+  def stop_video(self):
+    if self._video is not None:
+      self._video.stop()
+      self._video = None
+      self.camera.set_image_type(asi.ASI_IMG_RAW16)
+
   def coolto(self, tgt_temp: float):
     # Gradually cool
     delta = self.temperature - tgt_temp
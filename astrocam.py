@@ -15,7 +15,6 @@ from multiprocessing import Queue
 import queue
 
 from app import AstroApp
-from image_processing_service import ImageProcessingService
 from ui.focuser_widget import FocuserWidget
 from ui.fwhm_widget import FWHMWidget
 from ui.histogram_plot import HistogramViewer
@@ -31,6 +30,7 @@ from astropy.io import fits
 from tkinter import filedialog
 from astro_tasks import parse_tasks_yaml_file
 from skymap.skymap import SkyMap
+from settings import config
 
 from phd_ctrl import start_guiding, stop_guiding, pause_guiding
 
@@ -69,7 +69,6 @@ class AstroCam(AstroApp):
         self.task_list = []
         self.task_executing = False
 
-        self.imageProcessingService = ImageProcessingService(self.root)
 
         ##############VARIABLES##############
         self.runStatus = tk.StringVar()
@@ -431,28 +430,45 @@ class AstroCam(AstroApp):
         self.startNextExposure(job)
 
     def startNextExposure(self, job):
+        """ Start a capture sequence of exposure_number frames (live view: until cancelled) """
         self.exposureProgress['value'] = 0
         if not self.runningLiveView and not self.runningSimulator:
-            sno_file = Path('serial_no.txt')
-            if sno_file.exists():
-                serial_no = int(sno_file.read_text())
-            else:
-                serial_no = 0
-            sno_file.write_text(str(serial_no+1))
-
-            now = datetime.now()
-            now = now - timedelta(days=1 if now.hour<6 else 0)
-            output_dir = self.destDir / now.strftime("%Y%m%d")
-            if job['image_type'] == 'Light':
-                output_dir = output_dir / f"{job['object_name']}/Light"
-            else:
-                output_dir = output_dir / f"{job['image_type']}_{job['exp']}sec_{job['iso']}gain"
-            output_dir.mkdir(parents=True, exist_ok=True)
-            job['output_fname'] = str(output_dir / f"{job['image_type']}_{serial_no:05d}_{job['exp']}sec_{job['iso']}gain_{self.camera_svc._camera.temperature}C.fit")
+            job['output_fname'] = self._output_fname
         else:
             job['output_fname'] = None
+        job['count'] = 0 if self.runningLiveView else self.exposure_number.get()
+        job['compute_stars'] = job['image_type'] == 'Light' and not self.runningLiveView
+        # prepared in the analysis stage, off the Tk thread, for the viewer and the histogram
+        # live view publishes as soon as the pyramid is there, rgb24 is only needed when zoomed in
+        job['products'] = ['pyramid', 'histogram'] if self.runningLiveView else ['pyramid', 'histogram', 'rgb24']
+        if self.runningLiveView:
+            # live view frame rate follows the subframe size, not the sensor size
+            job['binning'] = config.get('liveview_binning', 1)
+            job['subframe'] = config.get('liveview_subframe', 1.0)
+            # cameras that can stream video keep streaming instead of taking single exposures
+            job['video'] = config.get('liveview_video', True)
+        job['on_frame'] = self._on_frame_captured
         self.camera_svc.capture_image(job, on_success=self._on_exposure_completed, on_failure=self._on_exposure_failed)
 
+    def _output_fname(self, job, hdr):
+        """ Name for the next sub; called from the capture thread for every frame """
+        sno_file = Path('serial_no.txt')
+        if sno_file.exists():
+            serial_no = int(sno_file.read_text())
+        else:
+            serial_no = 0
+        sno_file.write_text(str(serial_no+1))
+
+        now = datetime.now()
+        now = now - timedelta(days=1 if now.hour<6 else 0)
+        output_dir = self.destDir / now.strftime("%Y%m%d")
+        if job['image_type'] == 'Light':
+            output_dir = output_dir / f"{job['object_name']}/Light"
+        else:
+            output_dir = output_dir / f"{job['image_type']}_{job['exp']}sec_{job['iso']}gain"
+        output_dir.mkdir(parents=True, exist_ok=True)
+        return str(output_dir / f"{job['image_type']}_{serial_no:05d}_{job['exp']}sec_{job['iso']}gain_{hdr['CCD-TEMP']}C.{config.get('capture_format', 'fit')}")
+
     def _on_capture_status_update(self, event):
         if event.x >= 0:
             self.exposureProgress['value'] = event.y
@@ -460,44 +476,32 @@ class AstroCam(AstroApp):
             self.exposureProgress['value'] = 0
             logging.error("ERROR")
 
+    def _on_frame_captured(self, job, imageData, remaining):
+        # the next exposure is already running
+        if self.runningExposures and remaining is not None:
+            self.exposure_number.set(remaining)
+        if job['compute_stars']:
+            self._update_stars_fwhm(imageData)
+
     def _on_exposure_completed(self, job, imageData):
-        # Start next exposure
-        self._start_next_exposure(job)
+        if self.runningLiveView:
+            self.endRunningExposures("Stopped Live view")
+        elif self.cancelJob:
+            self.endRunningExposures("Cancelled")
+        else:
+            self.endRunningExposures("Finished")
 
-        if job['image_type'] == 'Light' and not self.runningLiveView:
-            self.imageProcessingService.computeStars(imageData, lambda job, img: self._update_stars_fwhm(img))
+    def _on_frame_saved(self, fname, error):
+        if error is not None:
+            self.runStatus.set(f"Save failed: {error}")
+        elif self.camera_svc.storage.pending > 0:
+            logging.info(f"{self.camera_svc.storage.pending} frames waiting to be saved")
 
     def _on_exposure_failed(self, job, error):
         self.exposureProgress['value'] = 0
         logging.error(f"Exposure failed: {error}")
         self.endRunningExposures(f"Error: {error}")
 
-    def _start_next_exposure(self, job):
-        # Start next exposure
-        if self.runningLiveView:
-            if self.cancelJob:
-                self.endRunningExposures("Stopped Live view")
-            else:
-                self.root.after(0, lambda: self.startNextExposure(job))
-                return
-        elif self.runningExposures:
-            if self.cancelJob:
-                self.endRunningExposures("Cancelled")
-                return
-            else:
-                self.exposure_number.set(self.exposure_number.get() - 1)
-            if self.exposure_number.get() == 0:
-                self.endRunningExposures("Finished")
-                return
-            else:
-                # Execute after exposure steps
-                
-                # Trigger next exposure
-                self.root.after(0, lambda: self.startNextExposure(job))
-        else:
-            self.endRunningExposures("Finished")
-            return
-
     def _update_stars_fwhm(self, imageData):
         if self.fwhmWidget.update(imageData):
             self.imageViewer.updateStars()
@@ -556,6 +560,8 @@ class AstroCam(AstroApp):
 
     def cancel(self):
         self.cancelJob = True
+        if self.connected:
+            self.camera_svc.cancel()
         try:
             while not self.req_queue.empty():
                 self.req_queue.get_nowait()
@@ -570,12 +576,7 @@ class AstroCam(AstroApp):
             newexp = expnum + 5
         self.exposure_number.set(newexp)
         if self.runningExposures:
-            exp_job = self.getExposureSettings()
-            try:
-                for i in range(newexp-expnum):
-                    self.req_queue.put(exp_job, block=False)
-            except queue.Full:
-                pass
+            self.camera_svc.set_remaining(newexp)
 
     def exp_number_down(self):
         expnum=self.exposure_number.get()
@@ -585,11 +586,7 @@ class AstroCam(AstroApp):
             newexp = expnum - 5
         self.exposure_number.set(newexp)
         if self.runningExposures:
-            try:
-                for i in range(expnum-newexp):
-                    self.req_queue.get_nowait()
-            except queue.Empty:
-                pass
+            self.camera_svc.set_remaining(newexp)
 
 
     ##################### Event Handlers #######################
@@ -620,6 +617,7 @@ class AstroCam(AstroApp):
                 self.root.bind(CaptureService.CaptureStatusUpdateEventName, self._on_capture_status_update)
                 self.camera_svc.subscribe(self.histoViewer.update)
                 self.camera_svc.subscribe(self.imageViewer.update)
+                self.camera_svc.storage.subscribe(self._on_frame_saved)
 
                 self.mountStatusWidget.connect(mount, self.camera_svc)
                 if focuser:
@@ -1,75 +1,253 @@
 from service_base import ServiceBase
 import tkinter as tk
+import threading
+import logging
 import time
+from collections import deque
 from datetime import datetime
 from astropy.io import fits
 from image_data import ImageData
+from storage_service import StorageService
+from pipeline import PipelineStage, StageMetrics
+from settings import config
 
 
 class CaptureService(ServiceBase):
 
     CaptureStatusUpdateEventName = "<<CaptureStatusUpdate>>"
+    FrameReadyEventName = "<<CaptureFrameReady>>"
 
     def __init__(self, tk_root, camera):
         super().__init__(tk_root)
         self._camera = camera
         self._image_count = 0
+        self.remaining = None
+        self._remaining_lock = threading.Lock()
+        self._cancel = threading.Event()
+        self._frames = deque()
+        self.metrics = {name: StageMetrics(name) for name in ['exposure', 'download', 'idle']}
+        self._analysis = PipelineStage('analysis', self._analyze, maxsize=config.get('pipeline_depth', 2))
+        self.metrics['analysis'] = self._analysis.metrics
+        self._tk_root.bind(self.FrameReadyEventName, self._on_frame_ready)
+        self.storage = StorageService(tk_root,
+                                      max_pending=config.get('write_queue', 4),
+                                      fits_compression=config.get('fits_compression'),
+                                      xisf_compression=config.get('xisf_compression', 'zlib'),
+                                      fsync=config.get('fsync', True))
+
+    def terminate(self):
+        self.cancel()
+        super().terminate()
+        # pending frames are still written
+        self._analysis.terminate()
+        self.storage.terminate()
+
+    def _expose(self, job):
+        """ Expose and download one frame; returns (img, header)
+        img must be owned by the caller: it goes on to the analysis and storage stages and into a
+        lazily evaluated ImageData while the next frame downloads, so a camera driver must never
+        download into it again
+        """
+        start = time.time()
+        self._camera.gain = job['iso']
+        # live view and focus frames bin and crop on the camera side
+        binning = job.get('binning', 1)
+        origin = self._camera.set_transfer(binning, job.get('subframe', 1.0))
+        self._camera.start_exposure(job['exp'])
+        job['date_obs'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        img_dt = 500 # ms
+        img_steps = int(job['exp'] * 1000 / img_dt)
+        steps = 0
+        while not self._camera.imageready:
+            self.token.check()
+            time.sleep(img_dt / 1000)
+            steps += 1
+            self._tk_root.event_generate(self.CaptureStatusUpdateEventName, when="tail", x=1, y=int(100*steps/img_steps))
+        self.metrics['exposure'].add(time.time() - start)
+
+        start = time.time()
+        img = self._camera.downloadimage()
+        self.metrics['download'].add(time.time() - start)
+        hdr = self._header(job, binning, origin)
+        self._image_count += 1
+        return img, hdr
+
+    def _header(self, job, binning, origin):
+        """ FITS header of a frame taken with job's settings """
+        temperature = self._camera.temperature
+        hdr = fits.Header({
+            'COMMENT': 'Anand Dinakar',
+            'OBJECT': job["object_name"],
+            'INSTRUME': self._camera.name,
+            'DATE-OBS': job['date_obs'],
+            'EXPTIME': job['exp'],
+            'CCD-TEMP': temperature,
+            'XPIXSZ': self._camera.pixelSize[0], #4.63,
+            'YPIXSZ': self._camera.pixelSize[1], #4.63,
+            'XBINNING': binning,
+            'YBINNING': binning,
+            'XORGSUBF': origin[0],
+            'YORGSUBF': origin[1],
+            'BZERO': 0,
+            'BSCALE': 1,
+            'EGAIN': self._camera.egain,
+            'FOCALLEN': job["focal_length"],
+            'SWCREATE': 'AstroCAM',
+            'SBSTDVER': 'SBFITSEXT Version 1.0',
+            'SNAPSHOT': 1,
+            'SET-TEMP': self._camera.set_temp,
+            'IMAGETYP': job['image_type'], #'Light Frame',
+            'SITELAT': job["latitude"],
+            'SITELONG': job["longitude"],
+            'GAIN': job['iso'],
+            'OFFSET': self._camera.offset,
+            'BAYERPAT': self._camera.sensor_type.name
+        })
+        return hdr
+
+    def _save(self, job, img, hdr):
+        # output_fname is a name, or a callable naming each frame of a sequence
+        output_fname = job.get('output_fname')
+        if callable(output_fname):
+            output_fname = output_fname(job, hdr)
+        if output_fname:
+            # written in the background, the next exposure does not wait for the disk
+            self.storage.save(output_fname, img, hdr)
+        return output_fname
 
     def process(self):
         if self._camera is not None and self._camera.connected:
-            self._camera.gain = self.job['iso']
-            self._camera.start_exposure(self.job['exp'])
-            self.job['date_obs'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-            img_dt = 500 # ms
-            img_steps = int(self.job['exp'] * 1000 / img_dt)
-            steps = 0
-            while not self._camera.imageready:
-                time.sleep(img_dt / 1000)
-                steps += 1
-                self._tk_root.event_generate(self.CaptureStatusUpdateEventName, when="tail", x=1, y=int(100*steps/img_steps))
-
-            img = self._camera.downloadimage()
-            temperature = self._camera.temperature
-            hdr = fits.Header({
-                'COMMENT': 'Anand Dinakar',
-                'OBJECT': self.job["object_name"],
-                'INSTRUME': self._camera.name,
-                'DATE-OBS': self.job['date_obs'],
-                'EXPTIME': self.job['exp'],
-                'CCD-TEMP': temperature,
-                'XPIXSZ': self._camera.pixelSize[0], #4.63,
-                'YPIXSZ': self._camera.pixelSize[1], #4.63,
-                'XBINNING': self._camera.binning,
-                'YBINNING': self._camera.binning,
-                'XORGSUBF': 0,
-                'YORGSUBF': 0,
-                'BZERO': 0,
-                'BSCALE': 1,
-                'EGAIN': self._camera.egain,
-                'FOCALLEN': self.job["focal_length"],
-                'SWCREATE': 'AstroCAM',
-                'SBSTDVER': 'SBFITSEXT Version 1.0',
-                'SNAPSHOT': 1,
-                'SET-TEMP': self._camera.set_temp,
-                'IMAGETYP': self.job['image_type'], #'Light Frame',
-                'SITELAT': self.job["latitude"],
-                'SITELONG': self.job["longitude"],
-                'GAIN': self.job['iso'],
-                'OFFSET': self._camera.offset,
-                'BAYERPAT': self._camera.sensor_type.name
-            })
-            if 'output_fname' in self.job:
-                output_fname = self.job['output_fname']
-                hdu = fits.PrimaryHDU(img, header=hdr)
-                hdu.writeto(output_fname)
-            else:
-                output_fname = None
-            self.output = ImageData(img, output_fname, hdr)
-            self._image_count += 1
+            if self.job.get('video') and hasattr(self._camera, 'start_video'):
+                self._process_video()
+                return
+            if 'count' in self.job:
+                self._process_sequence()
+                return
+            img, hdr = self._expose(self.job)
+            self.output = ImageData(img, self._save(self.job, img, hdr), hdr)
             self._tk_root.event_generate(self.CaptureStatusUpdateEventName, when="tail", x=1, y=100)
         else:
             raise RuntimeError("Camera not connected")
 
+    def _process_video(self):
+        """ Live view from a camera streaming video: frames at the sensor frame rate until cancelled
+        Frames arriving while the analysis stage is still busy are dropped, never queued.
+        """
+        job = self.job
+        self.output = None
+        self._cancel.clear()
+        self.remaining = None
+        for metrics in self.metrics.values():
+            metrics.reset()
+        binning = job.get('binning', 1)
+        origin = self._camera.set_transfer(binning, job.get('subframe', 1.0))
+        self._camera.gain = job['iso']
+        job['date_obs'] = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        # device properties are read once, not for every frame
+        hdr = self._header(job, binning, origin)
+        self._camera.start_video(job['exp'])
+        start = time.time()
+        try:
+            while not (self._cancel.is_set() or self.token.cancelled):
+                frame = self._camera.get_video_frame(timeout=0.5)
+                if frame is None:
+                    continue
+                img, dropped = frame
+                # time per frame; frames skipped between two reads count as dropped downloads
+                self.metrics['download'].add(time.time() - start)
+                self.metrics['download'].add_dropped(dropped)
+                start = time.time()
+                self._analysis.offer((job, ImageData(img, None, hdr.copy()), None))
+                self._image_count += 1
+        finally:
+            self._camera.stop_video()
+        self._analysis.drain()
+        for metrics in self.metrics.values():
+            logging.info(str(metrics))
+
+    def _process_sequence(self):
+        """ Capture job['count'] frames back to back (0: until cancelled)
+        The next exposure starts as soon as a frame is downloaded; analysis and writing of that
+        frame happen on the analysis and storage stages meanwhile. Frames in the pipeline are never
+        reused by the camera driver (see _expose).
+        """
+        job = self.job
+        self.output = None
+        self._cancel.clear()
+        self.remaining = job['count'] if job['count'] > 0 else None
+        for metrics in self.metrics.values():
+            metrics.reset()
+        self.storage.metrics.reset()
+        idle_start = None
+        while not (self._cancel.is_set() or self.token.cancelled) and (self.remaining is None or self.remaining > 0):
+            if idle_start is not None:
+                self.metrics['idle'].add(time.time() - idle_start)
+            img, hdr = self._expose(job)
+            idle_start = time.time()
+            with self._remaining_lock:
+                if self.remaining is not None:
+                    self.remaining = max(self.remaining - 1, 0)
+                remaining = self.remaining
+            output_fname = self._save(job, img, hdr)
+            self._tk_root.event_generate(self.CaptureStatusUpdateEventName, when="tail", x=1, y=100)
+            # blocks when analysis is pipeline_depth frames behind
+            self._analysis.put((job, ImageData(img, output_fname, hdr), remaining))
+        # frame events go out before the sequence completes
+        self._analysis.drain()
+        for metrics in self.metrics.values():
+            logging.info(str(metrics))
+        logging.info(str(self.storage.metrics))
+
+    def _analyze(self, item):
+        job, imageData, remaining = item
+        imageData.compute(*job.get('products', []))
+        if job.get('compute_stars'):
+            try:
+                imageData.computeStars()
+            except Exception as e:
+                logging.error(f"Star detection failed: {e}")
+        self._frames.append((job, imageData, remaining))
+        self._tk_root.event_generate(self.FrameReadyEventName, when="tail", x=0)
+
+    def _on_frame_ready(self, event):
+        while self._frames:
+            job, imageData, remaining = self._frames.popleft()
+            if job.get('video') and any(queued[0] is job for queued in self._frames):
+                # the UI fell behind the video: only the newest frame is shown
+                continue
+            for cb in self._completion_callbacks:
+                cb(imageData)
+            if job.get('on_frame') is not None:
+                job['on_frame'](job, imageData, remaining)
+
+    def cancel(self):
+        """ Stop a sequence after the current exposure """
+        self._cancel.set()
+
+    def set_remaining(self, count):
+        """ Change the number of frames still to be taken by the running sequence """
+        with self._remaining_lock:
+            if self.remaining is not None:
+                self.remaining = max(count, 0)
+
+    @property
+    def sequence_running(self):
+        """ Whether a sequence or live view has the camera; those only end when cancelled """
+        with self._job_avbl:
+            return any('count' in entry.job or entry.job.get('video') for entry in self._active)
+
+    def run_job(self, job, priority=None, timeout=None):
+        """ One frame for another service (autofocus, refine); None when it could not be taken
+        Refused while a sequence or live view runs instead of waiting for it to end, and given up
+        capture_timeout seconds after the exposure should have finished.
+        """
+        if self.sequence_running:
+            self.error_message = f"{self.__class__.__name__}: camera busy with a sequence or live view"
+            return None
+        if timeout is None:
+            timeout = job['exp'] + config.get('capture_timeout', 60)
+        return super().run_job(job, priority, timeout)
+
     def capture_image(self, job, on_success=None, on_failure=None):
         return self.start_job(job, on_success, on_failure)
     
@@ -6,6 +6,7 @@ from ui.cooler_widget import CoolerWidget
 from argparse import ArgumentParser
 import psutil
 import sys
+from device_monitor import DeviceMonitor
 
 from ui.equipment_selector import make_camera, CAMERA_CHOICES
 
@@ -24,11 +25,9 @@ class CoolerApp(AstroApp):
     coolerFrame.pack(fill=tk.X, side=tk.TOP)
     paned_window.add(coolerFrame, weight=1)
     self.coolerWidget.connect(self.camera)
-    self.root.after(1000, self.statusPolling)
-
-  def statusPolling(self):
-    self.coolerWidget.update()
-    self.root.after(1000, self.statusPolling)
+    # read in the background: every second while cooling or warming, every 5 seconds otherwise
+    DeviceMonitor.shared(self.root).watch('cooler', self.coolerWidget.read_state, lambda state, changed: self.coolerWidget.update(state),
+                                          fast=1.0, slow=5.0, busy=lambda state: bool(state.get('threadStatus')))
 
 if __name__ == "__main__":
   ap = ArgumentParser()
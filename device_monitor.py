@@ -0,0 +1,126 @@
+""" Background polling of device state
+
+Devices are read on one background thread, never on the Tk thread. Each watched device has a
+read() function returning a dict of its state; the monitor compares it with the previous one
+and calls on_change on the Tk thread only when something changed. A device is polled at its fast
+interval while it is busy (slewing, moving, cooling) or its state just changed, and at its slow
+interval otherwise. poke() asks for a poll right away, e.g. after a command was sent.
+"""
+
+import threading
+import logging
+import time
+from collections import deque
+
+
+class _Watch:
+
+    def __init__(self, name, read, on_change, fast, slow, busy):
+        self.name = name
+        self.read = read
+        self.on_change = on_change
+        self.fast = fast
+        self.slow = slow
+        self.busy = busy
+        self.state = None
+        self.due = time.monotonic()
+
+
+class DeviceMonitor(threading.Thread):
+
+    StateChangedEventName = "<<DeviceStateChanged>>"
+
+    @classmethod
+    def shared(cls, tk_root):
+        """ The monitor of this Tk application, started on first use """
+        monitor = getattr(tk_root, 'device_monitor', None)
+        if monitor is None:
+            monitor = tk_root.device_monitor = cls(tk_root)
+        return monitor
+
+    def __init__(self, tk_root):
+        super().__init__(name="device_monitor")
+        self._tk_root = tk_root
+        self._cond = threading.Condition()
+        self._watches = {}
+        self._changes = deque()
+        self._terminated = False
+        self.daemon = True
+        self._tk_root.bind(self.StateChangedEventName, self._on_state_changed)
+        self.start()
+
+    def watch(self, name, read, on_change, fast=1.0, slow=5.0, busy=None):
+        """ Poll read() -> dict on the monitor thread; on_change(state, changed_keys) on the Tk thread
+        busy(state) -> bool selects the fast interval
+        """
+        with self._cond:
+            self._watches[name] = _Watch(name, read, on_change, fast, slow, busy)
+            self._cond.notify()
+
+    def unwatch(self, name):
+        with self._cond:
+            self._watches.pop(name, None)
+
+    def poke(self, name):
+        """ Poll a device now instead of at its next interval """
+        with self._cond:
+            if name in self._watches:
+                self._watches[name].due = time.monotonic()
+                self._cond.notify()
+
+    def state(self, name):
+        """ Last state read from a device, None before the first poll """
+        with self._cond:
+            watch = self._watches.get(name)
+            return watch.state if watch is not None else None
+
+    def terminate(self):
+        with self._cond:
+            self._terminated = True
+            self._cond.notify()
+        self.join()
+
+    def _next_due(self):
+        with self._cond:
+            while not self._terminated:
+                if not self._watches:
+                    self._cond.wait()
+                    continue
+                watch = min(self._watches.values(), key=lambda w: w.due)
+                delay = watch.due - time.monotonic()
+                if delay <= 0:
+                    # not polled again before this poll decides the next interval
+                    watch.due = float('inf')
+                    return watch
+                self._cond.wait(delay)
+            return None
+
+    def _poll(self, watch):
+        try:
+            state = watch.read()
+        except Exception as e:
+            logging.error(f"Polling {watch.name} failed: {e}")
+            state = {'error': str(e)}
+        previous = watch.state or {}
+        changed = [key for key in state.keys() | previous.keys() if key not in state or key not in previous or state[key] != previous[key]]
+        busy = watch.busy is not None and 'error' not in state and watch.busy(state)
+        with self._cond:
+            watch.state = state
+            if watch.due == float('inf'):
+                watch.due = time.monotonic() + (watch.fast if busy or (changed and previous) else watch.slow)
+        if changed:
+            self._changes.append((watch, state, changed))
+            self._tk_root.event_generate(self.StateChangedEventName, when="tail")
+
+    def run(self):
+        logging.info(f"Started {self.__class__.__name__} thread")
+        while (watch := self._next_due()) is not None:
+            self._poll(watch)
+
+    def _on_state_changed(self, event):
+        while self._changes:
+            watch, state, changed = self._changes.popleft()
+            with self._cond:
+                current = self._watches.get(watch.name) is watch
+            if current:
+                watch.on_change(state, changed)
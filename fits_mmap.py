@@ -0,0 +1,148 @@
+""" Memory-mapped FITS image reader
+
+Our own captures are plain uncompressed primary HDUs, so the data block starts right after the
+header and can be mapped directly: nothing is read until pixels are touched, and a region of
+interest only pages in the rows it covers. Anything else (compressed, extensions only, random
+groups) goes through astropy with memmap=True.
+"""
+
+import mmap
+import numpy as np
+from astropy.io import fits
+
+BLOCK = 2880
+CARD = 80
+
+_BITPIX_DTYPES = {8: '>u1', 16: '>i2', 32: '>i4', 64: '>i8', -32: '>f4', -64: '>f8'}
+
+
+def _read_header(f):
+    """ Read primary header blocks; returns (Header, data offset)
+    """
+    raw = b''
+    while True:
+        block = f.read(BLOCK)
+        if len(block) < BLOCK:
+            raise ValueError("Truncated FITS header")
+        raw += block
+        # END card is alone on its 80 column card
+        for i in range(len(raw) - BLOCK, len(raw), CARD):
+            if raw[i:i + 8] == b'END     ':
+                return fits.Header.fromstring(raw[:i + CARD].decode('ascii')), len(raw)
+
+
+class FitsImage:
+    """ Primary image of a FITS file, memory-mapped
+
+    stored: zero-copy view of the pixel values as stored in the file (big endian, before BZERO/BSCALE)
+    read(roi): native byte order, scaled values of the whole image or of a (y0, y1, x0, x1) region
+    """
+
+    def __init__(self, fname):
+        self.fname = str(fname)
+        self._hdul = None
+        self._shape = None
+        self._mmap = None
+        self._file = open(self.fname, 'rb')
+        try:
+            self.header, offset = _read_header(self._file)
+            if self._mappable(self.header):
+                self._map(offset)
+            else:
+                self._file.close()
+                self._file = None
+                self._open_astropy()
+        except Exception:
+            self.close()
+            raise
+
+    def _map(self, offset):
+        shape = tuple(self.header[f'NAXIS{n}'] for n in range(self.header['NAXIS'], 0, -1))
+        dtype = np.dtype(_BITPIX_DTYPES[self.header['BITPIX']])
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.stored = np.frombuffer(self._mmap, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        self.bzero = self.header.get('BZERO', 0)
+        self.bscale = self.header.get('BSCALE', 1)
+
+    def _open_astropy(self):
+        self._hdul = fits.open(self.fname, memmap=True)
+        hdu = next(h for h in self._hdul if h.is_image and h.header.get('NAXIS', 0) >= 2)
+        try:
+            hdu.section[(0,) * hdu.header['NAXIS']]
+        except ValueError:
+            # astropy refuses to memory-map scaled (BZERO/BSCALE) data in some HDU types
+            index = self._hdul.index_of(hdu)
+            self._hdul.close()
+            self._hdul = fits.open(self.fname, memmap=False)
+            hdu = self._hdul[index]
+        self.header = hdu.header
+        # section reads lazily (also tile compressed images) and applies the scaling itself
+        self.stored = hdu.section
+        self._shape = hdu.shape
+        self.bzero, self.bscale = 0, 1
+
+    @staticmethod
+    def _mappable(header):
+        return (header.get('SIMPLE', False) and header.get('NAXIS', 0) >= 2 and
+                header.get('BITPIX') in _BITPIX_DTYPES and not header.get('GROUPS', False) and
+                header.get('BSCALE', 1) == 1 and 'BLANK' not in header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.stored = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # a caller still holds a view of `stored`; the map goes away with it
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._hdul is not None:
+            self._hdul.close()
+            self._hdul = None
+
+    @property
+    def shape(self):
+        return self.stored.shape if self._hdul is None else self._shape
+
+    def _dtype(self):
+        """ Native dtype of the scaled values; BZERO 2^(n-1) marks unsigned integers """
+        stored = self.stored.dtype
+        if stored.kind == 'i' and self.bzero == 2**(stored.itemsize * 8 - 1):
+            return np.dtype(f'u{stored.itemsize}')
+        if self.bzero == 0:
+            return stored.newbyteorder('=')
+        return np.dtype(np.float64 if stored.itemsize > 4 else np.float32)
+
+    def read(self, roi=None):
+        """ Scaled pixels in native byte order; roi = (y0, y1, x0, x1) reads only that region
+        This is a copy: FITS integers are big endian and unsigned ones are stored with a BZERO offset
+        """
+        data = self.stored[...] if roi is None else self.stored[..., roi[0]:roi[1], roi[2]:roi[3]]
+        if self._hdul is not None:
+            return data.astype(data.dtype.newbyteorder('='), copy=False)
+        dtype = self._dtype()
+        if dtype.kind == 'u' and data.dtype.kind == 'i':
+            # unsigned stored with BZERO offset: flipping the sign bit is the same as adding BZERO
+            out = data.astype(dtype)
+            out ^= np.array(self.bzero, dtype=dtype)
+            return out
+        out = data.astype(dtype)
+        if self.bzero != 0:
+            out += self.bzero
+        return out
+
+
+def read_fits(fname, roi=None):
+    """ Read (image, header) through the memory map, closing the file before returning
+    """
+    with FitsImage(fname) as f:
+        return f.read(roi), f.header
@@ -6,6 +6,8 @@ from datetime import datetime
 from astropy.io import fits
 from image_data import ImageData
 import logging
+from settings import config
+from device_monitor import DeviceMonitor
 
 
 class FocuserService(ServiceBase):
@@ -17,18 +19,26 @@ class FocuserService(ServiceBase):
         super().__init__(tk_root)
         self._focuser = focuser
         self._camera_svc = camera_svc
-        self._tk_root.after(1000, self._poll_focuser_position)
+        # polled in the background: every second while the position changes, every 5 seconds otherwise
+        self._monitor = DeviceMonitor.shared(tk_root)
+        self._monitor.watch('focuser', self._read_focuser_position, self._on_focuser_position_change, fast=1.0, slow=5.0)
 
-    def _publish_focuser_position(self):
-        if self._focuser is not None and self._focuser.connected:
-            self._tk_root.event_generate(FocuserService.PositionUpdateEventName, when="tail", x=0, y=self._focuser.position)
+    def terminate(self):
+        self._monitor.unwatch('focuser')
+        super().terminate()
 
-    def _poll_focuser_position(self):
-        try:
-            self._publish_focuser_position()
-        except Exception as e:
-            logging.error(f"Error polling focuser position: {e}")
-        self._tk_root.after(5000, self._poll_focuser_position)
+    def _read_focuser_position(self):
+        """ Runs on the monitor thread """
+        if self._focuser is None or not self._focuser.connected:
+            return {'position': None}
+        return {'position': self._focuser.position}
+
+    def _on_focuser_position_change(self, state, changed):
+        if state.get('position') is not None:
+            self._tk_root.event_generate(FocuserService.PositionUpdateEventName, when="tail", x=0, y=state['position'])
+
+    def _publish_focuser_position(self):
+        self._monitor.poke('focuser')
 
     def process(self):
         if self._focuser is not None and self._focuser.connected:
@@ -116,11 +126,12 @@ class FocuserService(ServiceBase):
             "iso": 300,
             "exp": 5.0,
             "image_type": "Light",
+            "subframe": config.get('focus_subframe', 1.0),
             "output_fname": f"{self.autofocus_number}_{position}_focus.fit"
         }
         imageData = self._camera_svc.run_job(job)
         if imageData is None:
-            raise RuntimeError("Capture failed")
+            raise RuntimeError(f"Capture failed: {self._camera_svc.error_message}")
         imageData.computeStars()
         fwhm = np.sqrt(imageData.stars.fwhm_x**2 + imageData.stars.fwhm_y**2).mean()
         return fwhm
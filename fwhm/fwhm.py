@@ -200,6 +200,112 @@ def fitgaussian2d(data, circular=False, centered=False):
         popt[4] = popt[3]
     return tuple(popt)
 
+def stack_cutouts(cutouts):
+    """ Pad a list of 2D star cutouts into a single (N, H, W) float64 stack
+    Cutouts are anchored at the top-left so pixel coordinates match the per-star arrays.
+    Returns (stack, mask) where mask marks the valid (non padded) pixels
+    """
+    h = max(c.shape[0] for c in cutouts)
+    w = max(c.shape[1] for c in cutouts)
+    stack = np.zeros((len(cutouts), h, w), dtype=np.float64)
+    mask = np.zeros((len(cutouts), h, w), dtype=bool)
+    for i, c in enumerate(cutouts):
+        stack[i, :c.shape[0], :c.shape[1]] = c
+        mask[i, :c.shape[0], :c.shape[1]] = True
+    return stack, mask
+
+
+def moments_batch(stack, mask):
+    """ Returns (height, x, y, sigma_x, sigma_y) arrays for every cutout in the stack
+    Closed-form estimates from background subtracted, intensity weighted second moments.
+    Same axis convention as fitgaussian2d: x runs along axis 0 (rows), y along axis 1 (cols)
+    """
+    n = stack.shape[0]
+    flat = np.where(mask, stack, np.nan).reshape(n, -1)
+    bg = np.nanmedian(flat, axis=1)
+    noise = 1.4826 * np.nanmedian(np.abs(flat - bg[:, None]), axis=1)
+    data = stack - bg[:, None, None]
+    # Ignore pixels within the noise floor so the wings don't inflate the second moments
+    data = np.where(mask & (data > 3 * noise[:, None, None]), data, 0)
+
+    X, Y = np.indices(stack.shape[1:])
+    total = data.sum(axis=(1, 2))
+    total = np.where(total > 0, total, 1)
+    x = (X * data).sum(axis=(1, 2)) / total
+    y = (Y * data).sum(axis=(1, 2)) / total
+    var_x = ((X - x[:, None, None])**2 * data).sum(axis=(1, 2)) / total
+    var_y = ((Y - y[:, None, None])**2 * data).sum(axis=(1, 2)) / total
+    height = data.reshape(n, -1).max(axis=1)
+    return height, x, y, np.sqrt(np.maximum(var_x, 1e-6)), np.sqrt(np.maximum(var_y, 1e-6))
+
+
+def fitgaussian2d_batch(stack, mask, max_iter=50, tol=1e-8):
+    """ Returns (height, x, y, sigma_x, sigma_y) arrays for every cutout in the stack
+    Vectorized Levenberg-Marquardt fit of the same model and bounds as fitgaussian2d,
+    with all stars iterated together; each star keeps its own damping factor.
+    """
+    n = stack.shape[0]
+    X, Y = np.indices(stack.shape[1:])
+    X = X.astype(np.float64).reshape(1, -1)
+    Y = Y.astype(np.float64).reshape(1, -1)
+    data = stack.reshape(n, -1)
+    m = mask.reshape(n, -1).astype(np.float64)
+    rows = mask.any(axis=2).sum(axis=1)
+    cols = mask.any(axis=1).sum(axis=1)
+
+    lower = np.column_stack([np.zeros(n), np.zeros(n), np.zeros(n), np.full(n, 1e-3), np.full(n, 1e-3)])
+    upper = np.column_stack([np.where(mask, stack, 0).reshape(n, -1).max(axis=1) * 2, rows, cols, rows * 2, cols * 2])
+
+    def evaluate(p):
+        h, x0, y0, sx, sy = (p[:, i:i+1] for i in range(5))
+        dx = X - x0
+        dy = Y - y0
+        g = np.exp(-((dx / sx)**2 + (dy / sy)**2) / 2)
+        r = (h * g - data) * m
+        return g, dx, dy, r
+
+    p = np.column_stack(moments_batch(stack, mask))
+    p = np.clip(p, lower, upper)
+    g, dx, dy, r = evaluate(p)
+    cost = (r**2).sum(axis=1)
+    lam = np.full(n, 1e-3)
+    active = np.ones(n, dtype=bool)
+
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        h, sx, sy = p[:, 0:1], p[:, 3:4], p[:, 4:5]
+        hg = h * g * m
+        J = np.stack([
+            g * m,
+            hg * dx / sx**2,
+            hg * dy / sy**2,
+            hg * dx**2 / sx**3,
+            hg * dy**2 / sy**3,
+        ], axis=2)
+        JTJ = np.einsum('npi,npj->nij', J, J)
+        JTr = np.einsum('npi,np->ni', J, r)
+        A = JTJ + lam[:, None, None] * (np.eye(5) * np.diagonal(JTJ, axis1=1, axis2=2)[:, None, :] + 1e-12 * np.eye(5))
+        delta = np.linalg.solve(A, -JTr[:, :, None])[:, :, 0]
+
+        p_new = np.clip(p + delta, lower, upper)
+        g_new, dx_new, dy_new, r_new = evaluate(p_new)
+        cost_new = (r_new**2).sum(axis=1)
+
+        improved = active & (cost_new < cost)
+        converged = improved & ((cost - cost_new) <= tol * cost)
+        p = np.where(improved[:, None], p_new, p)
+        g = np.where(improved[:, None], g_new, g)
+        dx = np.where(improved[:, None], dx_new, dx)
+        dy = np.where(improved[:, None], dy_new, dy)
+        r = np.where(improved[:, None], r_new, r)
+        cost = np.where(improved, cost_new, cost)
+        lam = np.where(improved, lam / 10, lam * 10)
+        active &= ~converged & (lam < 1e10)
+
+    return p[:, 0], p[:, 1], p[:, 2], p[:, 3], p[:, 4]
+
+
 def fwhm(sigma):
     """ Calculates the full width half maximum for a given width
     only makes sense for circular gaussians """
@@ -0,0 +1,135 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import cv2
+from .star_finder import StarFinder
+
+
+# Per-process star finder, created once by the pool initializer
+_worker_star_finder = None
+
+
+def _init_worker(fit_mode):
+    global _worker_star_finder
+    # One OpenCV thread per process, otherwise N processes x M cores oversubscribe the CPU
+    cv2.setNumThreads(1)
+    _worker_star_finder = StarFinder(fit_mode=fit_mode)
+
+
+def _analyze_file(fname, topk):
+    """ Runs in worker: load frame from disk and return its star table only
+    Full frames (image / star_mask) are dropped so nothing large is pickled back
+    """
+    star_data = _worker_star_finder.getStarData(fname, topk=topk)
+    return star_data['stars']
+
+
+def _analyze_shared(img8_desc, img16_desc, topk):
+    """ Runs in worker: attach to frames published by the parent in shared memory
+    """
+    shm8, img8 = _attach(img8_desc)
+    shm16, img16 = _attach(img16_desc)
+    try:
+        _, stars = _worker_star_finder.find_stars(img8=img8, img16=img16, topk=topk)
+        return stars
+    finally:
+        del img8, img16
+        shm8.close()
+        shm16.close()
+
+
+def _publish(arr: np.ndarray):
+    """ Copy array into a new shared memory block owned by the caller
+    Returns (shm, descriptor) where descriptor is a small picklable (name, shape, dtype) tuple
+    """
+    arr = np.ascontiguousarray(np.squeeze(arr))
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def _attach(desc):
+    name, shape, dtype = desc
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+class ParallelStarFinder:
+    """ Fans StarFinder analysis of many frames out across a process pool
+    Results are streamed back in submission order; at most `max_in_flight` frames
+    are queued at any time so memory stays bounded on long sessions.
+    """
+
+    def __init__(self, max_workers=None, fit_mode="scipy", max_in_flight=None):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or 2 * self.max_workers
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             initializer=_init_worker,
+                                             initargs=(fit_mode,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _stream(self, jobs):
+        """ Submit (key, submit_args, shared_blocks) jobs with a bounded window, yield (key, result) in order
+        Shared memory blocks of a job are released once its result has been consumed.
+        """
+        def release(blocks):
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+        pending = deque()
+        jobs = iter(jobs)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < self.max_in_flight:
+                    try:
+                        key, args, blocks = next(jobs)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending.append((key, self._executor.submit(*args), blocks))
+                if not pending:
+                    return
+                key, future, blocks = pending[0]
+                result = future.result()
+                pending.popleft()
+                release(blocks)
+                yield key, result
+        finally:
+            # Consumer stopped early or a frame failed: drop outstanding work
+            for _, future, blocks in pending:
+                future.cancel()
+                try:
+                    future.exception()
+                except Exception:
+                    pass
+                release(blocks)
+
+    def map_files(self, fnames, topk=20):
+        """ Analyze FITS/XISF/NEF files; yields (fname, stars DataFrame) in input order
+        """
+        yield from self._stream((fname, (_analyze_file, str(fname), topk), []) for fname in fnames)
+
+    def map_frames(self, frames, topk=20):
+        """ Analyze in-memory frames given as (img8, img16) pairs; yields (index, stars DataFrame) in order
+        Frames are handed to workers through shared memory instead of being pickled.
+        """
+        def jobs():
+            for idx, (img8, img16) in enumerate(frames):
+                shm8, desc8 = _publish(img8)
+                shm16, desc16 = _publish(img16)
+                yield idx, (_analyze_shared, desc8, desc16, topk), [shm8, shm16]
+        yield from self._stream(jobs())
@@ -5,35 +5,224 @@ import cv2
 from tqdm import tqdm
 import pandas as pd
 import math
-from fwhm.fwhm import getFWHM_GaussianFitScaledAmp, fwhm1d, fwhm2d, fitgaussian2d, fwhm
+from fwhm.fwhm import getFWHM_GaussianFitScaledAmp, fwhm1d, fwhm2d, fitgaussian2d, fwhm, stack_cutouts, moments_batch, fitgaussian2d_batch
 from fwhm.star_centroid import iwc_centroid
-from astropy.io import fits
 from xisf.xisf_parser import read_xisf
+from fits_mmap import read_fits
 import time
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 # from debayer.nn_debayer import make_debayer
 # debayer = make_debayer()
 
+FIT_MODES = ["scipy", "batched", "moments"]
+DETECT_MODES = ["full", "tiled", "pyramid"]
+
+# Rows/cols of context needed so the morphology of a sub-region matches the full frame:
+# open 7x7 (3+3) and ring dilate 29x29 followed by erode 25x25 (14+12)
+DETECT_HALO = 26
+
+def _make_kernels(scale=1):
+  """ Structuring elements for star detection, shrunk by `scale` for binned images """
+  def ksize(k):
+    k = max(1, int(k // scale))
+    return k if k % 2 == 1 else k - 1
+  Bs = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(ksize(7),ksize(7)))
+  Bmi = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(ksize(21),ksize(21)))
+  Be = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(ksize(25),ksize(25)))
+  Bm = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(ksize(29),ksize(29)))
+  d = (Bm.shape[0] - Bmi.shape[0]) // 2
+  Bm[d:d+Bmi.shape[0], d:d+Bmi.shape[0]] -= Bmi
+  return Bs, Bm, Be
+
+def _max_bin(img, factor):
+  """ Downsample by `factor` keeping the brightest pixel of each block, so small stars survive binning
+  Rows are reduced first, so the column pass runs on a frame `factor` times smaller
+  """
+  h, w = img.shape[0] // factor * factor, img.shape[1] // factor * factor
+  rows = img[0:h:factor].copy()
+  for i in range(1, factor):
+    np.maximum(rows, img[i:h:factor], out=rows)
+  binned = rows[:, 0:w:factor].copy()
+  for i in range(1, factor):
+    np.maximum(binned, rows[:, i:w:factor], out=binned)
+  return binned
+
+def _star_residual(img8, Bs, Bm, Be):
+  """ Top-hat style residual: opened image minus local ring background """
+  K = cv2.morphologyEx(img8, cv2.MORPH_OPEN, Bs)
+  N = cv2.morphologyEx(cv2.morphologyEx(img8, cv2.MORPH_DILATE, Bm), cv2.MORPH_ERODE, Be)
+  return K - np.minimum(K,N)
+
 class StarFinder():
-  def __init__(self):
-    self.Bs = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(7,7))
-    Bmi = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(21,21))
-    self.Be = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(25,25))
-    Bmo = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(29,29))
-    d = (Bmo.shape[0] - Bmi.shape[0]) // 2
-    self.Bm = cv2.getStructuringElement(shape=cv2.MORPH_RECT, ksize=(29,29))
-    self.Bm[d:d+Bmi.shape[0], d:d+Bmi.shape[0]] -= Bmi
-
-  def find_stars(self, img8: np.ndarray, img16: np.ndarray, topk:int=None):
+  def __init__(self, fit_mode="scipy", detect_mode="full", pyramid_factor=4, num_strips=None):
+    if fit_mode not in FIT_MODES:
+      raise ValueError(f"Unknown fit mode: {fit_mode}")
+    if detect_mode not in DETECT_MODES:
+      raise ValueError(f"Unknown detect mode: {detect_mode}")
+    if pyramid_factor not in (2, 4, 8):
+      raise ValueError(f"Pyramid factor must be 2, 4 or 8: {pyramid_factor}")
+    self.fit_mode = fit_mode
+    self.detect_mode = detect_mode
+    self.pyramid_factor = pyramid_factor
+    self.num_strips = num_strips or os.cpu_count() or 1
+    self._strip_pool = None
+    self.Bs, self.Bm, self.Be = _make_kernels()
+    self._pyramid_kernels = _make_kernels(pyramid_factor)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    if self._strip_pool is not None:
+      self._strip_pool.shutdown(wait=True)
+      self._strip_pool = None
+
+  def _star_mask(self, img8, detect_mode, max_candidates):
+    """ Star residual mask for the whole frame
+    detect_mode: "full" runs the morphology on the entire frame,
+                 "tiled" splits the frame into overlapping strips processed by a thread pool,
+                 "pyramid" detects candidates on a binned frame and refines only their tiles at full resolution
+    """
+    if detect_mode == "full":
+      return _star_residual(img8, self.Bs, self.Bm, self.Be)
+    elif detect_mode == "tiled":
+      return self._star_mask_tiled(img8)
+    elif detect_mode == "pyramid":
+      return self._star_mask_pyramid(img8, max_candidates)
+    else:
+      raise ValueError(f"Unknown detect mode: {detect_mode}")
+
+  def _star_mask_tiled(self, img8):
+    img_height = img8.shape[0]
+    strip_height = max(DETECT_HALO, (img_height + self.num_strips - 1) // self.num_strips)
+    R = np.empty_like(img8)
+
+    def process_strip(top):
+      bottom = min(img_height, top + strip_height)
+      src_top = max(0, top - DETECT_HALO)
+      src_bottom = min(img_height, bottom + DETECT_HALO)
+      strip = _star_residual(img8[src_top:src_bottom], self.Bs, self.Bm, self.Be)
+      R[top:bottom] = strip[top - src_top:bottom - src_top]
+
+    if self._strip_pool is None:
+      self._strip_pool = ThreadPoolExecutor(max_workers=self.num_strips, thread_name_prefix="star_strip")
+    # OpenCV releases the GIL, so strips run concurrently
+    list(self._strip_pool.map(process_strip, range(0, img_height, strip_height)))
+    return R
+
+  def _star_mask_pyramid(self, img8, max_candidates):
+    img_height, img_width = img8.shape[:2]
+    f = self.pyramid_factor
+    binned = _max_bin(img8, f)
+    coarse = _star_residual(binned, *self._pyramid_kernels)
+    numlabels, labels = cv2.connectedComponents(coarse, None, 4, cv2.CV_32S)
+    if numlabels <= 1:
+      return np.zeros_like(img8)
+    # Only a few thousand coarse pixels are stars: rank and bound their components from those alone
+    xs, ys = cv2.findNonZero(coarse).reshape(-1, 2).T
+    lab = labels[ys, xs]
+    # Binned areas are a few pixels and tie a lot; rank candidates by residual flux instead
+    flux = np.bincount(lab, weights=coarse[ys, xs], minlength=numlabels)
+    candidates = np.argsort(flux[1:])[::-1][:max_candidates] + 1
+    top, left = np.full(numlabels, binned.shape[0]), np.full(numlabels, binned.shape[1])
+    bottom, right = np.zeros(numlabels, int), np.zeros(numlabels, int)
+    np.minimum.at(top, lab, ys)
+    np.minimum.at(left, lab, xs)
+    np.maximum.at(bottom, lab, ys + 1)
+    np.maximum.at(right, lab, xs + 1)
+
+    # Refine the whole coarse bbox of each candidate at full resolution
+    R = np.zeros_like(img8)
+    margin = 2 * f
+    windows = [(max(0, top[i] * f - margin), min(img_height, bottom[i] * f + margin),
+                max(0, left[i] * f - margin), min(img_width, right[i] * f + margin)) for i in candidates]
+    # A star can reach further at full resolution than its coarse bbox: grow those windows until
+    # no residual touches their edge, so components are never truncated
+    while windows:
+      windows = self._refine_windows(img8, windows, R, grow=max(margin, DETECT_HALO))
+    return R
+
+  def _refine_windows(self, img8, windows, R, grow):
+    """ Write the exact residual of each (top, bottom, left, right) window of img8 into R
+    Windows are cut out with their halo and packed side by side on one canvas, so the morphology
+    runs once for all of them; the halo keeps neighbours on the canvas from leaking into a window.
+    Windows at the frame border have no halo there and are processed on their own.
+    Returns the windows grown on the sides where their residual reaches the edge.
+    """
+    img_height, img_width = img8.shape[:2]
+    H = DETECT_HALO
+    packed, alone = [], []
+    for t, b, l, r in windows:
+      src = (max(0, t - H), min(img_height, b + H), max(0, l - H), min(img_width, r + H))
+      (packed if src == (t - H, b + H, l - H, r + H) else alone).append((src, (t, b, l, r)))
+
+    def residuals():
+      for (st, sb, sl, sr), window in alone:
+        yield _star_residual(img8[st:sb, sl:sr], self.Bs, self.Bm, self.Be), (st, sl), window
+      if not packed:
+        return
+      # shelf packing: tallest tiles first, rows as wide as the frame
+      packed.sort(key=lambda tile: tile[0][0] - tile[0][1])
+      placed, shelf_top, shelf_height, x = [], 0, 0, 0
+      for (st, sb, sl, sr), window in packed:
+        if x + sr - sl > img_width:
+          shelf_top, shelf_height, x = shelf_top + shelf_height, 0, 0
+        placed.append((shelf_top, x, st, sb, sl, sr, window))
+        shelf_height = max(shelf_height, sb - st)
+        x += sr - sl
+      canvas = np.zeros((shelf_top + shelf_height, img_width), dtype=img8.dtype)
+      for cy, cx, st, sb, sl, sr, _ in placed:
+        canvas[cy:cy + sb - st, cx:cx + sr - sl] = img8[st:sb, sl:sr]
+      residual = _star_residual(canvas, self.Bs, self.Bm, self.Be)
+      for cy, cx, st, sb, sl, sr, window in placed:
+        yield residual[cy:cy + sb - st, cx:cx + sr - sl], (st, sl), window
+
+    grown = []
+    for residual, (st, sl), (t, b, l, r) in residuals():
+      tile = residual[t - st:b - st, l - sl:r - sl]
+      R[t:b, l:r] = tile
+      nt = max(0, t - grow) if t > 0 and tile[0].any() else t
+      nb = min(img_height, b + grow) if b < img_height and tile[-1].any() else b
+      nl = max(0, l - grow) if l > 0 and tile[:, 0].any() else l
+      nr = min(img_width, r + grow) if r < img_width and tile[:, -1].any() else r
+      if (nt, nb, nl, nr) != (t, b, l, r):
+        grown.append((nt, nb, nl, nr))
+    return grown
+
+  def fit_stars(self, cutouts, fit_mode):
+    """ Fit a 2D gaussian to each star cutout
+    fit_mode: "scipy" fits one star at a time with curve_fit,
+              "batched" runs a vectorized Levenberg-Marquardt fit over all stars at once,
+              "moments" uses closed-form moment estimates (fastest, least accurate)
+    Returns list of (height, x, y, sigma_x, sigma_y) per cutout
+    """
+    if fit_mode == "scipy":
+      return [fitgaussian2d(star, circular=False, centered=False) for star in cutouts]
+    elif fit_mode in ("batched", "moments"):
+      stack, mask = stack_cutouts(cutouts)
+      if fit_mode == "batched":
+        params = fitgaussian2d_batch(stack, mask)
+      else:
+        params = moments_batch(stack, mask)
+      return list(zip(*params))
+    else:
+      raise ValueError(f"Unknown fit mode: {fit_mode}")
+
+  def find_stars(self, img8: np.ndarray, img16: np.ndarray, topk:int=None, fit_mode:str=None, detect_mode:str=None):
+    fit_mode = fit_mode or self.fit_mode
+    detect_mode = detect_mode or self.detect_mode
     img_height = img8.shape[0]
     img_width = img8.shape[1]
-    K = cv2.morphologyEx(img8, cv2.MORPH_OPEN, self.Bs)
-    N = cv2.morphologyEx(cv2.morphologyEx(img8, cv2.MORPH_DILATE, self.Bm), cv2.MORPH_ERODE, self.Be)
-    R = K - np.minimum(K,N)
+    R = self._star_mask(img8, detect_mode, max_candidates=10 * max(topk or 20, 20))
     numstars, labels, stats, centroids = cv2.connectedComponentsWithStats(R, 4, cv2.CV_16U, cv2.CCL_WU)
 
-    # Select top 20 largest by area
-    top_indices = np.argsort(stats[1:, cv2.CC_STAT_AREA])[::-1][:20] + 1
+    # Select top 20 largest by area; ties broken by position so every detect mode ranks alike
+    top_indices = np.lexsort((centroids[1:, 0], centroids[1:, 1], -stats[1:, cv2.CC_STAT_AREA]))[:20] + 1
     centroids = centroids[top_indices]
     stats = stats[top_indices]
     numstars = len(top_indices)
@@ -46,9 +235,8 @@ class StarFinder():
     #   width = max(width, stats[staridx, cv2.CC_STAT_WIDTH])
     #   height = max(height, stats[staridx, cv2.CC_STAT_HEIGHT])
     # print(f"Star dim: {width}, {height}")
-    total_gaussian_fit_time = 0
-
     bboxes = []
+    cutouts = []
     for staridx in range(1, numstars):
       centroid_x, centroid_y = centroids[staridx]
       # Per-star area
@@ -59,6 +247,7 @@ class StarFinder():
       min_col = int(max(0, centroid_x - width))
       max_col = int(min(img_width, centroid_x + width+1))
       star = img16[min_row:max_row, min_col:max_col]
+      cutouts.append(star)
       # Recalculate centroid
       iwc_cx, iwc_cy = iwc_centroid(star)
 
@@ -69,31 +258,30 @@ class StarFinder():
         tile_no = tile_x + tile_y * tiles_per_row
         return tile_no
 
-      # fwhm_x, fwhm_y, curve_cx, curve_cy = getFWHM_GaussianFitScaledAmp(star)
-      # fwhm_x = fwhm1d(star[int(max_row-min_row)//2, :])
-      # fwhm_y = fwhm1d(star[:, int(max_col-min_col)//2])
-      gaussian_fit_start_time = time.time()
-      ht, curve_cx, curve_cy, sigma_x, sigma_y = fitgaussian2d(star, circular=False, centered=False)
-      total_gaussian_fit_time += time.time() - gaussian_fit_start_time
-
-      fwhm_x, fwhm_y = fwhm(sigma_x), fwhm(sigma_y)
-      # fwhm_x, fwhm_y = star.shape
-      #fwhm_x, fwhm_y, curve_cx, curve_cy = getFWHM(star)
       bboxes.append({'area':stats[staridx, cv2.CC_STAT_AREA],
                      'cluster_cx': centroid_x,
                      'cluster_cy': centroid_y,
                      'iwc_cx': iwc_cx,
                      'iwc_cy': iwc_cy,
-                     'gaussian_cx': curve_cx,
-                     'gaussian_cy': curve_cy,
+                     'gaussian_cx': None,
+                     'gaussian_cy': None,
                      'box':[min_col, min_row, max_col, max_row],
                      'tile_4': tile(4),
                      'tile_32': tile(32),
-                     'fwhm_x': fwhm_x,
-                     'fwhm_y': fwhm_y,
+                     'fwhm_x': None,
+                     'fwhm_y': None,
                     })
 
-    print(f"fitgaussian2d on {numstars} images took {total_gaussian_fit_time:.2f} sec; avg: {(total_gaussian_fit_time/numstars):.6f} sec")
+    gaussian_fit_start_time = time.time()
+    if len(cutouts) > 0:
+      for bbox, (ht, curve_cx, curve_cy, sigma_x, sigma_y) in zip(bboxes, self.fit_stars(cutouts, fit_mode)):
+        bbox['gaussian_cx'] = curve_cx
+        bbox['gaussian_cy'] = curve_cy
+        bbox['fwhm_x'] = fwhm(sigma_x)
+        bbox['fwhm_y'] = fwhm(sigma_y)
+    total_gaussian_fit_time = time.time() - gaussian_fit_start_time
+
+    print(f"{fit_mode} fit on {len(cutouts)} images took {total_gaussian_fit_time:.2f} sec; avg: {(total_gaussian_fit_time/max(len(cutouts), 1)):.6f} sec")
 
     sorted_bboxes = sorted(bboxes, key=lambda x: x['area'], reverse=True)
     if topk is not None:
@@ -113,10 +301,7 @@ class StarFinder():
       hdr = None
 
     elif ext == '.fit':
-      f = fits.open(fname)
-      ph = f[0]
-      img = ph.data
-      hdr = ph.header
+      img, hdr = read_fits(fname)
       if hdr is not None and hdr['BAYERPAT'] == 'RGGB' and img.dtype == np.uint16:
         deb = cv2.cvtColor(img, cv2.COLOR_BAYER_BG2RGB)
         # deb = debayer_superpixel(np.expand_dims(img, axis=2))
@@ -127,8 +312,12 @@ class StarFinder():
 
     elif ext == '.xisf':
       img, hdr = read_xisf(fname)
-      img16 = (np.iinfo(np.uint16).max * img).astype(np.uint16)
-      img8 = (np.iinfo(np.uint8).max * img).astype(np.uint8)
+      if img.dtype == np.uint16:
+        img16 = img
+        img8 = (img >> 8).astype(np.uint8)
+      else:
+        img16 = (np.iinfo(np.uint16).max * img).astype(np.uint16)
+        img8 = (np.iinfo(np.uint8).max * img).astype(np.uint8)
 
     star_mask, bboxes = self.find_stars(img8=np.squeeze(img8), img16=np.squeeze(img16), topk=topk)
     return {  "star_mask": star_mask,
@@ -7,24 +7,74 @@ import matplotlib.pyplot as plt
 from itertools import combinations, product
 from collections import defaultdict
 import math
-from scipy.spatial import Delaunay
+from scipy.spatial import Delaunay, cKDTree
 from .star_finder import StarFinder
+from .parallel_star_finder import ParallelStarFinder
 import logging
 
 
+class TriangleIndex:
+    """ KD-tree over the (fX, fY) invariants of a reference triangle set
+    Built once per reference star set and reused for every target; all target triangles are
+    looked up with one batched range query instead of a DataFrame scan per triangle.
+    """
+
+    def __init__(self, triangles: pd.DataFrame):
+        self.triangles = triangles.reset_index(drop=True)
+        self.fXY = self.triangles[['fX', 'fY']].to_numpy(dtype=np.float64) if len(self.triangles) else np.zeros((0, 2))
+        self.tree = cKDTree(self.fXY) if len(self.fXY) else None
+
+    def __len__(self):
+        return len(self.triangles)
+
+    def query(self, fXY: np.ndarray, tolerance: float, absolute_similar=True):
+        """ Find similar reference triangles for every target invariant pair in fXY (N x 2)
+        absolute_similar: box of +/- tolerance/2 on fX and fY, otherwise a circle of radius tolerance
+        (with the +/- tolerance/2 band on fX)
+        Returns (tgt_idx, ref_idx) arrays of matching pairs, sorted by target then reference
+        """
+        if self.tree is None or len(fXY) == 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+
+        if absolute_similar:
+            hits = self.tree.query_ball_point(fXY, r=tolerance/2, p=np.inf)
+        else:
+            hits = self.tree.query_ball_point(fXY, r=tolerance, p=2)
+        counts = np.fromiter((len(h) for h in hits), dtype=np.intp, count=len(hits))
+        tgt_idx = np.repeat(np.arange(len(fXY)), counts)
+        ref_idx = np.fromiter((i for h in hits for i in sorted(h)), dtype=np.intp, count=counts.sum())
+
+        if not absolute_similar:
+            d = self.fXY[ref_idx] - fXY[tgt_idx]
+            keep = (np.abs(d[:, 0]) <= tolerance/2) & ((d**2).sum(axis=1) < tolerance**2)
+            tgt_idx, ref_idx = tgt_idx[keep], ref_idx[keep]
+        return tgt_idx, ref_idx
+
+
 class StarMatcher:
 
+    def buildRefIndex(self, df_ref: pd.DataFrame, vertex_sorted=True, limit_ref_triangle_fov=None) -> TriangleIndex:
+        """ Build the reference triangle index once so it can be reused across matchStars / matchStarsToTx calls
+        """
+        if vertex_sorted:
+            tri_ref = pd.DataFrame(self._getVertexSortedDelaunayTriangles(df_ref, fov_deg=limit_ref_triangle_fov))
+        else:
+            tri_ref = self._getTriangles(df_ref)
+        return TriangleIndex(tri_ref)
+
     def matchStars(self, df_ref: pd.DataFrame, df_tgt: pd.DataFrame, 
                    vertex_sorted = True,
                    down_votes = True,
                    absolute_similar = True,
                    vote_with_conf = True,
-                   limit_ref_triangle_fov=None):
+                   limit_ref_triangle_fov=None,
+                   ref_index: TriangleIndex = None):
         """ matchStars in a reference and target dataframes from either database or a photo
             Adds columns to target dataframe: starno (index in reference dataframe) and votes (int)
             Returns votes and voting pairs for informational purposes
             Code developed in refine_location.ipynb
             NOTE: must reset_index on target if it will be reused in future match calls
+            ref_index: prebuilt reference index from buildRefIndex (built here if not given)
         """
         result = {
             'vertex_sorted': vertex_sorted,
@@ -34,12 +84,12 @@ class StarMatcher:
             'limit_ref_triangle_fov': limit_ref_triangle_fov
         }
 
+        if ref_index is None:
+            ref_index = self.buildRefIndex(df_ref, vertex_sorted=vertex_sorted, limit_ref_triangle_fov=limit_ref_triangle_fov)
+        tri_ref = ref_index.triangles
         if vertex_sorted:
-            # tri_ref = self._getVertexSortedTriangles(df_ref, combinations(df_ref.index, 3), fov_deg=limit_ref_triangle_fov)
-            tri_ref = pd.DataFrame(self._getVertexSortedDelaunayTriangles(df_ref, fov_deg=limit_ref_triangle_fov))
             tri_tgt = pd.DataFrame(self._getVertexSortedTriangles(df_tgt, combinations(df_tgt.index, 3), fov_deg=None))
         else:
-            tri_ref = self._getTriangles(df_ref)
             tri_tgt = self._getTriangles(df_tgt)
 
         if len(tri_ref) == 0 or len(tri_tgt) == 0:
@@ -62,48 +112,30 @@ class StarMatcher:
 
         votes = np.zeros((len(df_ref)+1, len(df_tgt)+1), dtype=np.float32)
 
-        for tgt in tri_tgt.itertuples():
-            if absolute_similar:
-                similar_triangles = tri_ref[
-                    (tri_ref.fX >= tgt.fX - TRIANGLETOLERANCE/2) &
-                    (tri_ref.fX <= tgt.fX + TRIANGLETOLERANCE/2) &
-                    (tri_ref.fY >= tgt.fY - TRIANGLETOLERANCE/2) &
-                    (tri_ref.fY <= tgt.fY + TRIANGLETOLERANCE/2)
-                ]
-            else:
-                ref_matches = tri_ref[
-                    (tri_ref.fX >= tgt.fX - TRIANGLETOLERANCE/2) &
-                    (tri_ref.fX <= tgt.fX + TRIANGLETOLERANCE/2)]
-                similar_triangles = ref_matches[(ref_matches.fX-tgt.fX)**2 + (ref_matches.fY-tgt.fY)**2 < TRIANGLETOLERANCE**2]
-
-            for ref in similar_triangles.itertuples():
-                if vote_with_conf:
-                    err = ((ref.fX-tgt.fX)**2 + (ref.fY-tgt.fY)**2)
-                    upvote = 1/(np.exp(err*100))
-                    downvote = upvote / 2
-                else:
-                    upvote = 1
-                    downvote = 1/2
-
-                if vertex_sorted:
+        tgt_fXY = tri_tgt[['fX', 'fY']].to_numpy(dtype=np.float64)
+        tgt_idx, ref_idx = ref_index.query(tgt_fXY, TRIANGLETOLERANCE, absolute_similar=absolute_similar)
+
+        if vote_with_conf:
+            err = ((ref_index.fXY[ref_idx] - tgt_fXY[tgt_idx])**2).sum(axis=1)
+            upvote = 1/(np.exp(err*100))
+            downvote = upvote / 2
+        else:
+            upvote = np.ones(len(tgt_idx))
+            downvote = upvote / 2
+
+        if vertex_sorted:
+            ref_v = {v: tri_ref[v].to_numpy(dtype=np.intp)[ref_idx] for v in 'ABC'}
+            tgt_v = {v: tri_tgt[v].to_numpy(dtype=np.intp)[tgt_idx] for v in 'ABC'}
+            for r, t in product('ABC', 'ABC'):
+                if r == t:
                     # expect matched ABC vertices
-                    votes[ref.A, tgt.A] += upvote
-                    votes[ref.B, tgt.B] += upvote
-                    votes[ref.C, tgt.C] += upvote
-
-                    if down_votes:
-                        votes[ref.A, tgt.B] -= downvote
-                        votes[ref.A, tgt.C] -= downvote
-
-                        votes[ref.B, tgt.A] -= downvote
-                        votes[ref.B, tgt.C] -= downvote
-                        
-                        votes[ref.C, tgt.A] -= downvote
-                        votes[ref.C, tgt.B] -= downvote
-                else:
-                    # expect unordered star indices s1, s2, s3
-                    for a,b in product([ref.s1, ref.s2, ref.s3], [tgt.s1, tgt.s2, tgt.s3]):
-                        votes[int(a), b] += upvote
+                    np.add.at(votes, (ref_v[r], tgt_v[t]), upvote)
+                elif down_votes:
+                    np.add.at(votes, (ref_v[r], tgt_v[t]), -downvote)
+        else:
+            # expect unordered star indices s1, s2, s3
+            for r, t in product(['s1', 's2', 's3'], ['s1', 's2', 's3']):
+                np.add.at(votes, (tri_ref[r].to_numpy(dtype=np.intp)[ref_idx], tri_tgt[t].to_numpy(dtype=np.intp)[tgt_idx]), upvote)
 
         logging.info(f"Total triangle comparisons: {len(tri_ref) * len(tri_tgt)}")
         logging.info(f"Total votes: {np.sum(votes)}, hit-ratio: {np.sum(votes) / (len(tri_ref) * len(tri_tgt))}")
@@ -117,15 +149,12 @@ class StarMatcher:
 
         cutoff = votes.max() / 4
         logging.info(f"Vote cutoff threshold: {cutoff}")
-        topVotePairs = list(filter(lambda r: votes[r[0],r[1]] > cutoff, vVotingPairs))
+        topVotePairs = vVotingPairs[votes[vVotingPairs[:, 0], vVotingPairs[:, 1]] > cutoff]
 
-        matches = []
-        for vp in topVotePairs:
-            s1, s2 = vp
-            # if s1 == 0 or s2 == 0: # WHY ?
-            #     continue
-            if np.argmax(votes[:, s2]) == s1 and np.argmax(votes[s1, :]) == s2:
-                matches.append((s1, s2))
+        # Keep pairs that are each other's best vote
+        best_ref = np.argmax(votes, axis=0)
+        best_tgt = np.argmax(votes, axis=1)
+        matches = [(s1, s2) for s1, s2 in topVotePairs if best_ref[s2] == s1 and best_tgt[s1] == s2]
 
         df_tgt['starno'] = None
         df_tgt['votes'] = None
@@ -141,23 +170,25 @@ class StarMatcher:
 
     def matchStarsToTx(self, df_ref: pd.DataFrame, df_tgt: pd.DataFrame, 
                    vertex_sorted = True,
-                   limit_ref_triangle_fov=None):
+                   limit_ref_triangle_fov=None,
+                   ref_index: TriangleIndex = None):
         """ matchStars in a reference and target dataframes from either database or a photo
             Adds columns to target dataframe: starno (index in reference dataframe) and votes (int)
             Returns a transform from df to tgt
             Code developed in refine_location3.ipynb
+            ref_index: prebuilt reference index from buildRefIndex (built here if not given)
         """
         result = {
             'vertex_sorted': vertex_sorted,
             'limit_ref_triangle_fov': limit_ref_triangle_fov
         }
 
+        if ref_index is None:
+            ref_index = self.buildRefIndex(df_ref, vertex_sorted=vertex_sorted, limit_ref_triangle_fov=limit_ref_triangle_fov)
+        tri_ref = ref_index.triangles
         if vertex_sorted:
-            # tri_ref = self._getVertexSortedTriangles(df_ref, combinations(df_ref.index, 3), fov_deg=limit_ref_triangle_fov)
-            tri_ref = pd.DataFrame(self._getVertexSortedDelaunayTriangles(df_ref, fov_deg=limit_ref_triangle_fov))
             tri_tgt = pd.DataFrame(self._getVertexSortedTriangles(df_tgt, combinations(df_tgt.index, 3), fov_deg=None))
         else:
-            tri_ref = self._getTriangles(df_ref)
             tri_tgt = self._getTriangles(df_tgt)
 
         logging.info(f"Ref triangles: {len(tri_ref)}, Tgt triangles: {len(tri_tgt)}")
@@ -165,35 +196,27 @@ class StarMatcher:
         result['tgt_triangles'] = len(tri_tgt)
 
         TRIANGLETOLERANCE = 1e-2
+        tgt_idx, ref_idx = ref_index.query(tri_tgt[['fX', 'fY']].to_numpy(dtype=np.float64), TRIANGLETOLERANCE)
+
+        ref_xy = df_ref[['cluster_cx', 'cluster_cy']].to_numpy(dtype=np.float32)
+        tgt_xy = df_tgt[['cluster_cx', 'cluster_cy']].to_numpy(dtype=np.float32)
+        ref_abc = tri_ref[['A', 'B', 'C']].to_numpy(dtype=np.intp)[ref_idx]
+        tgt_abc = tri_tgt[['A', 'B', 'C']].to_numpy(dtype=np.intp)[tgt_idx]
+
         txs = []
-        for tgt in tri_tgt.itertuples():
-            similar_triangles = tri_ref[
-                (tri_ref.fX >= tgt.fX - TRIANGLETOLERANCE/2) &
-                (tri_ref.fX <= tgt.fX + TRIANGLETOLERANCE/2) &
-                (tri_ref.fY >= tgt.fY - TRIANGLETOLERANCE/2) &
-                (tri_ref.fY <= tgt.fY + TRIANGLETOLERANCE/2)
-            ]
-            for r in similar_triangles.itertuples():
-                ra = df_ref.iloc[r.A][['cluster_cx', 'cluster_cy']].tolist()
-                rb = df_ref.iloc[r.B][['cluster_cx', 'cluster_cy']].tolist()
-                rc = df_ref.iloc[r.C][['cluster_cx', 'cluster_cy']].tolist()
-                ta = df_tgt.iloc[tgt.A][['cluster_cx', 'cluster_cy']].tolist()
-                tb = df_tgt.iloc[tgt.B][['cluster_cx', 'cluster_cy']].tolist()
-                tc = df_tgt.iloc[tgt.C][['cluster_cx', 'cluster_cy']].tolist()
-                src = np.stack([ra, rb, rc]).astype(np.float32)
-                dst = np.stack([ta, tb, tc]).astype(np.float32)
-                tx = cv2.getAffineTransform(src, dst)
-                mapped = False
-                for i, (e,c) in enumerate(txs):
-                    if np.linalg.norm(tx - e) < 10000:
-                        txs[i][1] += 1
-                        mapped = True
-                        logging.info(f"tx: {tx}")
-                        logging.info(f"ref indices: {r.A}, {r.B}, {r.C}")
-                        logging.info(f"tgt indices: {tgt.A}, {tgt.B}, {tgt.C}")
-                        break
-                if not mapped:
-                    txs.append([tx, 1])
+        for r, t in zip(ref_abc, tgt_abc):
+            tx = cv2.getAffineTransform(ref_xy[r], tgt_xy[t])
+            mapped = False
+            for i, (e,c) in enumerate(txs):
+                if np.linalg.norm(tx - e) < 10000:
+                    txs[i][1] += 1
+                    mapped = True
+                    logging.info(f"tx: {tx}")
+                    logging.info(f"ref indices: {r[0]}, {r[1]}, {r[2]}")
+                    logging.info(f"tgt indices: {t[0]}, {t[1]}, {t[2]}")
+                    break
+            if not mapped:
+                txs.append([tx, 1])
 
         tx, num_max_matches = sorted(txs, key=lambda x: x[1], reverse=True)[0]
         result["matches"] = num_max_matches
@@ -206,28 +229,23 @@ class StarMatcher:
         For each triangle ABC, with side lengths a,b,c in asc order (c is longest)
         return (a/c, b/c); sorted by a/c
         """
-        # Cache distances between every pair of stars
-        starDistances = {}
-        for c in combinations(df.index, 2):
-            assert(c[1] > c[0])
-            key = (c[0], c[1])
-            x1, y1 = df.loc[c[0],['cluster_cx', 'cluster_cy']]
-            x2, y2 = df.loc[c[1],['cluster_cx', 'cluster_cy']]
-            starDistances[key] = math.sqrt((x2-x1)**2 + (y2-y1)**2)
-
-        vTriangles = []
-        for i,j,k in combinations(df.index, 3):
-            vDistances = sorted([starDistances[(i,j)], starDistances[(j,k)], starDistances[(i,k)]])
-
-            if vDistances[2] > 0:
-                fX = vDistances[1]/vDistances[2]
-                fY = vDistances[0]/vDistances[2]
+        xy = df[['cluster_cx', 'cluster_cy']].to_numpy(dtype=np.float64)
+        # Distances between every pair of stars
+        dist = np.sqrt(((xy[:, None, :] - xy[None, :, :])**2).sum(axis=2))
 
-                # Add to the triangle list
-                vTriangles.append({"s1":i, "s2":j, "s3":k, "fX":fX, "fY":fY})
+        ijk = np.array(list(combinations(range(len(df)), 3)), dtype=np.intp).reshape(-1, 3)
+        i, j, k = ijk[:, 0], ijk[:, 1], ijk[:, 2]
+        vDistances = np.sort(np.column_stack([dist[i, j], dist[j, k], dist[i, k]]), axis=1)
+        valid = vDistances[:, 2] > 0
+        labels = df.index.to_numpy()[ijk[valid]]
+        vDistances = vDistances[valid]
 
-        vTriangles = sorted(vTriangles, key=lambda x: x["fX"])
-        return pd.DataFrame(vTriangles)
+        vTriangles = pd.DataFrame({
+            "s1": labels[:, 0], "s2": labels[:, 1], "s3": labels[:, 2],
+            "fX": vDistances[:, 1] / vDistances[:, 2],
+            "fY": vDistances[:, 0] / vDistances[:, 2],
+        })
+        return vTriangles.sort_values("fX", kind="stable").reset_index(drop=True)
 
 
     def _getVertexSortedDelaunayTriangles(self, df_ref, fov_deg=None):
@@ -239,10 +257,8 @@ class StarMatcher:
         for mag in range(int(df_ref.mag.min()), int(df_ref.mag.max())+1, 1):
             df = df_ref[(df_ref.mag >= mag) & (df_ref.mag < mag+1)]
 
-            points = []
-            for idx, r in df.iterrows():
-                points.append([r.cluster_cx, r.cluster_cy])
-                pt_idx.append(idx)
+            points = df[['cluster_cx', 'cluster_cy']].to_numpy().tolist()
+            pt_idx.extend(df.index)
 
             if D is None:
                 if len(initial_points) < 4:
@@ -267,94 +283,75 @@ class StarMatcher:
 
 
     def _getVertexSortedTriangles(self, df, simplices, fov_deg=None, cache_distances=False):
-
-        if cache_distances:
-            # Cache distances between every pair of stars
-            starDistances = {}
-            for c in combinations(df.index, 2):
-                assert(c[1] > c[0])
-                key = (c[0], c[1])
-                x1, y1 = df.loc[c[0],['cluster_cx', 'cluster_cy']]
-                x2, y2 = df.loc[c[1],['cluster_cx', 'cluster_cy']]
-
-                if fov_deg:
-                    ra1, dec1 = df.loc[c[0],['ra', 'dec']]
-                    ra2, dec2 = df.loc[c[1],['ra', 'dec']]
-                    sphere_dist = math.sqrt((ra2-ra1)**2 + (dec2-dec1)**2)
-                else:
-                    sphere_dist = None
-
-                cartesian_dist = math.sqrt((x2-x1)**2 + (y2-y1)**2)
-                starDistances[key] = cartesian_dist, sphere_dist
-
-        def starDistance(df, i, j, fov_deg):
-            if fov_deg:
-                ra1, dec1 = df.loc[i,['ra', 'dec']]
-                ra2, dec2 = df.loc[j,['ra', 'dec']]
-                sphere_dist = math.sqrt((ra2-ra1)**2 + (dec2-dec1)**2)
-            else:
-                sphere_dist = None
-            x1, y1 = df.loc[i,['cluster_cx', 'cluster_cy']]
-            x2, y2 = df.loc[j,['cluster_cx', 'cluster_cy']]
-            cartesian_dist = math.sqrt((x2-x1)**2 + (y2-y1)**2)
-            return cartesian_dist, sphere_dist
-
-        vTriangles = []
-        for i,j,k in simplices:
-
-            if cache_distances:
-                ij, ijam = starDistances[(i, j)]
-                jk, jkam = starDistances[(j, k)]
-                ik, ikam = starDistances[(i, k)]
-            else:
-                # edge distances
-                ij, ijam = starDistance(df, i, j, fov_deg)
-                jk, jkam = starDistance(df, j, k, fov_deg)
-                ik, ikam = starDistance(df, i, k, fov_deg)
-
-            # filter out triangles with edges longer than fov
-            # TODO: better to avoid iterating these combinations
-            if fov_deg and (ijam > fov_deg or
-               jkam > fov_deg or
-               ikam > fov_deg):
-                continue
-
-            # sort edges by length
-            s, m, l = sorted([
-                (set([i, j]), ij),
-                (set([j, k]), jk),
-                (set([i, k]), ik)
-            ], key=lambda x:x[1])
-
-            # sorted vertices
-            # AC: longest side, AB: shortest side
-            A = s[0].intersection(l[0]).pop()
-            C = m[0].intersection(l[0]).pop()
-            B = s[0].intersection(m[0]).pop()
-
+        """ Vertex sorted triangles for the given (i, j, k) star index triples
+        AC is the longest side and AB the shortest; fX, fY are the shortest and mid sides over the longest.
+        Triangles with an edge longer than fov_deg (in ra/dec) are skipped.
+        cache_distances: kept for compatibility, edge lengths are always computed in one pass
+        Returns list of {A, B, C, fX, fY} sorted by fX
+        """
+        ijk = np.array(list(simplices), dtype=object).reshape(-1, 3)
+        if len(ijk) == 0:
+            return []
+        pos = df.index.get_indexer(ijk.ravel()).reshape(-1, 3)
+        xy = df[['cluster_cx', 'cluster_cy']].to_numpy(dtype=np.float64)[pos]
+
+        # edges ij, jk, ik and the vertex opposite each of them
+        edges = [(0, 1), (1, 2), (0, 2)]
+        opposite = np.array([2, 0, 1])
+        lengths = np.column_stack([np.sqrt(((xy[:, a] - xy[:, b])**2).sum(axis=1)) for a, b in edges])
+
+        keep = lengths.max(axis=1) > 0
+        # filter out triangles with edges longer than fov
+        if fov_deg:
+            radec = df[['ra', 'dec']].to_numpy(dtype=np.float64)[pos]
+            sphere = np.column_stack([np.sqrt(((radec[:, a] - radec[:, b])**2).sum(axis=1)) for a, b in edges])
+            keep &= (sphere <= fov_deg).all(axis=1)
+        ijk, lengths = ijk[keep], lengths[keep]
+
+        # sort edges by length: s, m, l
+        order = np.argsort(lengths, axis=1, kind="stable")
+        rows = np.arange(len(ijk))[:, None]
+        s, m, l = (lengths[rows[:, 0], order[:, n]] for n in range(3))
+        vertex = lambda edge: ijk[rows[:, 0], opposite[order[:, edge]]]
+
+        # sorted vertices
+        # AC: longest side, AB: shortest side
+        vTriangles = pd.DataFrame({
+            "A": vertex(1),
+            "B": vertex(2),
+            "C": vertex(0),
             # ratio of smallest & mid to longest
-            fX = s[1]/l[1]
-            fY = m[1]/l[1]
-
-            # Add to the triangle list
-            vTriangles.append({"A":A, "B":B, "C":C, "fX":fX, "fY":fY})
+            "fX": s / l,
+            "fY": m / l,
+        })
 
         # output triangles sorted by fX
-        vTriangles = sorted(vTriangles, key=lambda x: x["fX"])
-        return vTriangles
+        return vTriangles.sort_values("fX", kind="stable").to_dict("records")
+
+def _star_tables(image_fnames, max_workers=None):
+    """ Yield star tables for each file in order; analysis runs in a process pool unless max_workers is 1
+    """
+    if max_workers == 1:
+        starFinder = StarFinder()
+        for fname in image_fnames:
+            yield starFinder.getStarData(fname)['stars']
+    else:
+        with ParallelStarFinder(max_workers=max_workers) as finder:
+            for _, stars in finder.map_files(image_fnames):
+                yield stars
+
 
-def register_stars(image_fnames):
+def register_stars(image_fnames, max_workers=None):
     """ Register stars across image frames
     Input: list of image file names
+           max_workers: number of star analysis processes (None: all cores, 1: analyze in this process)
     Output: List of stars that occur in all frames. For each star, a list of occurances in each frame is returned.
     """
-    starFinder = StarFinder()
     matcher = StarMatcher()
 
     star_frames = []
     df = None
-    for fname in image_fnames:
-        starData = starFinder.getStarData(fname)['stars']
+    for starData in _star_tables(image_fnames, max_workers=max_workers):
         if df is None:
             df = starData
             df['starno'] = None
@@ -0,0 +1,89 @@
+""" Histograms and auto-stretch for display
+
+Histograms are computed in one np.bincount over all channels: samples are shifted down to the
+bin width and offset by channel, so there is no per channel pass and no float binning. The
+auto-stretch is the screen transfer function (STF) used by PixInsight: the shadows are clipped
+a few MADs below the median and a midtones transfer function brings the median to a target
+background level. Median and MAD come from the histogram, so nothing is sorted or fitted and
+dark frames (all samples in a few bins) work as well as bright ones.
+"""
+
+import numpy as np
+
+BITS = 16
+FINE_BINS = 4096
+DISPLAY_BINS = 256
+
+
+def subsample_step(shape, max_samples=1 << 20):
+    """ Row and column step keeping about max_samples pixels of an image """
+    return max(int(np.sqrt(shape[0] * shape[1] / max_samples)), 1)
+
+
+def channel_histograms(img, bins=FINE_BINS, step=1):
+    """ (channels, bins) histogram of a 16 bit HxWxC image, taking every step-th row and column """
+    img = img[::step, ::step]
+    channels = img.shape[2]
+    idx = img >> (BITS - int(np.log2(bins)))
+    idx = idx.astype(np.uint32) if channels * bins > 65536 else idx
+    idx += np.arange(channels, dtype=idx.dtype) * bins
+    return np.bincount(idx.ravel(), minlength=channels * bins).reshape(channels, bins)
+
+
+def mosaic_histograms(raw, bins=FINE_BINS, step=1):
+    """ (3, bins) B, G, R histogram straight from an RGGB mosaic, without debayering
+    step subsamples 2x2 blocks, so the colour sites stay balanced
+    """
+    h, w = raw.shape[0] & ~1, raw.shape[1] & ~1
+    blocks = raw[:h, :w].reshape(h // 2, 2, w // 2, 2)[::step, :, ::step, :]
+    idx = blocks.astype(np.uint32)
+    if raw.dtype == np.uint8:
+        idx <<= 8
+    idx >>= BITS - int(np.log2(bins))
+    # R at (0, 0), G at (0, 1) and (1, 0), B at (1, 1); channels in BGR order like the debayered image
+    idx += (np.array([[2, 1], [1, 0]], dtype=np.uint32) * bins)[None, :, None, :]
+    return np.bincount(idx.ravel(), minlength=3 * bins).reshape(3, bins)
+
+
+def rebin(hist, bins=DISPLAY_BINS):
+    """ Sum neighbouring bins down to `bins` bins """
+    return hist.reshape(*hist.shape[:-1], bins, -1).sum(axis=-1)
+
+
+def median_mad(hist):
+    """ Median and median absolute deviation of a histogram, both in [0, 1] """
+    n = hist.sum()
+    if n == 0:
+        return 0.0, 0.0
+    centers = (np.arange(len(hist)) + 0.5) / len(hist)
+    median = centers[np.searchsorted(np.cumsum(hist), n / 2)]
+    dev = np.abs(centers - median)
+    order = np.argsort(dev, kind='stable')
+    mad = dev[order][np.searchsorted(np.cumsum(hist[order]), n / 2)]
+    return float(median), float(mad)
+
+
+def mtf(m, x):
+    """ Midtones transfer function: maps 0 -> 0, m -> 0.5, 1 -> 1 """
+    x = np.asarray(x, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = (m - 1) * x / ((2 * m - 1) * x - m)
+    return np.where(x <= 0, 0.0, np.where(x >= 1, 1.0, y))
+
+
+def auto_stretch(hist, target_background=0.25, shadows_clip=-2.8):
+    """ STF parameters (shadows, midtones, highlights) in [0, 1] for one channel's histogram """
+    median, mad = median_mad(hist)
+    # normalized MAD: the standard deviation of gaussian noise
+    shadows = min(max(median + shadows_clip * 1.4826 * mad, 0.0), median)
+    if median - shadows <= 0:
+        return shadows, 0.5, 1.0
+    midtones = float(mtf(target_background, (median - shadows) / (1.0 - shadows)))
+    return shadows, midtones, 1.0
+
+
+def stretch_table(shadows, midtones, highlights, size=256):
+    """ uint8 lookup table applying the STF to `size` input levels """
+    x = np.arange(size) / (size - 1)
+    x = np.clip((x - shadows) / max(highlights - shadows, 1e-6), 0.0, 1.0)
+    return np.round(mtf(midtones, x) * 255).astype(np.uint8)
@@ -1,7 +1,9 @@
-from astropy.io import fits
+from fits_mmap import FitsImage
+from xisf.xisf_parser import read_xisf
 import numpy as np
 import cv2
 import rawpy
+import histogram
 from fwhm.star_finder import StarFinder
 from fwhm.star_matcher import StarMatcher
 
@@ -18,7 +20,32 @@ def rgb2rggb(img):
 
   return (img[:,:,0] * r_m) + (img[:,:,1] * g1_m) + (img[:,:,1] * g2_m) + (img[:,:,2] * b_m)
 
+def _high_byte(img16):
+    """ 16 -> 8 bit by dropping the low byte (x >> 8) without going through float
+    """
+    if img16.dtype.byteorder == '>' or (img16.dtype.byteorder == '=' and np.little_endian is False):
+        return (img16 >> 8).astype(np.uint8)
+    # little endian: the high byte of every sample is the odd byte
+    return np.ascontiguousarray(img16.view(np.uint8)[..., 1::2])
+
+
+def _native(img):
+    """ OpenCV needs native byte order (FITS data is big endian) """
+    return img if img.dtype.isnative else img.astype(img.dtype.newbyteorder('='))
+
+
 class ImageData:
+    """ Frame with lazily derived pixel products
+
+    Only `raw` (the Bayer mosaic) is kept from the start; rgb24, deb16, gray16, gray8, the
+    half resolution superpixel16, the display pyramid and the histogram are computed on first request and
+    cached. Gray products come straight from the mosaic, 8 bit products from the 16 bit ones by
+    integer shift.
+    """
+
+    PRODUCTS = ['rgb24', 'deb16', 'gray16', 'gray8', 'superpixel16', 'pyramid', 'histogram']
+    PYRAMID_LEVELS = 3
+
     def __init__(self, raw, fname, header):
         self._raw = raw
         self._fname = fname
@@ -27,6 +54,9 @@ class ImageData:
         self._deb16 = None
         self._gray16 = None
         self._gray8 = None
+        self._superpixel16 = None
+        self._pyramid = None
+        self._histogram = None
         self._stars = None
         self._star_img = None
 
@@ -34,13 +64,35 @@ class ImageData:
         self._raw = None
         self._fname = None
         self._header = None
-        self._rgb24 = None
-        self._deb16 = None
-        self._gray16 = None
-        self._gray8 = None
+        self.release()
         self._stars = None
         self._star_img = None
 
+    def compute(self, *products):
+        """ Compute the requested products now (e.g. from a worker thread)
+        """
+        for name in products:
+            if name not in ImageData.PRODUCTS:
+                raise ValueError(f"Unknown image product: {name}")
+            getattr(self, name)
+        return self
+
+    def release(self, *products):
+        """ Drop cached products (all when none given) to free memory; they are recomputed on request
+        """
+        for name in products or ImageData.PRODUCTS:
+            if name not in ImageData.PRODUCTS:
+                raise ValueError(f"Unknown image product: {name}")
+            setattr(self, f"_{name}", None)
+
+    @property
+    def nbytes(self):
+        """ Memory held by raw data and cached products
+        """
+        arrays = [self._raw] + [getattr(self, f"_{name}") for name in ImageData.PRODUCTS if name != 'pyramid']
+        arrays += self._pyramid or []
+        return sum(a.nbytes for a in arrays if a is not None)
+
     @property
     def fname(self):
         return self._fname
@@ -49,6 +101,14 @@ class ImageData:
     def header(self):
         return self._header
 
+    @property
+    def shape(self):
+        """ Image height, width without debayering
+        """
+        if self._rgb24 is not None:
+            return self._rgb24.shape[:2]
+        return self.raw.shape[:2]
+
     @property
     def raw(self):
         """ RAW image data (before debayer)
@@ -77,20 +137,18 @@ class ImageData:
                 raw.close()
 
             elif ext == 'fit':
-                with fits.open(self.fname) as f:
-                    ph = f[0]
-                    img = ph.data
-
-                    if ph.header['BAYERPAT'] == 'RGGB':
-                        self._raw = img
-                        deb = cv2.cvtColor(img, cv2.COLOR_BAYER_BG2BGR)
-                        if self._raw.dtype == np.uint16:
-                            self._deb16 = deb
-                        img = deb.astype(np.float32) / np.iinfo(deb.dtype).max
-                        img = (img * 255).astype(np.uint8)
-                        self._rgb24 = img
+                with FitsImage(self.fname) as f:
+                    if f.header['BAYERPAT'] == 'RGGB':
+                        self._raw = f.read()
                     else:
-                        raise NotImplementedError(f"Unsupported bayer pattern: {ph.header['BAYERPAT']}")
+                        raise NotImplementedError(f"Unsupported bayer pattern: {f.header['BAYERPAT']}")
+
+            elif ext == 'isf':
+                img, hdr = read_xisf(self.fname)
+                if hdr.get('BAYERPAT') == 'RGGB' and img.shape[2] == 1:
+                    self._raw = img[:, :, 0]
+                else:
+                    raise NotImplementedError(f"Unsupported bayer pattern: {hdr.get('BAYERPAT')}")
 
             elif ext in ['png', 'tif', 'jpg']:
                 # convert to Bayer RGGB by creating an np.array
@@ -98,31 +156,34 @@ class ImageData:
 
         return self._raw
 
+    def _mosaic(self):
+        raw = _native(self.raw)
+        if raw.dtype not in (np.uint8, np.uint16):
+            raise NotImplementedError(f"Unsupported raw format: {raw.dtype}")
+        return raw
+
     @property
     def rgb24(self):
         if self._rgb24 is None:
-            deb = cv2.cvtColor(self.raw, cv2.COLOR_BAYER_BG2BGR)
-            if self.raw.dtype == np.uint16:
-                self._deb16 = deb
-
-            img = deb.astype(np.float32) / np.iinfo(deb.dtype).max
-            img = (img * 255).astype(np.uint8)
-            self._rgb24 = img
+            raw = self._mosaic()
+            if raw.dtype == np.uint8:
+                self._rgb24 = cv2.cvtColor(raw, cv2.COLOR_BAYER_BG2BGR)
+            else:
+                # reuse deb16 if somebody asked for it, otherwise debayer into a temporary
+                deb = self._deb16 if self._deb16 is not None else cv2.cvtColor(raw, cv2.COLOR_BAYER_BG2BGR)
+                self._rgb24 = _high_byte(deb)
         return self._rgb24
     
     @property
     def deb16(self):
         if self._deb16 is None:
-            if self.raw.dtype != np.uint16:
-                if self.raw.dtype == np.uint8:
-                    raw = self.raw.astype(np.uint16)
-                    raw *= 256
-                else:
-                    raise NotImplemented(f"Unsupported raw format")
+            raw = self._mosaic()
+            if raw.dtype == np.uint8:
+                deb = cv2.cvtColor(raw, cv2.COLOR_BAYER_BG2BGR).astype(np.uint16)
+                deb <<= 8
             else:
-                raw = self.raw
-
-            self._deb16 = cv2.cvtColor(raw, cv2.COLOR_BAYER_BG2BGR)
+                deb = cv2.cvtColor(raw, cv2.COLOR_BAYER_BG2BGR)
+            self._deb16 = deb
             assert(self._deb16.dtype == np.uint16)
             assert(len(self._deb16.shape) == 3)
             assert(self._deb16.shape[2] == 3)
@@ -131,21 +192,91 @@ class ImageData:
     @property
     def gray16(self):
         if self._gray16 is None:
-            self._gray16 = cv2.cvtColor(self.deb16, cv2.COLOR_BGR2GRAY)
+            raw = self._mosaic()
+            # luminance interpolated straight from the mosaic, no 3 channel intermediate
+            gray = cv2.cvtColor(raw, cv2.COLOR_BAYER_BG2GRAY)
+            if gray.dtype == np.uint8:
+                gray = gray.astype(np.uint16)
+                gray <<= 8
+            self._gray16 = gray
         return self._gray16
 
     @property
     def gray8(self):
         if self._gray8 is None:
-            self._gray8 = ((self.gray16 / np.iinfo(np.uint16).max) *np.iinfo(np.uint8).max).astype(np.uint8)
+            if self._gray16 is None and self._mosaic().dtype == np.uint8:
+                self._gray8 = cv2.cvtColor(self._mosaic(), cv2.COLOR_BAYER_BG2GRAY)
+            else:
+                self._gray8 = _high_byte(self.gray16)
         return self._gray8
+
+    @property
+    def superpixel16(self):
+        """ Half resolution luminance: mean of every RGGB 2x2 block, for previews and focusing
+        """
+        if self._superpixel16 is None:
+            raw = self._mosaic()
+            h, w = raw.shape[0] & ~1, raw.shape[1] & ~1
+            acc = raw[0:h:2, 0:w:2].astype(np.uint32)
+            acc += raw[0:h:2, 1:w:2]
+            acc += raw[1:h:2, 0:w:2]
+            acc += raw[1:h:2, 1:w:2]
+            if raw.dtype == np.uint8:
+                acc <<= 6
+            else:
+                acc >>= 2
+            self._superpixel16 = acc.astype(np.uint16)
+        return self._superpixel16
     
+    @property
+    def pyramid(self):
+        """ [1/2, 1/4, 1/8] resolution 8 bit BGR images for display
+        The half resolution level comes straight from the RGGB blocks of the mosaic (R, mean of
+        the Gs, B), so the viewer can paint a new frame before anything is debayered.
+        """
+        if self._pyramid is None:
+            raw = self.raw
+            if self._rgb24 is None and raw.ndim == 2:
+                raw = self._mosaic()
+                h, w = raw.shape[0] & ~1, raw.shape[1] & ~1
+                g = raw[0:h:2, 1:w:2].astype(np.uint32)
+                g += raw[1:h:2, 0:w:2]
+                g >>= 1
+                level = np.dstack([raw[1:h:2, 1:w:2], g.astype(raw.dtype), raw[0:h:2, 0:w:2]])
+                if level.dtype == np.uint16:
+                    level = _high_byte(level)
+            else:
+                level = self._half(self.rgb24)
+            levels = [level]
+            while len(levels) < ImageData.PYRAMID_LEVELS:
+                levels.append(self._half(levels[-1]))
+            self._pyramid = levels
+        return self._pyramid
+
+    @staticmethod
+    def _half(img):
+        h, w = img.shape[:2]
+        return cv2.resize(img, ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA)
+
+    @property
+    def histogram(self):
+        """ (3, histogram.FINE_BINS) histogram of the 16 bit B, G, R channels, from about a million samples
+        Taken from the mosaic, so the frame does not have to be debayered for it
+        """
+        if self._histogram is None:
+            if self._deb16 is not None:
+                self._histogram = histogram.channel_histograms(self._deb16, step=histogram.subsample_step(self._deb16.shape))
+            else:
+                raw = self._mosaic()
+                # the step counts 2x2 blocks: a quarter million blocks are a million samples
+                step = histogram.subsample_step((raw.shape[0] // 2, raw.shape[1] // 2), 1 << 18)
+                self._histogram = histogram.mosaic_histograms(raw, step=step)
+        return self._histogram
+
     def get_deb16_histogram(self):
-        """ Get 16-bit debayered histogram for R, G, B channels
+        """ Get 16-bit debayered histogram for R, G, B channels, 256 bins each
         """
-        r_hist, _ = np.histogram(self.deb16[:,:,0], bins=256, range=(0, 65536))
-        g_hist, _ = np.histogram(self.deb16[:,:,1], bins=256, range=(0, 65536))
-        b_hist, _ = np.histogram(self.deb16[:,:,2], bins=256, range=(0, 65536))
+        r_hist, g_hist, b_hist = histogram.rebin(self.histogram)
         return r_hist, g_hist, b_hist
 
     def computeStars(self):
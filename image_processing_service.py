@@ -2,60 +2,93 @@ from service_base import ServiceBase
 import cv2
 import numpy as np
 import tkinter as tk
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image, ImageTk
+from settings import config
+from ui.tile_renderer import TILE
 
 
 class ImageProcessingService(ServiceBase):
+    """ Renders display tiles on a pool of worker threads
+
+    OpenCV and NumPy release the GIL, so up to display_workers jobs run side by side. Each worker
+    renders and stretches tiles in one preallocated tile buffer and returns PIL images copied from
+    it; ImageTk.PhotoImage objects are only created on the Tk thread, in the completion callbacks.
+    """
 
     def __init__(self, tk_root):
         super().__init__(tk_root)
+        self._workers = config.get('display_workers', 2)
+        self._running = 0
+        self._buffers = threading.local()
+        self._threads = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix="image_processing")
+
+    def _can_run(self, entry):
+        return self._running < self._workers
+
+    def _run_on_worker(self, entry):
+        try:
+            self._execute(entry, self.execute)
+        finally:
+            with self._job_avbl:
+                self._running -= 1
+                self._job_avbl.notify()
+
+    def run(self):
+        logging.info(f"Started {self.__class__.__name__} thread")
+        self.on_start()
+        while (entry := self._next_job()) is not None:
+            with self._job_avbl:
+                self._running += 1
+            self._threads.submit(self._run_on_worker, entry)
+        self._threads.shutdown(wait=True, cancel_futures=True)
 
     def process(self):
-        
-        if self.job['cmd'] == 'compute_stars':
-            imageData = self.job['imageData']
-            imageData.computeStars()
-            self.output = imageData
-        elif self.job['cmd'] == 'resize':
-            imageData = self.job['imageData']
-            w, h = self.job['w'], self.job['h']
-            scaledImg = cv2.resize(imageData.rgb24, dsize=(int(w*self.job['imageScale']), int(h*self.job['imageScale'])), interpolation=cv2.INTER_LINEAR)
-            if scaledImg.dtype == np.uint16:
-                scaledImg = (scaledImg / 256).astype(np.uint8)
-
-            img = scaledImg
-            if len(self.job['gamma_table'].shape) == 2:
-                r = cv2.LUT(img[:, :, 0], self.job['gamma_table'][:, 0])
-                g = cv2.LUT(img[:, :, 1], self.job['gamma_table'][:, 1])
-                b = cv2.LUT(img[:, :, 2], self.job['gamma_table'][:, 2])
-                img = np.stack([r, g, b], axis=-1)
-            else:
-                img = cv2.LUT(img, self.job['gamma_table'])
-
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            self.output = (scaledImg, ImageTk.PhotoImage(image=Image.fromarray(img)))
-
-        elif self.job['cmd'] == 'stretch_to_photoimage':
-            img = self.job['image']
-
-            if len(self.job['gamma_table'].shape) == 2:
-                r = cv2.LUT(img[:, :, 0], self.job['gamma_table'][:, 0])
-                g = cv2.LUT(img[:, :, 1], self.job['gamma_table'][:, 1])
-                b = cv2.LUT(img[:, :, 2], self.job['gamma_table'][:, 2])
-                img = np.stack([r, g, b], axis=-1)
-            else:
-                img = cv2.LUT(img, self.job['gamma_table'])
-
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            self.output = ImageTk.PhotoImage(image=Image.fromarray(img))
-        else:
-            raise RuntimeError(f"Unknown command: {self.job['cmd']}")
+        self.output = self.execute(self.job, self.token)
 
-    def computeStars(self, imageData, on_success):
-        return self.start_job({'cmd': 'compute_stars', 'imageData': imageData}, on_success=on_success)
+    @staticmethod
+    def display_lut(gamma_table):
+        """ 256x1x3 cv2.LUT table taking a BGR image to stretched RGB
+        gamma_table is one curve (256,) or one per BGR channel (256, 3); the channel swap is folded in
+        """
+        if len(gamma_table.shape) == 1:
+            gamma_table = np.repeat(gamma_table[:, None], 3, axis=1)
+        return np.ascontiguousarray(gamma_table[:, ::-1], dtype=np.uint8).reshape(256, 1, 3)
 
-    def resize(self, imageData, w, h, imageScale, gamma_table, on_success):
-        return self.start_job({'cmd': 'resize', 'imageData': imageData, 'w': w, 'h': h, 'imageScale': imageScale, 'gamma_table': gamma_table}, on_success=on_success)
+    @staticmethod
+    def _stretch(img, lut, out=None):
+        """ Stretched RGB of a BGR uint8 image in two passes over `out`; out=img stretches in place """
+        out = cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=out)
+        return cv2.LUT(out, lut, dst=out)
+
+    def _tile_buffer(self):
+        """ TILE x TILE BGR buffer of the calling worker, reused for every tile it renders """
+        buffer = getattr(self._buffers, 'tile', None)
+        if buffer is None:
+            buffer = self._buffers.tile = np.empty((TILE, TILE, 3), dtype=np.uint8)
+        return buffer
+
+    def execute(self, job, token):
+        """ Run a job on the calling (worker) thread and return its output """
+        if job['cmd'] == 'render_tiles':
+            buffer = self._tile_buffer()
+            tiles = []
+            for tile in job['tiles']:
+                token.check()
+                img = job['tiledImage'].render_tile(job['scale'], *tile, job['size'], out=buffer)
+                # stretched in place in the buffer; the PIL image keeps its own copy of the pixels
+                tiles.append((tile, Image.fromarray(self._stretch(img, job['lut'], out=img))))
+            return tiles
+
+        else:
+            raise RuntimeError(f"Unknown command: {job['cmd']}")
 
-    def stretch_to_photoimage(self, image, gamma_table, on_success):
-        return self.start_job({'cmd': 'stretch_to_photoimage', 'image': image, 'gamma_table': gamma_table}, on_success=on_success)
+    def render_tiles(self, tiledImage, scale, size, tiles, gamma_table, on_success):
+        """ Render viewport tiles; on_success(job, [((tx, ty), PhotoImage)]) """
+        def to_photoimages(job, output):
+            on_success(job, [(tile, ImageTk.PhotoImage(image=image)) for tile, image in output])
+        # the viewer asks again for whatever is still missing after a pan or zoom
+        return self.start_job({'cmd': 'render_tiles', 'tiledImage': tiledImage, 'scale': scale, 'size': size, 'tiles': tiles, 'lut': self.display_lut(gamma_table)},
+                              on_success=to_photoimages, priority=self.PRIORITY_HIGH, coalesce='tiles')
@@ -9,10 +9,11 @@ from datetime import datetime
 from astropy.io import fits
 from image_data import ImageData
 import threading
+import logging
 import skymap.platesolver as PS
 from skymap.skymap import SkyMap
-import psutil
 from settings import config
+from device_monitor import DeviceMonitor
 from copy import deepcopy
 
 
@@ -24,42 +25,58 @@ class MountService(ServiceBase):
         super().__init__(tk_root)
         self._mount = mount
         self._camera_svc = camera_svc
-        self._tk_root.after(1000, self._poll_mount_position)
 
         self._mtx = threading.Lock()
         self._status = "Unk"
         self._coord = None
         self._coord_txt = ""
+        self._objname = ""
+        self._objname_coord_txt = None
         self._skyMap = None
+        # polled in the background: every second while slewing, every 5 seconds otherwise
+        self._monitor = DeviceMonitor.shared(tk_root)
+        self._monitor.watch('mount', self._read_mount_position, self._on_mount_position_change,
+                            fast=1.0, slow=5.0, busy=lambda state: state['slewing'])
 
     def on_start(self):
         # Load skymap
         try:
-            if "mongod.exe" not in [p.name() for p in psutil.process_iter()]:
-                psutil.Popen([r"mongod.exe", "--dbpath", config['stardb']], shell=True, cwd=config['mongodir'])
             with self._mtx:
                 self._skyMap = SkyMap()
         except Exception as ex:
             print(f"Failed to connect to SkyMap: {ex}")
 
-    def _publish_mount_position(self):
-        if self._mount is not None and self._mount.connected:
-            with self._mtx:
-                if self._mount.tracking:
-                    self._status = "Tracking"
-                elif self._mount.atpark:
-                    self._status = "Parked"
-                elif self._mount.slewing:
-                    self._status = "Slewing"
-
-                self._coord = self._mount.coordinates
-                self._coord_txt = self._coord.to_string("hmsdms")
-                self._objname = self._getObjectName(self._coord)
-            self._tk_root.event_generate(MountService.PositionUpdateEventName, when="tail")
-
-    def _poll_mount_position(self):
-        self._publish_mount_position()
-        self._tk_root.after(5000, self._poll_mount_position)
+    def terminate(self):
+        self._monitor.unwatch('mount')
+        super().terminate()
+
+    def _read_mount_position(self):
+        """ Runs on the monitor thread """
+        if self._mount is None or not self._mount.connected:
+            return {'status': "Disconnected", 'slewing': False, 'coord_txt': ""}
+        status = self._mount.status()
+        coord = status["coordinates"]
+        coord_txt = coord.to_string("hmsdms")
+        # the catalog lookup only when the mount moved (or the sky map just became available)
+        objname = self._getObjectName(coord) if coord_txt != self._objname_coord_txt else None
+        with self._mtx:
+            if status["tracking"]:
+                self._status = "Tracking"
+            elif status["atpark"]:
+                self._status = "Parked"
+            elif status["slewing"]:
+                self._status = "Slewing"
+
+            self._coord = coord
+            self._coord_txt = coord_txt
+            if objname is not None:
+                self._objname = objname
+                if self._skyMap is not None:
+                    self._objname_coord_txt = coord_txt
+            return {'status': self._status, 'slewing': status["slewing"], 'coord_txt': coord_txt}
+
+    def _on_mount_position_change(self, state, changed):
+        self._tk_root.event_generate(MountService.PositionUpdateEventName, when="tail")
 
     def _getObjectName(self, coord):
         try:
@@ -104,12 +121,15 @@ class MountService(ServiceBase):
 
             if self.job['cmd'] == 'goto':
                 self._mount.moveto(self.job['coord'])
+                self._monitor.poke('mount')
 
             elif self.job['cmd'] == 'syncto':
                 self._mount.syncto(self.job['coord'])
+                self._monitor.poke('mount')
 
             elif self.job['cmd'] == 'park':
                 self._mount.park()
+                self._monitor.poke('mount')
 
             elif self.job['cmd'] == 'refine':
                 # Take snapshot
@@ -124,9 +144,13 @@ class MountService(ServiceBase):
                     "output_fname": f"refine_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.fit"
                 })
                 if imageData is None:
-                    raise RuntimeError("Capture failed")
+                    raise RuntimeError(f"Capture failed: {self._camera_svc.error_message}")
                 imageData.computeStars()
                 solver_result = PS.platesolve(imageData, self._mount.coordinates)
+                if not solver_result['solved'] and PS.get_blind_solver() is not None:
+                    # mount is pointing somewhere else than it reports: solve without the hint
+                    logging.info("Plate solving near the mount position failed, trying a blind solve")
+                    solver_result = PS.platesolve(imageData, None)
                 if solver_result is None:
                     raise RuntimeError("Plate solving failed")
                 self.output = solver_result
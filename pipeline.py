@@ -0,0 +1,123 @@
+""" Building blocks for the capture pipeline
+
+A PipelineStage is a worker thread with a bounded input queue. Producers block in put() when the
+stage falls behind (back-pressure), so at most `maxsize` frames wait in memory per stage.
+Every stage keeps StageMetrics: how long items wait in the queue, how long the stage works on
+them and how long producers were held up by a full queue.
+"""
+
+import queue
+import threading
+import logging
+import time
+
+
+class StageMetrics:
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.errors = 0
+            self.busy = 0.0
+            self.last = 0.0
+            self.max = 0.0
+            self.wait = 0.0
+            self.blocked = 0.0
+            self.dropped = 0
+
+    def add(self, busy, wait=0.0, error=False):
+        with self._lock:
+            self.count += 1
+            self.errors += int(error)
+            self.busy += busy
+            self.last = busy
+            self.max = max(self.max, busy)
+            self.wait += wait
+
+    def add_blocked(self, blocked):
+        with self._lock:
+            self.blocked += blocked
+
+    def add_dropped(self, dropped):
+        with self._lock:
+            self.dropped += dropped
+
+    @property
+    def mean(self):
+        return self.busy / self.count if self.count else 0.0
+
+    def as_dict(self):
+        return {'count': self.count, 'errors': self.errors, 'mean': self.mean, 'last': self.last, 'max': self.max,
+                'mean_wait': self.wait / self.count if self.count else 0.0, 'blocked': self.blocked, 'dropped': self.dropped}
+
+    def __str__(self):
+        return (f"{self.name}: {self.count} items, mean {self.mean:.2f}s, max {self.max:.2f}s, "
+                f"queued {self.wait / max(self.count, 1):.2f}s, producer blocked {self.blocked:.2f}s"
+                + (f", dropped {self.dropped}" if self.dropped else ""))
+
+
+class PipelineStage(threading.Thread):
+    """ fn(item) runs on the stage thread; a non-None result is put into the `next` stage
+    """
+
+    def __init__(self, name, fn, maxsize=2, next=None):
+        super().__init__(name=name)
+        self.fn = fn
+        self.next = next
+        self.metrics = StageMetrics(name)
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.daemon = True
+        self.start()
+
+    @property
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def put(self, item):
+        """ Queue an item; blocks while the stage is full """
+        start = time.time()
+        self._queue.put((time.time(), item))
+        self.metrics.add_blocked(time.time() - start)
+
+    def offer(self, item):
+        """ Queue an item unless the stage is full; returns False (and counts a drop) when it is """
+        try:
+            self._queue.put_nowait((time.time(), item))
+            return True
+        except queue.Full:
+            self.metrics.add_dropped(1)
+            return False
+
+    def drain(self):
+        """ Wait until every queued item went through this stage """
+        self._queue.join()
+
+    def terminate(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        logging.info(f"Started pipeline stage {self.name}")
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                self._queue.task_done()
+                return
+            queued, item = entry
+            start = time.time()
+            error = False
+            try:
+                result = self.fn(item)
+                if result is not None and self.next is not None:
+                    self.next.put(result)
+            except Exception as e:
+                error = True
+                logging.error(f"Pipeline stage {self.name} failed: {e}")
+            finally:
+                self.metrics.add(time.time() - start, start - queued, error)
+                self._queue.task_done()
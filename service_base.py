@@ -1,27 +1,88 @@
 import threading
+import heapq
+import itertools
 import tkinter as tk
 import logging
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class CancellationToken:
+    """ Shared flag to cancel queued or running jobs; process() calls check() between steps
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        if self._event.is_set():
+            raise JobCancelled("Job cancelled")
+
+
+class _QueuedJob:
+
+    def __init__(self, job, on_success, on_failure, priority, coalesce, token):
+        self.job = job
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.priority = priority
+        self.coalesce = coalesce
+        self.token = token if token is not None else CancellationToken()
+        self.future = Future()
+        self.output = None
+        self.error_message = None
 
 
 class ServiceBase(threading.Thread):
+    """ Worker thread running jobs from a priority queue
+
+    start_job queues a job and returns a Future for its output; on_success/on_failure are called on
+    the Tk thread. Lower priority numbers run first, jobs of equal priority in order. A job queued
+    with a coalesce key replaces the pending jobs with the same key, so only the latest of a burst
+    of requests (e.g. resizes while dragging) is executed.
+    """
+
+    PRIORITY_HIGH = 0
+    PRIORITY_NORMAL = 10
+    PRIORITY_LOW = 20
 
     def __init__(self, tk_root):
         super().__init__()
         self._tk_root = tk_root
         self.job = None
+        self.token = None
         self.output = None
         self.error_message = None
         self._job_avbl = threading.Condition()
+        self._queue = []
+        self._seq = itertools.count()
+        self._done = deque()
+        self._active = set()
         self._processing = threading.Event()
         self._completion_callbacks = []
         self.daemon = True
         self.DoneEventName = f"<<{self.__class__.__name__}Done>>"
         self._tk_root.bind(self.DoneEventName, self._on_job_done)
         self._tk_root.after_idle(self.start)
-    
+
     def terminate(self):
         with self._job_avbl:
-            self.job = "terminate"
+            for _, _, entry in self._queue:
+                if entry is not None:
+                    entry.token.cancel()
+            # ahead of every job
+            heapq.heappush(self._queue, (float('-inf'), next(self._seq), None))
             self._job_avbl.notify()
         self.join()
 
@@ -39,72 +100,125 @@ class ServiceBase(threading.Thread):
         """
         pass
 
+    @property
+    def pending(self):
+        """ Number of queued jobs that will still run """
+        with self._job_avbl:
+            return sum(1 for _, _, entry in self._queue if entry is not None and not entry.token.cancelled)
+
+    def _can_run(self, entry):
+        """ Whether a queued job may start now; services running several jobs at once limit them here """
+        return True
+
+    def _next_job(self):
+        """ Wait for the highest priority job that can run; None on terminate """
+        with self._job_avbl:
+            while True:
+                for item in sorted(self._queue, key=lambda item: item[:2]):
+                    entry = item[2]
+                    if entry is not None and (entry.token.cancelled or entry.future.cancelled()):
+                        # superseded or cancelled before it started
+                        self._queue.remove(item)
+                        heapq.heapify(self._queue)
+                        entry.future.cancel()
+                        continue
+                    if entry is None or self._can_run(entry):
+                        self._queue.remove(item)
+                        heapq.heapify(self._queue)
+                        if entry is not None and not entry.future.set_running_or_notify_cancel():
+                            break
+                        if entry is not None:
+                            if entry.coalesce is not None:
+                                # with several workers an older job could still be running: its output would be stale
+                                for running in self._active:
+                                    if running.coalesce == entry.coalesce:
+                                        running.token.cancel()
+                            self._active.add(entry)
+                        return entry
+                else:
+                    self._job_avbl.wait()
+
+    def _run_process(self, job, token):
+        self.job = job
+        self.token = token
+        self.output = None
+        self._processing.set()
+        try:
+            self.process()
+            return self.output
+        finally:
+            self._processing.clear()
+
+    def _execute(self, entry, fn):
+        """ Run fn(job, token) -> output for a queued job and deliver the result """
+        try:
+            try:
+                output = fn(entry.job, entry.token)
+            finally:
+                with self._job_avbl:
+                    self._active.discard(entry)
+            entry.token.check()
+            entry.output = output
+            entry.future.set_result(output)
+            self._done.append(entry)
+            self._tk_root.event_generate(self.DoneEventName, when="tail", x=0)
+        except JobCancelled as e:
+            entry.future.set_exception(e)
+        except Exception as e:
+            self.error_message = entry.error_message = f"{self.__class__.__name__}: {e}"
+            logging.error(self.error_message)
+            entry.future.set_exception(e)
+            self._done.append(entry)
+            self._tk_root.event_generate(self.DoneEventName, when="tail", x=-2)
+
     def run(self):
         logging.info(f"Started {self.__class__.__name__} thread")
         self.on_start()
-        while True:
-            with self._job_avbl:
-                self._job_avbl.wait()
-                self._processing.set()
-
-            if self.job == "terminate":
-                self._processing.clear()
-                self.job = None
-                return
+        while (entry := self._next_job()) is not None:
+            self._execute(entry, self._run_process)
+        self.job = None
 
-            try:
-                self.process()
-                self._tk_root.event_generate(self.DoneEventName, when="tail", x=0)
-            except Exception as e:
-                self.error_message = f"{self.__class__.__name__}: {e}"
-                logging.error(self.error_message)
-                self._tk_root.event_generate(self.DoneEventName, when="tail", x=-2)
-
-    def start_job(self, job, on_success=None, on_failure=None):
-        if self._job_avbl.acquire(blocking=False):
-            if self._processing.is_set():
-                self._job_avbl.release()
-                return False
-            self.job = job
-            self._on_success = on_success
-            self._on_failure = on_failure
+    def start_job(self, job, on_success=None, on_failure=None, priority=None, coalesce=None, token=None):
+        """ Queue a job; returns a Future resolved with the output (cancelled when superseded)
+        """
+        entry = _QueuedJob(job, on_success, on_failure, self.PRIORITY_NORMAL if priority is None else priority, coalesce, token)
+        with self._job_avbl:
+            if coalesce is not None:
+                for _, _, queued in self._queue:
+                    if queued is not None and queued.coalesce == coalesce:
+                        queued.token.cancel()
+            heapq.heappush(self._queue, (entry.priority, next(self._seq), entry))
             self._job_avbl.notify()
-            self._job_avbl.release()
-            return True
-        else:
-            return False
-
-    def run_job(self, job):
-        if self._job_avbl.acquire(blocking=False):
-            if self._processing.is_set():
-                self._job_avbl.release()
-                return None
-            try:
-                self.job = job
-                self._on_success = None
-                self._on_failure = None
-                self._processing.set()
-                self.process()
-                for cb in self._completion_callbacks:
-                    cb(self.output)
-                return self.output
-            except Exception as e:
-                self.error_message = f"{self.__class__.__name__}: {e}"
-                return None
-            finally:
-                self._processing.clear()
-                self._job_avbl.release()
+        return entry.future
 
-    def _on_job_done(self, event):
+    def run_job(self, job, priority=None, timeout=None):
+        """ Queue a job and wait for its output; None on failure or after timeout seconds (see error_message)
+        A job that timed out is cancelled. Not for the Tk thread: jobs post their events to it while it would be blocked here
+        """
+        token = CancellationToken()
+        future = self.start_job(job, priority=self.PRIORITY_HIGH if priority is None else priority, token=token)
         try:
-            if event.x == 0:
-                for cb in self._completion_callbacks:
-                    cb(self.output)
-                if self._on_success is not None:
-                    self._on_success(self.job, self.output)
-            else:
-                if self._on_failure is not None:
-                    self._on_failure(self.job, self.error_message)
-        finally:
-            self._processing.clear()
+            return future.result(timeout)
+        except TimeoutError:
+            token.cancel()
+            future.cancel()
+            self.error_message = f"{self.__class__.__name__}: no result after {timeout} s"
+            return None
+        except Exception as e:
+            future.cancel()
+            self.error_message = f"{self.__class__.__name__}: {e}"
+            return None
 
+    def _on_job_done(self, event):
+        while self._done:
+            entry = self._done.popleft()
+            if entry.error_message is None:
+                # jobs that publish their own outputs (capture sequences) leave output empty
+                if entry.output is not None:
+                    for cb in self._completion_callbacks:
+                        cb(entry.output)
+                if entry.on_success is not None:
+                    entry.on_success(entry.job, entry.output)
+            else:
+                if entry.on_failure is not None:
+                    entry.on_failure(entry.job, entry.error_message)
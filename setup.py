@@ -3,8 +3,8 @@ from Cython.Build import cythonize
 
 setup(
     name='Astrocam',
-    ext_modules=cythonize(["astrocam.py", "image_data.py", "snap_process.py", "settings.py", "ui/*.py", 
+    ext_modules=cythonize(["astrocam.py", "image_data.py", "snap_process.py", "settings.py", "fits_mmap.py", "storage_service.py", "pipeline.py", "histogram.py", "device_monitor.py", "ui/*.py", 
                            "Alpaca/*.py", "asi_native/asinative_camera.py", "simulated_devices/*.py",
-                           "fwhm/*.py", "skymap/skymap.py", "skymap/platesolver.py", "skymap/stardb/render_view.py",
+                           "fwhm/*.py", "skymap/skymap.py", "skymap/star_catalog.py", "skymap/platesolver.py", "skymap/triangle_catalog.py", "skymap/blind_solver.py", "skymap/projection.py", "skymap/wcs_fit.py", "skymap/stardb/render_view.py",
                            "xisf/*.py", "debayer/*.py"]),
 )
\ No newline at end of file
@@ -2,7 +2,7 @@
 from pathlib import Path
 import time
 from enum import IntEnum
-from astropy.io import fits
+from fits_mmap import FitsImage, read_fits
 import numpy as np
 
 
@@ -21,6 +21,7 @@ class SimulatedCamera():
         self._temperature = 22
         self._exp_start_time = None
         self._idx = 0
+        self._subframe = 1.0
         self.files = list(self.dir.glob("*.fit"))
 
     def close(self):
@@ -63,6 +64,27 @@ class SimulatedCamera():
     def binning(self, value: int):
         return
 
+    def set_transfer(self, binning: int = 1, subframe: float = 1.0):
+        """ Subframes are cropped from the stored images; binning is ignored
+        Returns the crop origin in the image downloadimage delivers next
+        """
+        self._subframe = subframe
+        if subframe >= 1.0:
+            return 0, 0
+        # only the header is read for the size
+        with FitsImage(self._next_file()) as f:
+            y, x, _, _ = self._crop(f.shape)
+        return x, y
+
+    def _next_file(self):
+        return self.files[self._idx % len(self.files)]
+
+    def _crop(self, shape):
+        """ Centered subframe (y, x, height, width) of an image of `shape` """
+        h, w = shape[:2]
+        nh, nw = int(h * self._subframe) & ~1, int(w * self._subframe) & ~1
+        return ((h - nh) // 2) & ~1, ((w - nw) // 2) & ~1, nh, nw
+
     """ Gain """
     @property
     def gain(self):
@@ -153,11 +175,12 @@ class SimulatedCamera():
         return False
 
     def downloadimage(self):
-        fname = self.files[self._idx % len(self.files)]
+        fname = self._next_file()
         print(fname)
         self._idx += 1
-        with fits.open(fname) as f:
-            ph = f[0]
-            img = ph.data
-            print("Image delivered")
-            return np.expand_dims(img, axis=2)
+        img, _ = read_fits(fname)
+        if self._subframe < 1.0:
+            y, x, nh, nw = self._crop(img.shape)
+            img = img[y:y+nh, x:x+nw]
+        print("Image delivered")
+        return np.expand_dims(img, axis=2)
@@ -43,6 +43,9 @@ class SimulatedMount():
     def atpark(self):
         return False
 
+    def status(self) -> dict:
+        return {"tracking": self.tracking, "atpark": self.atpark, "slewing": self.slewing, "coordinates": self.coordinates}
+
     def moveto(self, coord: SkyCoord):
         self._coordinates = coord
 
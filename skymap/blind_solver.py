@@ -0,0 +1,287 @@
+""" Blind plate solving with a 4-star geometric hash (quad) index
+
+Quads are formed by a pair of stars A, B (the diameter) and two stars C, D inside the circle
+on AB. In the frame where A = (0, 0) and B = (1, 1) the positions of C and D give a 4-d code
+that is invariant to translation, rotation and scale. Catalog quads are precomputed per sky
+tile in several bands of AB size, so no position hint is needed to find candidate matches;
+each candidate is verified by projecting the catalog stars around the implied image center.
+
+The index is stored next to the triangle catalog (skymap/triangle_catalog.py), whose
+memory-mapped star table it references:
+
+  quads.npy       a, b, c, d (global star index), code[4], band
+  quads.json      scale bands and build parameters
+"""
+
+import os
+import json
+import math
+import logging
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from astropy.coordinates import SkyCoord, ICRS
+from astropy import units as u
+from skymap.triangle_catalog import TriangleCatalog, _separation_deg
+from skymap.projection import gnomonic, inverse_gnomonic
+
+# AB diameter in degrees
+SCALE_BANDS = [(0.125, 0.25), (0.25, 0.5), (0.5, 1.0), (1.0, 2.0)]
+
+QUAD_DTYPE = np.dtype([('a', '<i4'), ('b', '<i4'), ('c', '<i4'), ('d', '<i4'), ('code', '<f4', (4,)), ('band', 'u1')])
+
+
+def quad_codes(xy: np.ndarray):
+  """ Canonical codes for quads given as (N, 4, 2) star positions in A, B, C, D order
+  Returns (codes (N, 4), order (N, 4)) where order permutes the input stars into canonical A, B, C, D:
+  C and D are expressed in the frame A=(0,0), B=(1,1); A/B are swapped so that xc + xd <= 1 and
+  C/D so that xc <= xd.
+  """
+  z = xy[..., 0] + 1j * xy[..., 1]
+  w = (z[:, 2:] - z[:, :1]) / (z[:, 1:2] - z[:, :1]) * (1 + 1j)
+  order = np.tile(np.arange(4), (len(xy), 1))
+
+  swap_ab = w.real.sum(axis=1) > 1
+  w[swap_ab] = (1 + 1j) - w[swap_ab]
+  order[swap_ab, :2] = order[swap_ab, 1::-1]
+
+  swap_cd = w[:, 0].real > w[:, 1].real
+  w[swap_cd] = w[swap_cd, ::-1]
+  order[swap_cd, 2:] = order[swap_cd, :1:-1]
+
+  codes = np.column_stack([w[:, 0].real, w[:, 0].imag, w[:, 1].real, w[:, 1].imag])
+  return codes, order
+
+
+def _quads(xy: np.ndarray, pairs: np.ndarray, inner_per_pair: int):
+  """ Quads (N, 4) of star indices for the given AB pairs; xy is sorted brightest first
+  C, D are taken from the brightest `inner_per_pair` stars inside the circle on AB
+  """
+  if len(pairs) == 0:
+    return np.zeros((0, 4), dtype=np.int64)
+  tree = cKDTree(xy)
+  mid = (xy[pairs[:, 0]] + xy[pairs[:, 1]]) / 2
+  radius = np.linalg.norm(xy[pairs[:, 0]] - xy[pairs[:, 1]], axis=1) / 2
+  quads = []
+  for (a, b), inner in zip(pairs, tree.query_ball_point(mid, radius * 0.999)):
+    inner = sorted(i for i in inner if i != a and i != b)[:inner_per_pair]
+    for c, d in itertools.combinations(inner, 2):
+      quads.append((a, b, c, d))
+  return np.array(quads, dtype=np.int64).reshape(-1, 4)
+
+
+def build_quad_index(path: str, scale_bands=SCALE_BANDS, stars_per_cell: int=8, min_stars: int=20, inner_per_pair: int=3):
+  """ Offline indexer: precompute quads for every tile of the triangle catalog at path
+  For a band with AB up to `hi` degrees, about stars_per_cell stars per hi x hi cell of the tile are used.
+  """
+  cat = TriangleCatalog(path)
+  tiling, tiles, stars = cat.tiling, cat.tiles, cat.stars
+  tile_deg = tiling.tile_deg
+
+  out = []
+  for t in range(tiling.num_tiles):
+    s0, s1 = int(tiles[t]['star_start']), int(tiles[t]['star_end'])
+    if s1 - s0 < 2:
+      continue
+    ra0, dec0 = float(stars['ra'][s0:s1].mean()), float(stars['dec'][s0:s1].mean())
+    tile_radius = _separation_deg(stars['ra'][s0:s1], stars['dec'][s0:s1], ra0, dec0).max()
+
+    for band, (lo, hi) in enumerate(scale_bands):
+      # stars within each tile are sorted by magnitude: take the brightest of every tile in reach
+      n = max(min_stars, int(math.ceil(stars_per_cell * (tile_deg / hi)**2)))
+      near = np.concatenate([np.arange(tiles[k]['star_start'], min(tiles[k]['star_end'], tiles[k]['star_start'] + n))
+                             for k in tiling.tiles_in_cone(ra0, dec0, tile_radius + hi)])
+      near = near[_separation_deg(stars['ra'][near], stars['dec'][near], ra0, dec0) <= tile_radius + hi]
+      near = near[np.argsort(stars['mag'][near], kind='stable')]
+      if len(near) < 4:
+        continue
+
+      x, y = gnomonic(stars['ra'][near], stars['dec'][near], ra0, dec0)
+      xy = np.degrees(np.column_stack([x, y]))
+      owned = (near >= s0) & (near < s1) & (np.arange(len(near)) < n)
+
+      pairs = np.array(sorted(cKDTree(xy).query_pairs(r=hi)), dtype=np.int64).reshape(-1, 2)
+      if len(pairs) == 0:
+        continue
+      d = np.linalg.norm(xy[pairs[:, 0]] - xy[pairs[:, 1]], axis=1)
+      # the tile owning the brighter star of AB keeps the quad
+      pairs = pairs[(d >= lo) & owned[pairs.min(axis=1)]]
+
+      quads = _quads(xy, pairs, inner_per_pair)
+      if len(quads) == 0:
+        continue
+      codes, order = quad_codes(xy[quads])
+      quads = np.take_along_axis(quads, order, axis=1)
+
+      rec = np.zeros(len(quads), dtype=QUAD_DTYPE)
+      for i, v in enumerate('abcd'):
+        rec[v] = near[quads[:, i]]
+      rec['code'] = codes
+      rec['band'] = band
+      out.append(rec)
+
+  quads = np.concatenate(out) if out else np.zeros(0, dtype=QUAD_DTYPE)
+  np.save(os.path.join(path, 'quads.npy'), quads)
+  with open(os.path.join(path, 'quads.json'), 'w') as f:
+    json.dump({
+      'scale_bands': [list(b) for b in scale_bands],
+      'stars_per_cell': stars_per_cell,
+      'inner_per_pair': inner_per_pair,
+      'num_quads': len(quads),
+    }, f, indent=2)
+  logging.info(f"Quad index: {len(quads)} quads in {len(scale_bands)} scale bands -> {path}")
+
+
+class BlindSolver:
+  """ Solves an image star list without a position hint using the quad index at path """
+
+  def __init__(self, path: str, catalog: TriangleCatalog=None):
+    self.catalog = catalog or TriangleCatalog(path)
+    with open(os.path.join(path, 'quads.json'), 'r') as f:
+      self.meta = json.load(f)
+    self.scale_bands = [tuple(b) for b in self.meta['scale_bands']]
+    self.quads = np.load(os.path.join(path, 'quads.npy'), mmap_mode='r')
+    self._trees = {}
+
+  def _band(self, band: int):
+    """ KD-tree over the codes of one scale band, built on first use """
+    if band not in self._trees:
+      idx = np.flatnonzero(self.quads['band'] == band)
+      self._trees[band] = (idx, cKDTree(self.quads['code'][idx]) if len(idx) else None)
+    return self._trees[band]
+
+  def _bands_for(self, fov_deg):
+    """ Bands worth searching for an image of roughly fov_deg width (all bands when unknown) """
+    if fov_deg is None:
+      return list(range(len(self.scale_bands)))
+    bands = [i for i, (lo, hi) in enumerate(self.scale_bands) if lo <= fov_deg and hi >= fov_deg / 8]
+    return bands or list(range(len(self.scale_bands)))
+
+  def solve(self, df_tgt: pd.DataFrame, image_shape, fov_deg: float=None, max_stars: int=20,
+            code_tolerance: float=0.01, match_px: float=5.0, min_matches: int=8, max_verify: int=500):
+    """ Blind solve image stars (cluster_cx, cluster_cy in pixels, brightest first)
+    fov_deg: optional rough image width, used only to narrow down the scale bands
+    Returns dict with solved, center (SkyCoord), scale_arcsec, rotation_deg, parity, matches and
+    tx (2x3 affine from the tangent plane around `tangent`, in skymap.projection.gnomonic units, to image pixels)
+    """
+    result = {'solved': False}
+    img_xy = df_tgt[['cluster_cx', 'cluster_cy']].to_numpy(dtype=np.float64)[:max_stars]
+    if len(img_xy) < 4:
+      return result
+    height, width = image_shape[:2]
+
+    pairs = np.array(list(itertools.combinations(range(len(img_xy)), 2)), dtype=np.int64)
+    img_quads = _quads(img_xy, pairs, self.meta.get('inner_per_pair', 3))
+    if len(img_quads) == 0:
+      return result
+    codes, order = quad_codes(img_xy[img_quads])
+    img_quads = np.take_along_axis(img_quads, order, axis=1)
+    # mirrored images: reflecting about AB swaps x and y of C and D
+    m_codes, m_order = quad_codes(img_xy[img_quads][..., ::-1])
+    m_quads = np.take_along_axis(img_quads, m_order, axis=1)
+
+    hits = []
+    for band in self._bands_for(fov_deg):
+      idx, tree = self._band(band)
+      if tree is None:
+        continue
+      for q, c in ((img_quads, codes), (m_quads, m_codes)):
+        dist, ref = tree.query(c, k=4, distance_upper_bound=code_tolerance)
+        for i, j in zip(*np.nonzero(np.isfinite(dist))):
+          hits.append((dist[i, j], q[i], idx[ref[i, j]]))
+    hits.sort(key=lambda h: h[0])
+    logging.info(f"Blind solve: {len(img_quads)} image quads, {len(hits)} code hits")
+    result['quad_hits'] = len(hits)
+
+    stars = self.catalog.stars
+    tried = set()
+    for _, img_q, cat_q in hits[:max_verify]:
+      if cat_q in tried:
+        continue
+      tried.add(cat_q)
+      quad = self.quads[cat_q]
+      star_ids = [quad[v] for v in 'abcd']
+      cat_ra, cat_dec = stars['ra'][star_ids], stars['dec'][star_ids]
+
+      # image -> tangent plane around the quad
+      ra0, dec0 = float(cat_ra.mean()), float(cat_dec.mean())
+      A = _fit_affine(img_xy[img_q], np.column_stack(gnomonic(cat_ra, cat_dec, ra0, dec0)))
+      if A is None:
+        continue
+      center_ra, center_dec = inverse_gnomonic(*(A @ [width / 2, height / 2, 1]), ra0, dec0)
+      scale = math.sqrt(abs(np.linalg.det(A[:, :2])))
+      radius_deg = math.degrees(scale * math.hypot(width, height) / 2)
+
+      verified_at = (float(center_ra), float(center_dec))
+      verified = self._verify(img_xy, img_q, star_ids, float(center_ra), float(center_dec), radius_deg, match_px, min_matches)
+      if verified is None:
+        continue
+      A, matches = verified
+      center_ra, center_dec = inverse_gnomonic(*(A @ [width / 2, height / 2, 1]), float(center_ra), float(center_dec))
+      scale = math.sqrt(abs(np.linalg.det(A[:, :2])))
+      result.update({
+        'solved': True,
+        'center': SkyCoord(float(center_ra) * u.degree, float(center_dec) * u.degree, frame=ICRS),
+        'tangent': SkyCoord(float(verified_at[0]) * u.degree, float(verified_at[1]) * u.degree, frame=ICRS),
+        # tangent plane -> image, same direction as StarMatcher transforms
+        'tx': np.linalg.inv(np.vstack([A, [0, 0, 1]]))[:2],
+        'matches': matches,
+        'scale_arcsec': math.degrees(scale) * 3600,
+        'rotation_deg': math.degrees(math.atan2(A[1, 0], A[0, 0])),
+        'parity': int(np.sign(np.linalg.det(A[:, :2]))),
+        # image width, like the fov_deg hint solve() takes
+        'fov_deg': math.degrees(scale * width),
+      })
+      logging.info(f"Blind solve: center {result['center']}, scale {result['scale_arcsec']:.2f}\"/px, {matches} matches")
+      return result
+    return result
+
+  def _verify(self, img_xy, img_quad, quad_stars, ra0, dec0, radius_deg, match_px, min_matches):
+    """ Count image stars landing on catalog stars around (ra0, dec0)
+    Returns (image -> tangent plane affine around (ra0, dec0), matches) or None
+    """
+    # positions only: ids and triangles are looked up by platesolve for the accepted solution
+    _, ref_xy = self.catalog.cone_xy(ra0, dec0, radius_deg)
+    if len(ref_xy) < min_matches:
+      return None
+    stars = self.catalog.stars
+    quad_xy = np.column_stack(gnomonic(stars['ra'][quad_stars], stars['dec'][quad_stars], ra0, dec0))
+    A = _fit_affine(img_xy[img_quad], quad_xy)
+    if A is None:
+      return None
+
+    tree = cKDTree(ref_xy)
+    matches = 0
+    for _ in range(3):
+      tol = match_px * math.sqrt(abs(np.linalg.det(A[:, :2])))
+      dist, ref = tree.query(img_xy @ A[:, :2].T + A[:, 2])
+      matched = np.flatnonzero(dist < tol)
+      if len(matched) < 3:
+        return None
+      matches = len(matched)
+      X = np.column_stack([img_xy[matched], np.ones(len(matched))])
+      A = np.linalg.lstsq(X, ref_xy[ref[matched]], rcond=None)[0].T
+    if matches < min_matches:
+      return None
+    return A, matches
+
+
+def _fit_affine(src, dst):
+  """ Least squares 2x3 affine src -> dst; None when the quad stars do not agree on a similarity """
+  X = np.column_stack([src, np.ones(len(src))])
+  A = np.linalg.lstsq(X, dst, rcond=None)[0].T
+  residual = np.linalg.norm(X @ A.T - dst, axis=1).max()
+  size = np.linalg.norm(dst[0] - dst[1])
+  if size == 0 or residual > 0.02 * size:
+    return None
+  return A
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(description="Build the blind solving quad index next to an existing triangle catalog")
+  parser.add_argument("path", help="triangle catalog directory")
+  args = parser.parse_args()
+  build_quad_index(args.path)
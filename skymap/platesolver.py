@@ -8,43 +8,88 @@ from astropy.coordinates import SkyCoord
 from astropy import units as u
 from astropy.coordinates import ICRS
 from skymap.skymap import SkyMap
-from skymap.stardb.render_view import project
+from skymap.triangle_catalog import TriangleCatalog
+from skymap.blind_solver import BlindSolver
+from skymap.projection import gnomonic
+from skymap.wcs_fit import fit_tan_wcs, wcs_residuals_arcsec
 from image_data import ImageData
 import itertools
-from sklearn.linear_model import LinearRegression
+from scipy.spatial import cKDTree
 import logging
+import os
+from settings import config
 
 
 def cone_search_stardata(skymap: SkyMap, center: SkyCoord, fov_deg: float, mag_limit: float):
-  stars = []
-  for star in skymap.coneSearch(center, fov_deg):
-    if 'mag' in star and star['mag'] < 11:
-      s_coord = SkyCoord(star['ra'] * u.degree, star['dec'] * u.degree, frame=ICRS)
-      x, y = project(s_coord.ra.degree, s_coord.dec.degree, center.ra.degree, center.dec.degree, 0)
-      stars.append({
-        "id": star["_id"], 
-        "cluster_cx": x, "cluster_cy": y, 
-        "ra": s_coord.ra.degree, "dec": s_coord.dec.degree,
-        "mag": star["mag"]
-      })
-  df_ref = pd.DataFrame(stars)
+  stars = skymap.coneSearchTable(center, fov_deg, mag_limit=mag_limit)
+  x, y = gnomonic(stars.ra.to_numpy(), stars.dec.to_numpy(), center.ra.degree, center.dec.degree)
+  df_ref = pd.DataFrame({
+    "_id": stars["_id"].to_numpy(),
+    "id": stars["id"].to_numpy(),
+    "cluster_cx": x, "cluster_cy": y,
+    "ra": stars.ra.to_numpy(), "dec": stars.dec.to_numpy(),
+    "mag": stars.mag.to_numpy()
+  })
   return df_ref
 
 
-def platesolve(imageData: ImageData, center: SkyCoord, fov_deg: float=5.0, mag_limit: float=11.0):
+_triangle_catalog = None
+
+def get_triangle_catalog():
+  """ Precomputed triangle catalog from config (triangle_catalog: <dir>), None if not built """
+  global _triangle_catalog
+  path = config.get('triangle_catalog')
+  if _triangle_catalog is None and path and os.path.exists(os.path.join(path, 'meta.json')):
+    _triangle_catalog = TriangleCatalog(path)
+  return _triangle_catalog
+
+
+_blind_solver = None
+
+def get_blind_solver():
+  """ Quad index built next to the triangle catalog (blind_solver.py), None if not built """
+  global _blind_solver
+  catalog = get_triangle_catalog()
+  if _blind_solver is None and catalog is not None and os.path.exists(os.path.join(config['triangle_catalog'], 'quads.npy')):
+    _blind_solver = BlindSolver(config['triangle_catalog'], catalog=catalog)
+  return _blind_solver
+
+
+def blind_platesolve(imageData: ImageData, fov_deg: float=None):
+  """ Solve without a position hint; returns BlindSolver result (center, scale_arcsec, rotation_deg, ...) """
+  solver = get_blind_solver()
+  if solver is None:
+    raise RuntimeError("Blind solving needs the quad index: python -m skymap.blind_solver <triangle_catalog dir>")
+  return solver.solve(imageData.stars, imageData.shape, fov_deg=fov_deg)
+
+
+def platesolve(imageData: ImageData, center: SkyCoord=None, fov_deg: float=5.0, mag_limit: float=11.0, sip_order: int=2):
   result = {
     'solved': False
   }
 
-  with SkyMap() as sm:
-    df_ref = cone_search_stardata(sm, center, fov_deg=fov_deg, mag_limit=mag_limit)
+  if center is None:
+    # no hint: find the field with the quad index, then refine as usual
+    blind_result = blind_platesolve(imageData)
+    result['blind'] = blind_result
+    if not blind_result['solved']:
+      return result
+    center = blind_result['center']
+
+  catalog = get_triangle_catalog()
+  if catalog is not None:
+    df_ref, ref_index = catalog.cone(center, fov_deg=fov_deg, mag_limit=mag_limit)
+  else:
+    with SkyMap() as sm:
+      df_ref = cone_search_stardata(sm, center, fov_deg=fov_deg, mag_limit=mag_limit)
+    ref_index = None
 
   df_tgt = imageData.stars
   logging.info(f"Num ref stars: {len(df_ref)}, Num tgt stars: {len(df_tgt)}")
   result['num_ref'] = len(df_ref)
   result['num_tgt'] = len(df_tgt)
   matcher = StarMatcher()
-  tx, matcher_result = matcher.matchStarsToTx(df_ref, df_tgt, limit_ref_triangle_fov=1.0)
+  tx, matcher_result = matcher.matchStarsToTx(df_ref, df_tgt, limit_ref_triangle_fov=1.0, ref_index=ref_index)
 
   # matcher_result = matcher.matchStars(df_ref, df_tgt, limit_ref_triangle_fov=1.0)
   result.update(matcher_result)
@@ -67,34 +112,38 @@ def platesolve(imageData: ImageData, center: SkyCoord, fov_deg: float=5.0, mag_l
 
 
   result['tx'] = tx
-  df_ref[['img_cx', 'img_cy']] = df_ref.apply(lambda r: pd.Series(np.dot(tx, [r.cluster_cx, r.cluster_cy, 1])).astype(np.int32), axis=1)
-
-  # Reassign stars
-  def dist(x1,y1, x2,y2):
-    return np.sqrt((y2-y1)**2+(x2-x1)**2)
-  def reassign(t):
-    x = df_ref.apply(lambda r: pd.Series([dist(t.cluster_cx, t.cluster_cy, r.img_cx, r.img_cy)]), axis=1)[0]
-    m = x.min()
-    if m < 25:
-      idx = x.argmin()
-      return pd.Series([idx, df_ref.iloc[idx].ra, df_ref.iloc[idx].dec])
-    else:
-      return pd.Series([None, None, None])
-  df_tgt[['starno', 'ra', 'dec']] = df_tgt.apply(reassign, axis=1)
-
-  nonantgt = df_tgt[ (~df_tgt.ra.isna()) & (~df_tgt.dec.isna())]
-  X = nonantgt[['cluster_cx', 'cluster_cy']]
-  y = nonantgt[['ra', 'dec']]
-  reg = LinearRegression().fit(X, y)
-  pred_center = reg.predict(pd.DataFrame([{"cluster_cx": imageData.rgb24.shape[1]//2, "cluster_cy": imageData.rgb24.shape[0]//2}]))[0]
-  pred_center = SkyCoord(pred_center[0] * u.degree, pred_center[1] * u.degree, frame=ICRS)
+  ref_img = df_ref[['cluster_cx', 'cluster_cy']].to_numpy(dtype=np.float64) @ tx[:, :2].T + tx[:, 2]
+  df_ref[['img_cx', 'img_cy']] = ref_img.astype(np.int32)
+
+  # Reassign stars: nearest reference star (in image coordinates) within 25 pixels
+  tgt_img = df_tgt[['cluster_cx', 'cluster_cy']].to_numpy(dtype=np.float64)
+  dist, idx = cKDTree(ref_img).query(tgt_img, distance_upper_bound=25)
+  found = np.isfinite(dist)
+  df_tgt['starno'] = pd.Series(np.where(found, idx, -1), index=df_tgt.index).where(found, None)
+  df_tgt['ra'] = pd.Series(df_ref.ra.to_numpy()[np.where(found, idx, 0)], index=df_tgt.index).where(found)
+  df_tgt['dec'] = pd.Series(df_ref.dec.to_numpy()[np.where(found, idx, 0)], index=df_tgt.index).where(found)
+  result['matched_stars'] = int(found.sum())
+  if found.sum() < 3:
+    return result
+
+  # TAN WCS (with SIP distortion when there are enough stars) around the image center
+  height, width = imageData.shape
+  crpix = (width // 2, height // 2)
+  wcs = fit_tan_wcs(tgt_img[found], df_tgt.ra.to_numpy()[found], df_tgt.dec.to_numpy()[found], crpix=crpix, sip_order=sip_order)
+  residuals = wcs_residuals_arcsec(wcs, tgt_img[found], df_tgt.ra.to_numpy()[found], df_tgt.dec.to_numpy()[found])
+  result['wcs'] = wcs
+  result['wcs_header'] = wcs.to_header(relax=True)
+  result['rms_arcsec'] = float(np.sqrt(np.mean(residuals**2)))
+
+  pred_center = wcs.pixel_to_world(*crpix)
+  pred_center = SkyCoord(pred_center.ra.degree * u.degree, pred_center.dec.degree * u.degree, frame=ICRS)
   separation_arcmin = center.separation(pred_center).arcminute
   result['center'] = pred_center
   result['separation_arcmin'] = separation_arcmin
   logging.info(f"Image Center RA,DEC: {pred_center}")
-  logging.info(f"Separation from target: {center.separation(pred_center).arcminute}")
+  logging.info(f"Separation from target: {separation_arcmin}; WCS rms: {result['rms_arcsec']:.2f} arcsec")
 
-  if center.separation(pred_center).arcminute > 20:
+  if separation_arcmin > 20:
     return result
   
   result['solved'] = True
@@ -103,4 +152,4 @@ def platesolve(imageData: ImageData, center: SkyCoord, fov_deg: float=5.0, mag_l
   for idx, star in df_tgt[~df_tgt.starno.isnull()].iterrows():
     df_tgt.loc[idx, 'name'] = df_ref.loc[star.starno].id
 
-  return result
\ No newline at end of file
+  return result
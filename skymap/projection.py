@@ -0,0 +1,39 @@
+""" Array based gnomonic (TAN) projection
+
+Tangent plane coordinates are in radians: x grows towards increasing RA, y towards increasing Dec.
+Scalars work too, results are then 0-d arrays.
+"""
+
+import numpy as np
+
+
+def gnomonic(ra_deg, dec_deg, ra_center_deg: float, dec_center_deg: float):
+  """ RA/Dec arrays (degrees) -> tangent plane x, y arrays around the center
+  Points more than 90 degrees from the center have no projection and come back as NaN
+  """
+  ra = np.radians(np.asarray(ra_deg, dtype=np.float64))
+  dec = np.radians(np.asarray(dec_deg, dtype=np.float64))
+  ra0, dec0 = np.radians(ra_center_deg), np.radians(dec_center_deg)
+
+  sin_dec, cos_dec = np.sin(dec), np.cos(dec)
+  sin_dec0, cos_dec0 = np.sin(dec0), np.cos(dec0)
+  cos_dra = np.cos(ra - ra0)
+  cos_c = sin_dec0 * sin_dec + cos_dec0 * cos_dec * cos_dra
+  with np.errstate(divide='ignore', invalid='ignore'):
+    inv = np.where(cos_c > 0, 1.0 / cos_c, np.nan)
+  x = cos_dec * np.sin(ra - ra0) * inv
+  y = (cos_dec0 * sin_dec - sin_dec0 * cos_dec * cos_dra) * inv
+  return x, y
+
+
+def inverse_gnomonic(x, y, ra_center_deg: float, dec_center_deg: float):
+  """ Tangent plane x, y arrays (radians) around the center -> RA (0..360), Dec arrays in degrees """
+  x = np.asarray(x, dtype=np.float64)
+  y = np.asarray(y, dtype=np.float64)
+  ra0, dec0 = np.radians(ra_center_deg), np.radians(dec_center_deg)
+
+  sin_dec0, cos_dec0 = np.sin(dec0), np.cos(dec0)
+  # with D = 1 / sqrt(1 + x^2 + y^2): sin(dec) = (sin_dec0 + y cos_dec0) D
+  dec = np.arctan2(sin_dec0 + y * cos_dec0, np.hypot(x, cos_dec0 - y * sin_dec0))
+  ra = ra0 + np.arctan2(x, cos_dec0 - y * sin_dec0)
+  return np.mod(np.degrees(ra), 360.0), np.degrees(dec)
@@ -1,16 +1,26 @@
-import math
 import re
+import numpy as np
 import pandas as pd
-from pymongo import MongoClient
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 from astropy.coordinates import ICRS
+from skymap.star_catalog import StarCatalog, FLAG_STAR, FLAG_NAMED
+from settings import config
+
+
+_catalog = None
+
+def get_star_catalog():
+  """ Star catalog shared by all SkyMap instances, memory-mapped on first use """
+  global _catalog
+  if _catalog is None:
+    _catalog = StarCatalog(config['star_catalog'])
+  return _catalog
 
 
 class SkyMap:
   def __init__(self) -> None:
-    self.client = MongoClient("localhost")
-    self.db = self.client.stars
+    self.catalog = get_star_catalog()
     self.cache = {}
 
   def __enter__(self):
@@ -18,46 +28,22 @@ class SkyMap:
   
   def __exit__(self, exc_type, exc_value, traceback):
     self.cache = None
-    self.client.close()
 
   def findObjects(self, coord: SkyCoord, fov_deg:float=0.5, limit:int=None):
 
-    # Conver fov to meters for mongo query
-    fov_rad = math.radians(fov_deg)
-    fov_meters = 6378.1 * 1000 * fov_rad
-
     ra, dec = coord.ra.degree-180, coord.dec.degree
     cache_key = (int(ra*100), int(dec*100))
     if cache_key in self.cache:
       return self.cache[cache_key]
 
-    pipeline = [
-      { '$geoNear': {
-          'near': {
-            'type': 'Point', 
-            'coordinates': [ra, dec]
-          }, 
-          'maxDistance': fov_meters, 
-          'key': 'icrs.location', 
-          'spherical': True, 
-          'distanceField': 'distance'
-      }},
-      { '$match': {
-          '$or': [
-            {'M': {'$exists': True}},
-            {'NGC': {'$exists': True}},
-            {'NAME': {'$exists': True}},
-          ]
-      }}
-    ]
-
-    if limit is not None:
-      pipeline.append({'$limit': limit})
-
-    cursor = self.db.stars.aggregate(pipeline)
+    # Named objects (M, NGC, NAME) nearest first
+    rows, sep = self.catalog.rows_in_cone(coord.ra.degree, coord.dec.degree, fov_deg)
+    named = (self.catalog.flags[rows] & FLAG_NAMED) != 0
+    rows = rows[named][np.argsort(sep[named], kind='stable')][:limit]
 
     objects = []
-    for star in cursor:
+    for row in rows:
+      star = self.catalog.designations_of(row)
       if 'NAME' in star:
         objects.append(star['NAME'])
       if 'M' in star:
@@ -69,100 +55,59 @@ class SkyMap:
     return searchresult
   
   def searchTextName(self, term):
-    cursor = self.db.stars.find(
-      filter={
-        '$text': {
-            '$search': term, 
-            '$caseSensitive': False
-        }
-      },
-      sort=list({
-          'mag': 1
-      }.items()),
-      limit=10)
-    return [star for star in cursor]
+    return self.searchText(term)
   
 
   def searchText(self, term):
-    cursor = self.db.stars.find(
-      filter={
-        '$text': {
-            '$search': term, 
-            '$caseSensitive': False
-        }
-      },
-      sort=list({
-          'mag': 1
-      }.items()),
-      limit=10)
-    return [star for star in cursor]
+    """ Objects matching any word of term in their id, best matching and brightest first """
+    words = [w.lower().encode() for w in re.split(r"\s+", term.strip()) if w]
+    if not words:
+      return []
+    score = np.zeros(len(self.catalog), dtype=np.int32)
+    # whole word match, ids are single space separated
+    padded = np.char.add(np.char.add(b' ', self.catalog.id_lower), b' ')
+    for w in words:
+      score += np.char.find(padded, b' ' + w + b' ') >= 0
+    rows = np.flatnonzero(score)
+    mag = np.nan_to_num(self.catalog.mag[rows], nan=np.inf)
+    rows = rows[np.lexsort((mag, -score[rows]))][:10]
+    return [self.catalog.document(row) for row in rows]
 
   def searchName(self, term):
-    cursor = self.db.stars.find(
-      filter={
-        'id': {'$regex': term, '$options': 'i'}
-      },
-      sort=list({
-        'mag': 1
-      }.items()),
-      limit=10)
-    return [star for star in cursor]
+    rows = self.catalog.by_magnitude(self.catalog.search_id(term), limit=10)
+    return [self.catalog.document(row) for row in rows]
   
 
   def search_catalog(self, cat_name, val):
-    cursor = self.db.stars.find(
-      filter={
-        cat_name: { '$regex': f"^{val}(?:,|$)" }
-      },
-      sort=list({
-        'mag': 1
-      }.items()),
-      limit=10)
-    return [star for star in cursor]
+    rows = self.catalog.by_magnitude(self.catalog.find_designation(f"{cat_name} {val}"), limit=10)
+    return [self.catalog.document(row) for row in rows]
   
-  def coneSearch(self, coord: SkyCoord, fov_deg: float, limit:int=None):
-    # Conver fov to meters for mongo query
-    fov_rad = math.radians(fov_deg / 2.0) # radius from fov_deg which is diameter
-    fov_meters = 6378.1 * 1000 * fov_rad
+  def coneSearchTable(self, coord: SkyCoord, fov_deg: float, mag_limit: float=None, limit:int=None):
+    """ coneSearch as a DataFrame (_id, id, mag, typ, ra, dec) built straight from the catalog columns """
+    rows = self.catalog.cone(coord, fov_deg / 2.0, mag_limit=mag_limit, flags=FLAG_STAR)[:limit]
+    return pd.DataFrame({
+      '_id': self.catalog.src_id[rows],
+      'id': np.char.decode(self.catalog.id[rows]),
+      'mag': np.nan_to_num(self.catalog.mag[rows], nan=16),
+      'typ': np.char.decode(self.catalog.typ[rows]),
+      'ra': self.catalog.ra[rows],
+      'dec': self.catalog.dec[rows],
+    })
 
-    ra, dec = coord.ra.degree-180, coord.dec.degree
-    cache_key = (int(ra*100), int(dec*100))
-    if cache_key in self.cache:
-      return self.cache[cache_key]
-
-    pipeline = [
-        { '$geoNear': {
-            'near': {
-              'type': 'Point', 
-              'coordinates': [ra, dec]
-            }, 
-            'maxDistance': fov_meters, 
-            'key': 'icrs.location', 
-            'spherical': True, 
-            'distanceField': 'distance'
-        }},
-        { '$match': {
-            'star': True
-        }},
-        { '$project':{
-            'id': 1,
-            'mag': {
-              '$ifNull': ["$mag", 16],
-            },
-            'typ': 1,
-            'ra': "$icrs.deg.ra",
-            'dec': "$icrs.deg.dec",
-        }},
-        { '$sort': {
-            'mag': 1
-        }},
-    ]
-
-    if limit is not None:
-      pipeline.append({'$limit': limit})
-
-    cursor = self.db.stars.aggregate(pipeline)
-    yield from cursor
+  def coneSearch(self, coord: SkyCoord, fov_deg: float, limit:int=None):
+    radius_deg = fov_deg / 2.0 # radius from fov_deg which is diameter
+
+    rows = self.catalog.cone(coord, radius_deg, flags=FLAG_STAR)[:limit]
+    for row in rows:
+      mag = float(self.catalog.mag[row])
+      yield {
+        '_id': int(self.catalog.src_id[row]),
+        'id': self.catalog.id[row].decode(),
+        'mag': 16 if np.isnan(mag) else mag,
+        'typ': self.catalog.typ[row].decode(),
+        'ra': float(self.catalog.ra[row]),
+        'dec': float(self.catalog.dec[row]),
+      }
 
 
 def _test():
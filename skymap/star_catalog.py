@@ -0,0 +1,170 @@
+""" Embedded star catalog: columnar NumPy arrays memory-mapped from disk
+
+Rows are sorted by sky tile (SkyTiling from triangle_catalog) and by magnitude within a tile,
+so a cone search touches only the rows of the tiles overlapping the cone. Names are kept in
+fixed width byte columns, catalog designations (M 57, NGC 6720, ...) in a sorted key index.
+
+  ra.npy, dec.npy, mag.npy (NaN when unknown), flags.npy, src_id.npy
+  id.npy, id_lower.npy, typ.npy, designations.npy  ("KEY=value|KEY=value" per row)
+  des_key.npy, des_row.npy                         sorted designation lookup
+  tile_offsets.npy                                 first row of every tile
+  catalog.json
+"""
+
+import os
+import re
+import json
+import math
+import logging
+import argparse
+import numpy as np
+from astropy.coordinates import SkyCoord
+from skymap.triangle_catalog import SkyTiling, _separation_deg
+
+VERSION = 1
+
+FLAG_STAR = 1
+FLAG_NAMED = 2   # has a NAME, M or NGC designation
+
+NAMED_KEYS = ['NAME', 'M', 'NGC']
+
+ID_re = re.compile(r"[A-Z]+")
+
+
+def build_star_catalog(objects, path: str, tile_deg: float=1.0):
+  """ Write catalog columns for objects in load_db.load_data() form (dicts with id, typ, icrs, mag, star, M, NGC...) """
+  objects = [o for o in objects if o.get('icrs') is not None]
+  ra = np.array([o['icrs']['deg']['ra'] for o in objects], dtype=np.float64)
+  dec = np.array([o['icrs']['deg']['dec'] for o in objects], dtype=np.float64)
+  mag = np.array([np.nan if o.get('mag') is None else o['mag'] for o in objects], dtype=np.float32)
+  flags = np.array([(FLAG_STAR if o.get('star') else 0) | (FLAG_NAMED if any(k in o for k in NAMED_KEYS) else 0)
+                    for o in objects], dtype=np.uint8)
+  src_id = np.array([o.get('_id', i) for i, o in enumerate(objects)], dtype=np.int64)
+  ids = [o.get('id') or '' for o in objects]
+  typ = [o.get('typ') or '' for o in objects]
+  designations = ['|'.join(f"{k}={o[k]}" for k in o if ID_re.fullmatch(k) and isinstance(o[k], str)) for o in objects]
+
+  tiling = SkyTiling(tile_deg)
+  tile = tiling.tile_of(ra, dec)
+  # by tile, then brightest first (unknown magnitudes last)
+  order = np.lexsort((np.nan_to_num(mag, nan=np.inf), tile))
+
+  os.makedirs(path, exist_ok=True)
+  def save(name, arr):
+    np.save(os.path.join(path, f"{name}.npy"), arr)
+  save('ra', ra[order])
+  save('dec', dec[order])
+  save('mag', mag[order])
+  save('flags', flags[order])
+  save('src_id', src_id[order])
+  save('id', np.array([ids[i] for i in order], dtype=object).astype('U').astype('S'))
+  save('id_lower', np.array([ids[i].lower() for i in order], dtype=object).astype('U').astype('S'))
+  save('typ', np.array([typ[i] for i in order], dtype=object).astype('U').astype('S'))
+  save('designations', np.array([designations[i] for i in order], dtype=object).astype('U').astype('S'))
+  save('tile_offsets', np.searchsorted(tile[order], np.arange(tiling.num_tiles + 1)).astype(np.int64))
+
+  # every designation value ("M 57", "NGC 6720", "NAME Ring Nebula") -> row
+  keys, rows = [], []
+  for row, i in enumerate(order):
+    for d in designations[i].split('|') if designations[i] else []:
+      k, v = d.split('=', 1)
+      for value in v.split(', '):
+        keys.append(f"{k} {value.strip()}")
+        rows.append(row)
+  keys = np.array(keys, dtype=object).astype('U').astype('S') if keys else np.zeros(0, dtype='S1')
+  rows = np.array(rows, dtype=np.int64)
+  key_order = np.argsort(keys, kind='stable')
+  save('des_key', keys[key_order])
+  save('des_row', rows[key_order])
+
+  with open(os.path.join(path, 'catalog.json'), 'w') as f:
+    json.dump({'version': VERSION, 'tile_deg': tile_deg, 'num_objects': len(objects)}, f, indent=2)
+  logging.info(f"Star catalog: {len(objects)} objects in {tiling.num_tiles} tiles -> {path}")
+
+
+class StarCatalog:
+  """ Memory-mapped reader for a catalog written by build_star_catalog """
+
+  COLUMNS = ['ra', 'dec', 'mag', 'flags', 'src_id', 'id', 'id_lower', 'typ', 'designations', 'tile_offsets', 'des_key', 'des_row']
+
+  def __init__(self, path: str):
+    with open(os.path.join(path, 'catalog.json'), 'r') as f:
+      self.meta = json.load(f)
+    if self.meta.get('version') != VERSION:
+      raise ValueError(f"Unsupported star catalog version: {self.meta.get('version')}")
+    self.tiling = SkyTiling(self.meta['tile_deg'])
+    for name in StarCatalog.COLUMNS:
+      setattr(self, name, np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r'))
+
+  def __len__(self):
+    return len(self.ra)
+
+  def rows_in_cone(self, ra: float, dec: float, radius_deg: float):
+    """ Row numbers within radius_deg of (ra, dec) and their separations """
+    tiles = self.tiling.tiles_in_cone(ra, dec, radius_deg)
+    rows = np.concatenate([np.arange(self.tile_offsets[t], self.tile_offsets[t + 1]) for t in tiles] + [np.zeros(0, dtype=np.int64)])
+    sep = _separation_deg(self.ra[rows], self.dec[rows], ra, dec)
+    keep = sep <= radius_deg
+    return rows[keep], sep[keep]
+
+  def cone(self, coord: SkyCoord, radius_deg: float, mag_limit: float=None, flags: int=0):
+    """ Rows within radius_deg sorted by magnitude (unknown last), optionally brighter than mag_limit
+    and having all of the given flags
+    """
+    rows, _ = self.rows_in_cone(coord.ra.degree, coord.dec.degree, radius_deg)
+    if flags:
+      rows = rows[(self.flags[rows] & flags) == flags]
+    mag = self.mag[rows]
+    if mag_limit is not None:
+      rows, mag = rows[mag < mag_limit], mag[mag < mag_limit]
+    return rows[np.argsort(np.nan_to_num(mag, nan=np.inf), kind='stable')]
+
+  def designations_of(self, row: int):
+    d = self.designations[row].decode()
+    return dict(x.split('=', 1) for x in d.split('|')) if d else {}
+
+  def find_designation(self, key: str):
+    """ Rows with the exact designation key, e.g. "M 57" """
+    k = np.bytes_(key.encode())
+    lo = np.searchsorted(self.des_key, k, side='left')
+    hi = np.searchsorted(self.des_key, k, side='right')
+    return np.unique(self.des_row[lo:hi])
+
+  def search_id(self, pattern: str):
+    """ Rows whose id contains pattern (case insensitive) """
+    return np.flatnonzero(np.char.find(self.id_lower, pattern.lower().encode()) >= 0)
+
+  def by_magnitude(self, rows, limit: int=None):
+    rows = np.asarray(rows, dtype=np.int64)
+    rows = rows[np.argsort(np.nan_to_num(self.mag[rows], nan=np.inf), kind='stable')]
+    return rows[:limit] if limit is not None else rows
+
+  def document(self, row: int):
+    """ Object as a dict in the star database document layout """
+    ra, dec = float(self.ra[row]), float(self.dec[row])
+    mag = float(self.mag[row])
+    doc = {
+      '_id': int(self.src_id[row]),
+      'id': self.id[row].decode(),
+      'typ': self.typ[row].decode(),
+      'mag': None if math.isnan(mag) else mag,
+      'star': bool(self.flags[row] & FLAG_STAR),
+      'icrs': {
+        'deg': {'ra': ra, 'dec': dec},
+        'location': {'type': 'Point', 'coordinates': [ra - 180, dec]},
+      },
+      'ra': ra,
+      'dec': dec,
+    }
+    doc.update(self.designations_of(row))
+    return doc
+
+
+if __name__ == "__main__":
+  from skymap.stardb.load_db import load_data
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(description="Build the embedded star catalog from the SIMBAD downloads")
+  parser.add_argument("path", help="output directory")
+  parser.add_argument("--tile", type=float, default=1.0, help="tile size in degrees")
+  args = parser.parse_args()
+  build_star_catalog(load_data().values(), args.path, tile_deg=args.tile)
@@ -1,4 +1,3 @@
-from pymongo import MongoClient, ASCENDING, GEOSPHERE, TEXT
 from tqdm import tqdm
 from pathlib import Path
 import re
@@ -135,6 +134,7 @@ def load_data():
 
 
 if __name__ == "__main__":
+  from pymongo import MongoClient, ASCENDING, GEOSPHERE, TEXT
   objects_in_the_sky = load_data()
   with MongoClient("localhost") as mon:
     db = mon.stars
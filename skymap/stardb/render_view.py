@@ -1,7 +1,6 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import math
-from pymongo import MongoClient
 import cv2
 import re
 
@@ -27,6 +26,7 @@ def magnitude_to_intensity(mag: float) -> int:
   return np.clip(1.0 - (mag / 12), 0, 1)
 
 def render(ra_center_deg: float, dec_center_deg: float, fov: float):
+  from pymongo import MongoClient
   with MongoClient("localhost") as mon:
     db = mon.stars
     cursor = db.stars.find({"$and": [{
@@ -70,6 +70,7 @@ def render(ra_center_deg: float, dec_center_deg: float, fov: float):
     cv2.waitKey(0)
 
 if __name__ == "__main__":
+  from pymongo import MongoClient
 
   with MongoClient("localhost") as mon:
     db = mon.stars
@@ -0,0 +1,241 @@
+""" Sky-wide precomputed triangle catalog for plate solving
+
+The sky is cut into declination bands of `tile_deg` height, each band into RA cells of
+roughly `tile_deg` width. For every tile the vertex sorted Delaunay triangles of its
+stars (down to `mag_limit`, edges up to `max_edge_deg`) are computed once and written to
+flat .npy files that are memory-mapped at solve time:
+
+  stars.npy      ra, dec, mag per star, grouped by tile
+  star_ids.npy   star designations (same order as stars.npy)
+  src_ids.npy    star catalog source ids (same order as stars.npy)
+  triangles.npy  a, b, c (global star index), fX, fY; grouped by the tile owning vertex A
+  tiles.npy      star_start, star_end, tri_start, tri_end per tile
+  meta.json      tiling parameters
+"""
+
+import os
+import json
+import math
+import logging
+import argparse
+import numpy as np
+import pandas as pd
+from astropy.coordinates import SkyCoord
+from fwhm.star_matcher import StarMatcher, TriangleIndex
+from skymap.projection import gnomonic
+
+VERSION = 2
+
+STAR_DTYPE = np.dtype([('ra', '<f8'), ('dec', '<f8'), ('mag', '<f4')])
+TRIANGLE_DTYPE = np.dtype([('a', '<i4'), ('b', '<i4'), ('c', '<i4'), ('fX', '<f4'), ('fY', '<f4')])
+TILE_DTYPE = np.dtype([('star_start', '<i8'), ('star_end', '<i8'), ('tri_start', '<i8'), ('tri_end', '<i8')])
+
+
+class SkyTiling:
+  """ Declination bands split into RA cells no wider than tile_deg (on the sky) """
+
+  def __init__(self, tile_deg: float):
+    self.tile_deg = tile_deg
+    self.num_bands = int(math.ceil(180.0 / tile_deg))
+    band_lo = -90.0 + np.arange(self.num_bands) * tile_deg
+    band_hi = np.minimum(band_lo + tile_deg, 90.0)
+    # widest part of the band is the edge closest to the equator
+    widest = np.where((band_lo < 0) & (band_hi > 0), 0.0, np.minimum(np.abs(band_lo), np.abs(band_hi)))
+    self.cells = np.maximum(1, np.ceil(360.0 * np.cos(np.radians(widest)) / tile_deg)).astype(np.int64)
+    self.offsets = np.concatenate([[0], np.cumsum(self.cells)])
+    self.num_tiles = int(self.offsets[-1])
+
+  def tile_of(self, ra, dec):
+    band = np.clip(((np.asarray(dec) + 90.0) // self.tile_deg).astype(np.int64), 0, self.num_bands - 1)
+    cells = self.cells[band]
+    cell = np.minimum((np.mod(ra, 360.0) / 360.0 * cells).astype(np.int64), cells - 1)
+    return self.offsets[band] + cell
+
+  def tiles_in_cone(self, ra: float, dec: float, radius_deg: float):
+    """ Conservative list of tiles overlapping a cone """
+    dec_lo, dec_hi = max(dec - radius_deg, -90.0), min(dec + radius_deg, 90.0)
+    b0 = int(np.clip((dec_lo + 90.0) // self.tile_deg, 0, self.num_bands - 1))
+    b1 = int(np.clip((dec_hi + 90.0) // self.tile_deg, 0, self.num_bands - 1))
+    polar = dec_hi >= 90.0 or dec_lo <= -90.0
+    if not polar:
+      dra = radius_deg / math.cos(math.radians(max(abs(dec_lo), abs(dec_hi))))
+    tiles = []
+    for band in range(b0, b1 + 1):
+      cells = int(self.cells[band])
+      if polar or dra >= 180.0:
+        tiles.extend(range(self.offsets[band], self.offsets[band] + cells))
+        continue
+      c0 = int(math.floor((ra - dra) / 360.0 * cells))
+      c1 = int(math.floor((ra + dra) / 360.0 * cells))
+      for c in range(c0, min(c1, c0 + cells - 1) + 1):
+        tiles.append(self.offsets[band] + c % cells)
+    return np.unique(np.array(tiles, dtype=np.int64))
+
+
+def _separation_deg(ra, dec, ra0, dec0):
+  ra, dec, ra0, dec0 = (np.radians(v) for v in (ra, dec, ra0, dec0))
+  h = np.sin((dec - dec0) / 2)**2 + np.cos(dec) * np.cos(dec0) * np.sin((ra - ra0) / 2)**2
+  return np.degrees(2 * np.arcsin(np.sqrt(np.clip(h, 0, 1))))
+
+
+def _projected(ra, dec, ra0, dec0, index=None):
+  """ DataFrame in the layout StarMatcher expects, projected around (ra0, dec0) """
+  x, y = gnomonic(ra, dec, ra0, dec0)
+  return pd.DataFrame({
+    "cluster_cx": x,
+    "cluster_cy": y,
+    "ra": ra, "dec": dec,
+  }, index=index)
+
+
+def build_triangle_catalog(stars: pd.DataFrame, path: str, mag_limit: float=11.0, tile_deg: float=2.0, max_edge_deg: float=1.0):
+  """ Offline indexer: precompute per-tile triangles for stars (columns _id, id, ra, dec, mag) and write them to path
+  """
+  stars = stars[stars.mag < mag_limit].sort_values('mag', kind='stable')
+  tiling = SkyTiling(tile_deg)
+  tile = tiling.tile_of(stars.ra.to_numpy(), stars.dec.to_numpy())
+
+  # group stars by tile; star index in the catalog == position in this order
+  order = np.argsort(tile, kind='stable')
+  stars = stars.iloc[order].reset_index(drop=True)
+  tile = tile[order]
+  ra, dec, mag = stars.ra.to_numpy(np.float64), stars.dec.to_numpy(np.float64), stars.mag.to_numpy(np.float32)
+  star_bounds = np.searchsorted(tile, np.arange(tiling.num_tiles + 1))
+
+  matcher = StarMatcher()
+  triangles = []
+  tiles = np.zeros(tiling.num_tiles, dtype=TILE_DTYPE)
+  tri_count = 0
+  for t in range(tiling.num_tiles):
+    s0, s1 = star_bounds[t], star_bounds[t + 1]
+    tiles[t] = (s0, s1, tri_count, tri_count)
+    if s1 - s0 == 0:
+      continue
+    ra0, dec0 = ra[s0:s1].mean(), dec[s0:s1].mean()
+    # tile stars plus a margin so triangles crossing the tile edge are complete
+    radius = _separation_deg(ra[s0:s1], dec[s0:s1], ra0, dec0).max() + max_edge_deg
+    near = np.concatenate([np.arange(star_bounds[n], star_bounds[n + 1]) for n in tiling.tiles_in_cone(ra0, dec0, radius)])
+    near = near[_separation_deg(ra[near], dec[near], ra0, dec0) <= radius]
+    near = near[np.argsort(mag[near], kind='stable')]
+    if len(near) < 4:
+      continue
+
+    df = _projected(ra[near], dec[near], ra0, dec0, index=near)
+    df['mag'] = mag[near]
+    tri = pd.DataFrame(matcher._getVertexSortedDelaunayTriangles(df, fov_deg=max_edge_deg))
+    if len(tri) == 0:
+      continue
+    # tile owning vertex A keeps the triangle
+    tri = tri[(tri.A >= s0) & (tri.A < s1)]
+    rec = np.zeros(len(tri), dtype=TRIANGLE_DTYPE)
+    rec['a'], rec['b'], rec['c'] = tri.A, tri.B, tri.C
+    rec['fX'], rec['fY'] = tri.fX, tri.fY
+    triangles.append(rec)
+    tri_count += len(rec)
+    tiles['tri_end'][t] = tri_count
+
+  os.makedirs(path, exist_ok=True)
+  star_rec = np.zeros(len(stars), dtype=STAR_DTYPE)
+  star_rec['ra'], star_rec['dec'], star_rec['mag'] = ra, dec, mag
+  np.save(os.path.join(path, 'stars.npy'), star_rec)
+  np.save(os.path.join(path, 'star_ids.npy'), stars.id.astype(str).to_numpy().astype('S'))
+  np.save(os.path.join(path, 'src_ids.npy'), stars['_id'].to_numpy(np.int64))
+  np.save(os.path.join(path, 'triangles.npy'), np.concatenate(triangles) if triangles else np.zeros(0, dtype=TRIANGLE_DTYPE))
+  np.save(os.path.join(path, 'tiles.npy'), tiles)
+  with open(os.path.join(path, 'meta.json'), 'w') as f:
+    json.dump({
+      'version': VERSION,
+      'tile_deg': tile_deg,
+      'mag_limit': mag_limit,
+      'max_edge_deg': max_edge_deg,
+      'num_stars': len(star_rec),
+      'num_triangles': tri_count,
+    }, f, indent=2)
+  logging.info(f"Triangle catalog: {len(star_rec)} stars, {tri_count} triangles in {tiling.num_tiles} tiles -> {path}")
+
+
+class TriangleCatalog:
+  """ Memory-mapped reader for a catalog written by build_triangle_catalog """
+
+  def __init__(self, path: str):
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+      self.meta = json.load(f)
+    if self.meta.get('version') != VERSION:
+      raise ValueError(f"Unsupported triangle catalog version: {self.meta.get('version')}")
+    self.tiling = SkyTiling(self.meta['tile_deg'])
+    self.stars = np.load(os.path.join(path, 'stars.npy'), mmap_mode='r')
+    self.star_ids = np.load(os.path.join(path, 'star_ids.npy'), mmap_mode='r')
+    self.src_ids = np.load(os.path.join(path, 'src_ids.npy'), mmap_mode='r')
+    self.triangles = np.load(os.path.join(path, 'triangles.npy'), mmap_mode='r')
+    self.tiles = np.load(os.path.join(path, 'tiles.npy'), mmap_mode='r')
+
+  @property
+  def max_edge_deg(self):
+    return self.meta['max_edge_deg']
+
+  def _stars_in(self, tiles, ra0, dec0, radius, mag_limit=None):
+    """ (global star index, star records) of the stars of `tiles` within radius degrees of (ra0, dec0) """
+    idx = np.concatenate([np.arange(t['star_start'], t['star_end']) for t in tiles] + [np.zeros(0, dtype=np.int64)])
+    stars = self.stars[idx]
+    keep = _separation_deg(stars['ra'], stars['dec'], ra0, dec0) <= radius
+    if mag_limit is not None:
+      keep &= stars['mag'] < mag_limit
+    return idx[keep], stars[keep]
+
+  def cone_xy(self, ra0: float, dec0: float, radius_deg: float, mag_limit: float=None):
+    """ Star positions only: (global star index, (N, 2) gnomonic xy around (ra0, dec0)) in a cone
+    No triangles, ids or DataFrame, for callers probing many cones (blind solve verification)
+    """
+    tiles = self.tiles[self.tiling.tiles_in_cone(ra0, dec0, radius_deg)]
+    idx, stars = self._stars_in(tiles, ra0, dec0, radius_deg, mag_limit)
+    return idx, np.column_stack(gnomonic(stars['ra'].astype(np.float64), stars['dec'].astype(np.float64), ra0, dec0))
+
+  def cone(self, center: SkyCoord, fov_deg: float, mag_limit: float=None):
+    """ Reference stars and triangle index for a cone of diameter fov_deg
+    Returns (df_ref, TriangleIndex) ready for StarMatcher.matchStarsToTx
+    """
+    ra0, dec0, radius = center.ra.degree, center.dec.degree, fov_deg / 2.0
+    # triangles are owned by the tile of vertex A, their other vertices may lie in a neighbour tile
+    tiles = self.tiles[self.tiling.tiles_in_cone(ra0, dec0, radius + self.max_edge_deg)]
+
+    idx, stars = self._stars_in(tiles, ra0, dec0, radius, mag_limit)
+    order = np.argsort(stars['mag'], kind='stable')
+    idx, stars = idx[order], stars[order]
+
+    df_ref = _projected(stars['ra'].astype(np.float64), stars['dec'].astype(np.float64), ra0, dec0)
+    df_ref['mag'] = stars['mag']
+    # same _id / id columns as SkyMap.coneSearchTable
+    df_ref.insert(0, '_id', self.src_ids[idx])
+    df_ref.insert(1, 'id', np.char.decode(self.star_ids[idx]))
+
+    # global star index -> row in df_ref
+    tri = np.concatenate([self.triangles[t['tri_start']:t['tri_end']] for t in tiles] + [np.zeros(0, dtype=TRIANGLE_DTYPE)])
+    lookup = pd.Index(idx)
+    abc = np.column_stack([lookup.get_indexer(tri[v]) for v in 'abc']) if len(tri) else np.zeros((0, 3), dtype=np.intp)
+    valid = (abc >= 0).all(axis=1)
+    abc, tri = abc[valid], tri[valid]
+    tri_ref = pd.DataFrame({
+      "A": abc[:, 0], "B": abc[:, 1], "C": abc[:, 2],
+      "fX": tri['fX'].astype(np.float64), "fY": tri['fY'].astype(np.float64),
+    }).sort_values("fX", kind="stable").reset_index(drop=True)
+    return df_ref, TriangleIndex(tri_ref)
+
+
+def _skymap_stars(mag_limit: float):
+  """ All stars brighter than mag_limit from the star catalog """
+  from skymap.skymap import get_star_catalog
+  from skymap.star_catalog import FLAG_STAR
+  cat = get_star_catalog()
+  rows = np.flatnonzero(((cat.flags[:] & FLAG_STAR) != 0) & (cat.mag[:] < mag_limit))
+  return pd.DataFrame({"_id": cat.src_id[rows], "id": np.char.decode(cat.id[rows]), "ra": cat.ra[rows], "dec": cat.dec[rows], "mag": cat.mag[rows]})
+
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO)
+  parser = argparse.ArgumentParser(description="Build the precomputed plate solving triangle catalog")
+  parser.add_argument("path", help="output directory")
+  parser.add_argument("--mag", type=float, default=11.0, help="faintest star magnitude")
+  parser.add_argument("--tile", type=float, default=2.0, help="tile size in degrees")
+  parser.add_argument("--edge", type=float, default=1.0, help="longest triangle edge in degrees")
+  args = parser.parse_args()
+  build_triangle_catalog(_skymap_stars(args.mag), args.path, mag_limit=args.mag, tile_deg=args.tile, max_edge_deg=args.edge)
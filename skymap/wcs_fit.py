@@ -0,0 +1,63 @@
+""" Least squares TAN (gnomonic) WCS fit from matched stars, with optional SIP distortion """
+
+import numpy as np
+from astropy.wcs import WCS, Sip
+from skymap.projection import gnomonic, inverse_gnomonic
+
+
+def _sip_terms(order: int):
+  return [(p, q) for p in range(order + 1) for q in range(order + 1) if 2 <= p + q <= order]
+
+
+def fit_tan_wcs(pixel_xy: np.ndarray, ra: np.ndarray, dec: np.ndarray, crpix, sip_order: int=None, iterations: int=5):
+  """ Fit CRVAL and CD so that pixel_xy (0-based x, y) maps to ra, dec (degrees)
+  crpix: reference pixel (0-based x, y), usually the image center
+  sip_order: add SIP polynomial distortion of this order (2 or 3) when there are enough stars
+  Returns astropy WCS
+  """
+  pixel_xy = np.asarray(pixel_xy, dtype=np.float64)
+  ra, dec = np.asarray(ra, dtype=np.float64), np.asarray(dec, dtype=np.float64)
+  if len(pixel_xy) < 3:
+    raise ValueError(f"Need at least 3 matched stars for a WCS fit, got {len(pixel_xy)}")
+
+  uv = pixel_xy - np.asarray(crpix, dtype=np.float64)
+  terms = _sip_terms(sip_order) if sip_order else []
+  if len(uv) < 2 * (len(terms) + 3):
+    terms = []
+  # xi, eta = CD @ (uv + sip(uv)) + offset is linear in CD, CD @ sip coefficients and offset
+  X = np.column_stack([uv, np.ones(len(uv))] + [uv[:, 0]**p * uv[:, 1]**q for p, q in terms])
+
+  # start at the mean star position; move CRVAL until the fitted offset at crpix vanishes
+  x, y = gnomonic(ra, dec, ra[0], dec[0])
+  crval = [float(v) for v in inverse_gnomonic(x.mean(), y.mean(), ra[0], dec[0])]
+  for _ in range(iterations):
+    xi_eta = np.degrees(np.column_stack(gnomonic(ra, dec, *crval)))
+    M = np.linalg.lstsq(X, xi_eta, rcond=None)[0].T
+    cd, offset = M[:, :2], M[:, 2]
+    crval = [float(v) for v in inverse_gnomonic(*np.radians(offset), *crval)]
+    if np.hypot(*offset) < 1e-9:
+      break
+
+  wcs = WCS(naxis=2)
+  wcs.wcs.ctype = ["RA---TAN", "DEC--TAN"]
+  wcs.wcs.crval = crval
+  # FITS pixels are 1-based
+  wcs.wcs.crpix = [crpix[0] + 1, crpix[1] + 1]
+  wcs.wcs.cd = cd
+
+  if terms:
+    coef = np.linalg.inv(cd) @ M[:, 3:]
+    A = np.zeros((sip_order + 1, sip_order + 1))
+    B = np.zeros((sip_order + 1, sip_order + 1))
+    for (p, q), (a, b) in zip(terms, coef.T):
+      A[p, q], B[p, q] = a, b
+    wcs.wcs.ctype = ["RA---TAN-SIP", "DEC--TAN-SIP"]
+    wcs.sip = Sip(A, B, None, None, wcs.wcs.crpix)
+  return wcs
+
+
+def wcs_residuals_arcsec(wcs: WCS, pixel_xy: np.ndarray, ra: np.ndarray, dec: np.ndarray):
+  """ Angular distance between fitted and catalog positions of the matched stars """
+  fit_ra, fit_dec = wcs.all_pix2world(pixel_xy[:, 0], pixel_xy[:, 1], 0)
+  dra = (fit_ra - ra + 180) % 360 - 180
+  return np.degrees(np.hypot(np.radians(dra) * np.cos(np.radians(dec)), np.radians(fit_dec - dec))) * 3600
@@ -0,0 +1,112 @@
+""" Write-behind storage for captured frames
+
+Frames are queued and written by a background thread so the next exposure can start as soon as
+the previous one is downloaded. The queue is bounded: when the disk falls that far behind, save()
+blocks the capture thread instead of piling frames up in memory. Files are written under a
+temporary name, fsynced and renamed, so a crash never leaves a truncated sub with the final name.
+"""
+
+import os
+import queue
+import threading
+import logging
+import time
+from collections import deque
+from astropy.io import fits
+from xisf.xisf_parser import write_xisf
+from pipeline import StageMetrics
+
+
+def _fsync(path):
+    # Windows only flushes through a handle opened for writing
+    with open(path, 'r+b') as f:
+        os.fsync(f.fileno())
+
+
+class StorageService(threading.Thread):
+
+    WriteDoneEventName = "<<StorageWriteDone>>"
+
+    def __init__(self, tk_root, max_pending=4, fits_compression=None, xisf_compression='zlib', fsync=True):
+        """ fits_compression: None or a tile compression type ('RICE_1', 'GZIP_2', ...); Rice is lossless on integer data
+        xisf_compression: codec for .xisf files, see xisf_parser.write_xisf
+        """
+        super().__init__()
+        self._tk_root = tk_root
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._results = deque()
+        self._callbacks = []
+        self.fits_compression = fits_compression
+        self.xisf_compression = xisf_compression
+        self.fsync = fsync
+        self.metrics = StageMetrics('storage')
+        self.daemon = True
+        self._tk_root.bind(self.WriteDoneEventName, self._on_write_done)
+        self.start()
+
+    def subscribe(self, cb):
+        """ cb(fname, error) on the Tk thread after each write; error is None on success """
+        self._callbacks.append(cb)
+
+    @property
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def save(self, fname, img, header):
+        """ Queue a frame for writing; blocks while max_pending frames are waiting """
+        start = time.time()
+        self._queue.put((time.time(), str(fname), img, header))
+        self.metrics.add_blocked(time.time() - start)
+
+    def flush(self):
+        """ Wait until every queued frame is on disk """
+        self._queue.join()
+
+    def terminate(self):
+        self._queue.put(None)
+        self.join()
+
+    def write(self, fname, img, header):
+        if os.path.exists(fname):
+            raise FileExistsError(f"{fname} already exists")
+        tmp_fname = fname + '.part'
+        if fname.lower().endswith('.xisf'):
+            write_xisf(tmp_fname, img, header, codec=self.xisf_compression)
+        else:
+            if self.fits_compression:
+                hdul = fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(img, header=header, compression_type=self.fits_compression)])
+            else:
+                hdul = fits.HDUList([fits.PrimaryHDU(img, header=header)])
+            hdul.writeto(tmp_fname, overwrite=True)
+        if self.fsync:
+            _fsync(tmp_fname)
+        os.replace(tmp_fname, fname)
+
+    def run(self):
+        logging.info(f"Started {self.__class__.__name__} thread")
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            queued, fname, img, header = item
+            error = None
+            start = time.time()
+            try:
+                self.write(fname, img, header)
+                logging.info(f"Saved {fname} in {time.time() - start:.2f} sec")
+            except Exception as e:
+                error = f"{self.__class__.__name__}: {e}"
+                logging.error(f"Failed to save {fname}: {e}")
+                if os.path.exists(fname + '.part'):
+                    os.remove(fname + '.part')
+            self.metrics.add(time.time() - start, start - queued, error is not None)
+            self._results.append((fname, error))
+            self._queue.task_done()
+            self._tk_root.event_generate(self.WriteDoneEventName, when="tail", x=0 if error is None else -2, y=self.pending)
+
+    def _on_write_done(self, event):
+        while self._results:
+            fname, error = self._results.popleft()
+            for cb in self._callbacks:
+                cb(fname, error)
@@ -65,26 +65,38 @@ class CoolerWidget(BaseWidget):
     self.thread = Thread(target=self.camera.warmto, args=[25], name="Warm")
     self.thread.start()
 
-  def _update(self):
-    if self.camera is not None and self.camera.connected:
-
-      threadStatus = ""      
-      if self.thread is not None:
-        if self.thread.is_alive():
-          if self.thread.getName() == "Cool":
-            # unicode char for arrow down
-            threadStatus += u'\u2193'
-          elif self.thread.getName() == "Warm":
-            # unicode char for arrow up
-            threadStatus += u'\u2191'
-        else:
-          self.thread = None
-
-      stat = 'On' if self.camera.cooler == True else 'Off'
-      temperature = self.camera.temperature
-      coolerpower = self.camera.coolerpower
-      self.cameraTemp.set(f"({stat} {coolerpower}%) {threadStatus}")
-      self.hdrInfo.set(f"{stat} {temperature:.1f} C")
+  def read_state(self):
+    """ Camera cooler state; runs on the device monitor thread """
+    if self.camera is None or not self.camera.connected:
+      return {'connected': False}
+
+    threadStatus = ""
+    thread = self.thread
+    if thread is not None and thread.is_alive():
+      if thread.name == "Cool":
+        # unicode char for arrow down
+        threadStatus += u'\u2193'
+      elif thread.name == "Warm":
+        # unicode char for arrow up
+        threadStatus += u'\u2191'
+
+    return {
+      'connected': True,
+      'cooler': self.camera.cooler,
+      'temperature': self.camera.temperature,
+      'coolerpower': self.camera.coolerpower,
+      'threadStatus': threadStatus
+    }
+
+  def _update(self, state):
+    if 'error' in state:
+      raise RuntimeError(state['error'])
+    if state['connected']:
+      if self.thread is not None and not self.thread.is_alive():
+        self.thread = None
+
+      stat = 'On' if state['cooler'] == True else 'Off'
+      self.cameraTemp.set(f"({stat} {state['coolerpower']}%) {state['threadStatus']}")
+      self.hdrInfo.set(f"{stat} {state['temperature']:.1f} C")
       return True
     return False
-
@@ -6,6 +6,7 @@ import psutil
 import time
 from pathlib import Path
 import json
+from settings import config
 
 class COMPortSelectionDialog(tk.Toplevel):
 
@@ -159,7 +160,7 @@ def make_camera(camera_name, parent=None):
     camera = ASINativeCamera("294")
   elif camera_name == "294MC-Ascom":
     from Alpaca.camera import Camera
-    camera = Camera("294")
+    camera = Camera("294", gzip=config.get('alpaca_gzip', False))
   elif camera_name == "Nikon D90":
     raise NotImplementedError()
   elif camera_name == "Nikon D750":
@@ -9,23 +9,10 @@ from ui.base_widget import BaseWidget
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import matplotlib.ticker as ticker
-from fwhm.fwhm import fit_1dgausssian
+import histogram
 import logging
 
 
-def calc_stretch(red, green, blue):
-    a = []
-    b = []
-    for i, h in enumerate([red, green, blue]):
-        fit_g = fit_1dgausssian(h)[:3]
-        if fit_g is None:
-          raise ValueError("Gaussian fit error")
-        ampl, avg, stddev = fit_g
-        fwhm = abs(8 * np.log(2) * stddev)
-        a.append(max(int(avg - 1.0 * fwhm), 1))
-        b.append(min(int(avg + 2.5 * fwhm), 255))
-    return a, b
-
 class HistogramViewer(BaseWidget):
 
   def __init__(self, parentFrame, image_container):
@@ -83,6 +70,7 @@ class HistogramViewer(BaseWidget):
     self.canvas = FigureCanvasTkAgg(fig, master=self.histoCanvas)
     self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
 
+    self.hist = None
     self.red = None
     self.green = None
     self.blue = None
@@ -165,31 +153,24 @@ class HistogramViewer(BaseWidget):
 
 
   def _stretch(self):
-    if self.red is None or self.green is None or self.blue is None:
+    if self.hist is None:
       return
-    try:
-      a, b = calc_stretch(self.red, self.green, self.blue)
-      self.image_container.set_stretch(a, b)
+    # linked: one curve from all channels keeps the colour balance of the frame
+    hists = [self.hist.sum(axis=0)] * 3 if self.locked else self.hist
+    shadows, midtones, highlights = zip(*[histogram.auto_stretch(h) for h in hists])
+    self.image_container.set_stf(shadows, midtones, highlights)
 
-      self.slider_low_val = [int(a) for a in a]
-      self.slider_high_val = [int(b) for b in b]
-      self._update_slider_positions()
-    except ValueError as err:
-      logging.error(err)
-      pass
+    self.slider_low_val = [int(s * self.slider_max_val) for s in shadows]
+    self.slider_high_val = [int(h * self.slider_max_val) for h in highlights]
+    self._update_slider_positions()
 
   def _update(self, img: ImageData):
     if img is None:
       return
 
-    if True:
-      self.red, self.green, self.blue = img.get_deb16_histogram()
-      img = img.deb16
-    else:
-      img = img.rgb24
-      self.red = np.bincount(img[:,:,0].reshape(-1))
-      self.green = np.bincount(img[:,:,1].reshape(-1))
-      self.blue = np.bincount(img[:,:,2].reshape(-1))
+    # computed from the mosaic by the capture pipeline; nothing is debayered here
+    self.hist = img.histogram
+    self.red, self.green, self.blue = histogram.rebin(self.hist)
 
     m = np.max([np.max(self.red), np.max(self.blue), np.max(self.green)])
     # m = 1e3 * int((m + 1e3)/1e3)
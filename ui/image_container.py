@@ -11,9 +11,12 @@ import numpy as np
 from debayer.bilinear import debayer_bilinear
 import pandas as pd
 from image_data import ImageData
+from histogram import stretch_table
 from ui.base_widget import BaseWidget
 from scipy.interpolate import interp1d, PchipInterpolator
 from image_processing_service import ImageProcessingService
+from ui.tile_renderer import TILE, TileCache, TiledImage, visible_tiles
+from settings import config
 
 
 class ImageViewer(BaseWidget):
@@ -24,7 +27,11 @@ class ImageViewer(BaseWidget):
     self.image = None
     self.imageScale = 1.0
     self.highlights = None
-    self.scaledImg = None
+    self.viewSize = None
+    self.tiledImage = None
+    self.tileCache = TileCache(config.get('tile_cache', 256))
+    self.tileItems = {}
+    self.gammaVersion = 0
     self.starHotSpots = {}
     self.onTargetStarChanged = None
 
@@ -37,10 +44,10 @@ class ImageViewer(BaseWidget):
     self.tooltipLabel = tk.Label(self.imageCanvas, background="#FFFFDD", relief="solid", borderwidth=1)
     self.hbar=ttk.Scrollbar(self.widgetFrame, orient=tk.HORIZONTAL)
     self.hbar.pack(side=tk.BOTTOM, fill=tk.X)
-    self.hbar.config(command=self.imageCanvas.xview)
+    self.hbar.config(command=self._xview)
     self.vbar=ttk.Scrollbar(self.widgetFrame, orient=tk.VERTICAL)
     self.vbar.pack(side=tk.RIGHT, fill=tk.Y)
-    self.vbar.config(command=self.imageCanvas.yview)
+    self.vbar.config(command=self._yview)
     self.imageCanvas.config(xscrollcommand=self.hbar.set, yscrollcommand=self.vbar.set)
     self.imageCanvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
     # Bind the mouse click event to the canvas
@@ -74,12 +81,7 @@ class ImageViewer(BaseWidget):
     self.ageLabel = tk.Label(self.imageCanvas, background="#000", foreground="#FFF", font=("Arial", 10), anchor="e")
     self.ageLabel.place(relx=1.0, rely=0.0, x=-10, y=10, anchor="ne")
     self.imageLoadTime = None
-    def updateAgeLabel():
-      if self.imageLoadTime is not None:
-        age_seconds = int(time.time() - self.imageLoadTime)
-        self.ageLabel.configure(text=f"{age_seconds}s")
-      self.imageCanvas.after(1000, updateAgeLabel)
-    updateAgeLabel()
+    self.ageTimer = None
 
     imageObject = ImageTk.PhotoImage(image=Image.open(Path(__file__).parent / "splash.jpg"))
     tk_root.after_idle(self._updatePhotoImage, imageObject, 1024, 768, None)
@@ -95,6 +97,15 @@ class ImageViewer(BaseWidget):
 
   def _onMouseDrag(self, event):
       self.imageCanvas.scan_dragto(event.x, event.y, gain=1)
+      self._renderViewport()
+
+  def _xview(self, *args):
+    self.imageCanvas.xview(*args)
+    self._renderViewport()
+
+  def _yview(self, *args):
+    self.imageCanvas.yview(*args)
+    self._renderViewport()
 
   def _onMouseRelease(self, event):
       pass
@@ -123,6 +134,12 @@ class ImageViewer(BaseWidget):
         spline = PchipInterpolator([0, low, high, 256], [0, 0, 255, 256])
         self.gamma_table[:, i] = spline(np.arange(256))
 
+  def set_stf(self, shadows, midtones, highlights):
+    """ Screen transfer function per channel (lists in [0, 1], see histogram.auto_stretch) """
+    self.gamma.set(1.0)
+    self.gammaStr.set("1.0")
+    self.gamma_table = np.stack([stretch_table(*params) for params in zip(shadows, midtones, highlights)], axis=-1)
+
   def refresh(self):
     self._refreshDisplay()
 
@@ -130,12 +147,13 @@ class ImageViewer(BaseWidget):
     self.updateGammaTable()
     self._refreshDisplay()
 
-  def _scaleImage(self, after):
+  def _scaleImage(self, after, scroll_pos=None):
     if self.image is None:
       return
     imgCanvasWidth, imgCanvasHeight = self.imageCanvas.winfo_width(), self.imageCanvas.winfo_height()
     # print("canvas size: ", imgCanvasWidth, imgCanvasHeight)
-    imgAspect = self.image.rgb24.shape[0] / self.image.rgb24.shape[1]
+    imgHeight, imgWidth = self.image.shape
+    imgAspect = imgHeight / imgWidth
 
     if imgCanvasWidth * imgAspect <= imgCanvasHeight:
       w = imgCanvasWidth
@@ -143,36 +161,94 @@ class ImageViewer(BaseWidget):
     else:
       w = int(imgCanvasHeight / imgAspect)
       h = imgCanvasHeight
-    self.scaleX = (w*self.imageScale) / self.image.rgb24.shape[1]
-    self.scaleY = (h*self.imageScale) / self.image.rgb24.shape[0]
-
-    def after_resize(j, output):
-      scaledImg, imageObject = output
-      img = self.scaledImg = scaledImg
-      h, w = img.shape[:2]
-      self._updatePhotoImage(imageObject, w, h, after)
-
-    self.imageProcessingService.resize(self.image, w, h, self.imageScale, self.gamma_table, on_success=after_resize)
-    
+    # virtual size of the zoomed image; only the tiles in view are ever rendered
+    self.viewSize = (max(int(w*self.imageScale), 1), max(int(h*self.imageScale), 1))
+    self.scaleX = self.viewSize[0] / imgWidth
+    self.scaleY = self.viewSize[1] / imgHeight
+    self._clearTiles()
+    self.imageCanvas.configure(scrollregion=(0, 0, *self.viewSize))
+    if scroll_pos is not None:
+      # keep the view centered on the same spot when zooming
+      self.imageCanvas.xview_moveto(scroll_pos[0]/self.viewSize[0])
+      self.imageCanvas.yview_moveto(scroll_pos[1]/self.viewSize[1])
+    self._placeCrosshairs(self.viewSize[0]//2, self.viewSize[1]//2)
+    self._renderViewport(after)
 
   def _refreshDisplay(self, after=None):
-    if self.scaledImg is None:
+    if self.viewSize is None:
       return
-    img = self.scaledImg
-    h, w = img.shape[:2]
-    self.imageProcessingService.stretch_to_photoimage(img, self.gamma_table, on_success=lambda j, imageObject: self._updatePhotoImage(imageObject, w, h, after))
+    # stretch changed: every tile has to be rendered again
+    self.gammaVersion += 1
+    self._clearTiles()
+    self._renderViewport(after)
+
+  def _tileKey(self, tile):
+    return (self.scaleX, self.gammaVersion, tile)
+
+  def _clearTiles(self):
+    self.imageCanvas.delete('tile')
+    self.tileItems = {}
+
+  def _placeTile(self, tile, photo):
+    tx, ty = tile
+    self.tileItems[tile] = self.imageCanvas.create_image((tx*TILE, ty*TILE), image=photo, anchor='nw', tags='tile')
+    self.imageCanvas.tag_lower(self.tileItems[tile])
+
+  def _renderViewport(self, after=None):
+    """ Show the tiles around the viewport: cached ones right away, the rest from a worker """
+    if self.tiledImage is None or self.viewSize is None:
+      if after is not None:
+        self.tk_root.after_idle(after)
+      return
+    tiles = visible_tiles(self.imageCanvas.canvasx(0), self.imageCanvas.canvasy(0),
+                          self.imageCanvas.winfo_width(), self.imageCanvas.winfo_height(), self.viewSize)
+    visible = set(tiles)
+    for tile in [t for t in self.tileItems if t not in visible]:
+      self.imageCanvas.delete(self.tileItems.pop(tile))
+    missing = []
+    for tile in tiles:
+      if tile in self.tileItems:
+        continue
+      photo = self.tileCache.get(self._tileKey(tile))
+      if photo is not None:
+        self._placeTile(tile, photo)
+      else:
+        missing.append(tile)
+
+    if not missing:
+      if after is not None:
+        self.tk_root.after_idle(after)
+      return
+
+    tiledImage, scale, gammaVersion = self.tiledImage, self.scaleX, self.gammaVersion
+    def on_rendered(job, rendered):
+      for tile, photo in rendered:
+        self.tileCache.put((scale, gammaVersion, tile), photo)
+      # zoom, stretch or frame changed meanwhile: keep the tiles cached but do not show them
+      if tiledImage is self.tiledImage and scale == self.scaleX and gammaVersion == self.gammaVersion:
+        for tile, photo in rendered:
+          if tile not in self.tileItems:
+            self._placeTile(tile, photo)
+      if after is not None:
+        self.tk_root.after_idle(after)
+    self.imageProcessingService.render_tiles(tiledImage, scale, self.viewSize, missing, self.gamma_table, on_success=on_rendered)
+
+  def _placeCrosshairs(self, c_x, c_y):
+    if not self.imageCanvas.find_withtag('crosshairs'):
+      self.imageCanvas.create_oval(c_x-25, c_y-25, c_x+25, c_y+25, outline="red", tags='crosshairs')
+      self.imageCanvas.create_line(c_x-50, c_y, c_x+50, c_y, fill='red', tags='crosshairs')
+      self.imageCanvas.create_line(c_x, c_y-50, c_x, c_y+50, fill='red', tags='crosshairs')
+    else:
+      self.imageCanvas.moveto('crosshairs', c_x-50, c_y-50)
 
   def _updatePhotoImage(self, imageObject, w, h, after=None):
+    """ Single image (the splash screen) """
     self.imageObject = imageObject
-    c_x, c_y = w//2, h//2
     if self.image_container is None:
       self.image_container = self.imageCanvas.create_image((0,0), image=self.imageObject, anchor='nw')
-      self.imageCanvas.create_oval(c_x-25, c_y-25, c_x+25, c_y+25, outline="red", tags='crosshairs')
-      self.imageCanvas.create_line(c_x-50, c_y, c_x+50, c_y, fill='red', tags='crosshairs')
-      self.imageCanvas.create_line(c_x, c_y-50, c_x, c_y+50, fill='red', tags='crosshairs')
     else:
       self.imageCanvas.itemconfig(self.image_container, image=self.imageObject)
-      self.imageCanvas.moveto('crosshairs', c_x-25, c_y-25)
+    self._placeCrosshairs(w//2, h//2)
     if after is not None:
       self.tk_root.after_idle(after)
 
@@ -188,22 +264,15 @@ class ImageViewer(BaseWidget):
       center_y = int(center_y * new_scale / old_scale)
       return max(0, center_x - vw/2), max(0, center_y - vh/2)
 
-  def after_scale(self, scroll_xpos, scroll_ypos):
-    self.updateStars()
-    self.imageCanvas.configure(scrollregion=self.imageCanvas.bbox("all"))
-    w, h = self.scaledImg.shape[1], self.scaledImg.shape[0]
-    self.imageCanvas.xview_moveto(scroll_xpos/w)
-    self.imageCanvas.yview_moveto(scroll_ypos/h)
-
   def zoomin(self):
     if self.imageScale < 5:
-      scroll_xpos, scroll_ypos = self._updateZoom(self.imageScale + 0.5)
-      self._scaleImage(after=lambda: self.after_scale(scroll_xpos, scroll_ypos))
+      scroll_pos = self._updateZoom(self.imageScale + 0.5)
+      self._scaleImage(after=self.updateStars, scroll_pos=scroll_pos)
 
   def zoomout(self):
     if self.imageScale > 0.5:
-      scroll_xpos, scroll_ypos = self._updateZoom(self.imageScale - 0.5)
-      self._scaleImage(after=lambda: self.after_scale(scroll_xpos, scroll_ypos))
+      scroll_pos = self._updateZoom(self.imageScale - 0.5)
+      self._scaleImage(after=self.updateStars, scroll_pos=scroll_pos)
 
   def resize(self, event):
     self.imageCanvas.configure(scrollregion=self.imageCanvas.bbox("all"))
@@ -211,10 +280,25 @@ class ImageViewer(BaseWidget):
 
   def _update(self, imgData: ImageData):
     self.image = imgData
+    self.tiledImage = TiledImage(imgData)
+    self.tileCache.clear()
+    if self.image_container is not None:
+      # splash screen
+      self.imageCanvas.delete(self.image_container)
+      self.image_container = None
     self.imageLoadTime = time.time()
+    self._updateAgeLabel()
     self._scaleImage(after=self.updateStars)
     return True
 
+  def _updateAgeLabel(self):
+    """ Started by each new image; ticks on whole seconds of its age, no device access """
+    if self.ageTimer is not None:
+      self.imageCanvas.after_cancel(self.ageTimer)
+    age = time.time() - self.imageLoadTime
+    self.ageLabel.configure(text=f"{int(age)}s")
+    self.ageTimer = self.imageCanvas.after(int((1 - age % 1) * 1000) + 1, self._updateAgeLabel)
+
   def updateStars(self):
     self.imageCanvas.delete('star_bbox')
     self.starHotSpots = {}
@@ -240,7 +324,7 @@ class ImageViewer(BaseWidget):
   def _onMouseClick(self, event):
     if len(self.starHotSpots) == 0:
        return
-    h, w = self.scaledImg.shape[:2]
+    w, h = self.viewSize
     x = event.x + (w * self.hbar.get()[0])
     y = event.y + (h * self.vbar.get()[0])
     # Perform hit test on ovals
@@ -110,7 +110,7 @@ class RefineConfirm(tk.Toplevel):
         results_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
         # Insert the new results into the table
-        for idx, result_key in enumerate(['solved', 'separation_arcmin', 'num_ref', 'num_tgt', 'solver_votes', 'matches', 'center', 'tx']):
+        for idx, result_key in enumerate(['solved', 'separation_arcmin', 'num_ref', 'num_tgt', 'solver_votes', 'matches', 'matched_stars', 'rms_arcsec', 'center', 'tx']):
             if result_key in solver_result:
                 self.table.insert('', 'end', text=str(idx), values=(result_key, solver_result[result_key]))
 
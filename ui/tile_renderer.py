@@ -0,0 +1,107 @@
+""" Viewport tiling for the image viewer
+
+The displayed image is a virtual canvas of the frame scaled to the zoom level, cut into TILE x TILE
+tiles. Only tiles intersecting the viewport (plus a margin) are rendered, each from the pyramid
+level closest above the display scale, so the work per tile does not depend on the sensor size.
+"""
+
+import math
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+TILE = 256
+
+
+def pyramid_level(scale: float) -> int:
+  """ Pyramid level k (frame downsampled by 2^k) to render a display scale from: 2^-k >= scale > 2^-(k+1) """
+  if scale >= 1:
+    return 0
+  return int(math.floor(math.log2(1.0 / scale)))
+
+
+def visible_tiles(view_x, view_y, view_w, view_h, size, margin=TILE//2):
+  """ (tx, ty) of the tiles intersecting the view rectangle grown by margin, clipped to the virtual image size """
+  width, height = size
+  tx0 = max(int(view_x - margin) // TILE, 0)
+  ty0 = max(int(view_y - margin) // TILE, 0)
+  tx1 = min(int(math.ceil((view_x + view_w + margin) / TILE)), int(math.ceil(width / TILE)))
+  ty1 = min(int(math.ceil((view_y + view_h + margin) / TILE)), int(math.ceil(height / TILE)))
+  return [(tx, ty) for ty in range(ty0, ty1) for tx in range(tx0, tx1)]
+
+
+class TileCache:
+  """ LRU cache of rendered tiles """
+
+  def __init__(self, max_tiles=256):
+    self.max_tiles = max_tiles
+    self._tiles = OrderedDict()
+
+  def get(self, key):
+    tile = self._tiles.get(key)
+    if tile is not None:
+      self._tiles.move_to_end(key)
+    return tile
+
+  def put(self, key, tile):
+    self._tiles[key] = tile
+    self._tiles.move_to_end(key)
+    while len(self._tiles) > self.max_tiles:
+      self._tiles.popitem(last=False)
+
+  def clear(self):
+    self._tiles.clear()
+
+  def __len__(self):
+    return len(self._tiles)
+
+
+class TiledImage:
+  """ Resolution levels of an ImageData: rgb24, the ImageData display pyramid, and further halvings built here
+  render_tile() may be called from worker threads
+  """
+
+  def __init__(self, imageData):
+    self.imageData = imageData
+    self._levels = {}
+    self._lock = threading.RLock()
+
+  @property
+  def shape(self):
+    return self.imageData.shape
+
+  def level(self, k: int) -> np.ndarray:
+    with self._lock:
+      if k not in self._levels:
+        if k == 0:
+          self._levels[0] = self.imageData.rgb24
+        elif k <= self.imageData.PYRAMID_LEVELS:
+          self._levels[k] = self.imageData.pyramid[k - 1]
+        else:
+          prev = self.level(k - 1)
+          h, w = prev.shape[:2]
+          self._levels[k] = cv2.resize(prev, ((w + 1) // 2, (h + 1) // 2), interpolation=cv2.INTER_AREA)
+      return self._levels[k]
+
+  def render_tile(self, scale: float, tx: int, ty: int, size, out=None):
+    """ BGR tile (tx, ty) of the frame displayed at `scale` (display px per sensor px) on a virtual image of `size`
+    out: TILE x TILE x 3 buffer to render into instead of a new array; the tile is a view of it
+    """
+    k = pyramid_level(scale)
+    src = self.level(k)
+    s = scale * (1 << k)
+    width, height = size
+    x0, y0 = tx * TILE, ty * TILE
+    w, h = min(TILE, width - x0), min(TILE, height - y0)
+    # source window covering the tile, one pixel of context on each side for interpolation
+    sx0 = max(int(math.floor((x0 + 0.5) / s - 0.5)) - 1, 0)
+    sy0 = max(int(math.floor((y0 + 0.5) / s - 0.5)) - 1, 0)
+    sx1 = min(int(math.ceil((x0 + w + 0.5) / s - 0.5)) + 2, src.shape[1])
+    sy1 = min(int(math.ceil((y0 + h + 0.5) / s - 0.5)) + 2, src.shape[0])
+    crop = src[sy0:sy1, sx0:sx1]
+    # same global pixel-center mapping for every tile, so neighbouring tiles join without seams
+    M = np.array([[s, 0, s * (sx0 + 0.5) - 0.5 - x0],
+                  [0, s, s * (sy0 + 0.5) - 0.5 - y0]], dtype=np.float64)
+    interpolation = cv2.INTER_NEAREST if s >= 4 else cv2.INTER_LINEAR
+    return cv2.warpAffine(crop, M, (w, h), dst=None if out is None else out[:h, :w], flags=interpolation, borderMode=cv2.BORDER_REPLICATE)
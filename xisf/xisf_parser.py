@@ -1,10 +1,52 @@
+""" XISF (PixInsight) image files
+
+XISFFile parses only the XML header when opened; pixels are read when asked for. Uncompressed
+attachments are served straight from a memory map, compressed ones (zlib, lz4, lz4hc, zstd, each
+optionally byte shuffled) are inflated on read. write_xisf stores one or more images as a
+monolithic file with compressed attachments.
+lz4 and zstd need the `lz4` and `zstandard` packages; zlib is always available.
+"""
+
 import re
-from struct import unpack
+import mmap
+import zlib
+import base64
+import hashlib
+from struct import pack, unpack
+from datetime import datetime, timezone
 import numpy as np
 import lxml.etree as ET
-import matplotlib.pyplot as plt
 
-ns = {'x':'http://www.pixinsight.com/xisf'}
+try:
+  import lz4.block as lz4_block
+except ImportError:
+  lz4_block = None
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+XISF_NS = 'http://www.pixinsight.com/xisf'
+ns = {'x': XISF_NS}
+SIGNATURE = b'XISF0100'
+
+SAMPLE_FORMATS = {
+  'UInt8': np.uint8,
+  'UInt16': np.uint16,
+  'UInt32': np.uint32,
+  'UInt64': np.uint64,
+  'Float32': np.float32,
+  'Float64': np.float64,
+  'Complex32': np.complex64,
+  'Complex64': np.complex128,
+}
+CODECS = ['zlib', 'lz4', 'lz4hc', 'zstd']
+
+# attachment positions are aligned like PixInsight does, so blocks start on page boundaries
+BLOCK_ALIGN = 4096
+# compressed blocks larger than this are split into subblocks (lz4 cannot take more than 2 GB)
+MAX_SUBBLOCK = 1 << 30
+
 
 def read_data_blocks_file(f):
   # Read datablock
@@ -25,41 +67,364 @@ def read_data_blocks_file(f):
 
   print(f"Number of blocks: {num_blocks}")
 
-def read_xisf(fname: str) -> np.ndarray:
-  with open(fname, "rb") as f:
-    if f.read(8) != b'XISF0100':
-      raise ValueError("Invalid XISF file")
-    
-    hdr_len = unpack("<I", f.read(4)) [0]
-    if f.read(4) != b'\0'*4: # resvd
-      raise ValueError("Invalid XISF file")
-
-    # Read header       
-    hdr: ET.Element = ET.fromstring(f.read(hdr_len))
-    # print(ET.tostring(hdr, pretty_print=True).decode('utf-8'))
-    image = hdr.xpath('/x:xisf/x:Image', namespaces=ns)[0]
-
-    # Fits Info
-    fits_kws = image.xpath(".//x:FITSKeyword", namespaces=ns)
-    fits_hdr = {kw.attrib['name'].strip(): kw.attrib['value'].strip("' ") for kw in fits_kws}
-
-    # Image dimensions
-    width, height, channels = map(int, image.attrib['geometry'].split(':'))
-    m = re.match(r'attachment:(\d+):(\d+)', image.attrib['location'])
-    if m is None:
-      raise ValueError(f"Unexpected header parameter {image.attrib['location']}")
-
-    # Image data pointer
-    db_offset = int(m.group(1))
-    db_len = int(m.group(2))
-    f.seek(db_offset)
-
-    img_data = f.read(db_len)
-    img = np.frombuffer(img_data, dtype=np.float32).reshape((height, width, channels))
-    # print(img.shape)
-    return img, fits_hdr
+
+def shuffle(data: bytes, item_size: int) -> bytes:
+  """ Byte shuffle: all first bytes of the items, then all second bytes, ...; a tail shorter than an item stays as is """
+  if item_size <= 1:
+    return bytes(data)
+  buf = np.frombuffer(data, dtype=np.uint8)
+  n = len(buf) // item_size * item_size
+  return buf[:n].reshape(-1, item_size).T.tobytes() + buf[n:].tobytes()
+
+
+def unshuffle(data: bytes, item_size: int) -> bytes:
+  """ Inverse of shuffle """
+  if item_size <= 1:
+    return data
+  buf = np.frombuffer(data, dtype=np.uint8)
+  n = len(buf) // item_size * item_size
+  return buf[:n].reshape(item_size, -1).T.tobytes() + buf[n:].tobytes()
+
+
+def _require(codec):
+  if codec in ('lz4', 'lz4hc') and lz4_block is None:
+    raise RuntimeError(f"XISF {codec} compression needs the lz4 package (pip install lz4)")
+  if codec == 'zstd' and zstandard is None:
+    raise RuntimeError("XISF zstd compression needs the zstandard package (pip install zstandard)")
+  if codec not in CODECS:
+    raise NotImplementedError(f"Unsupported XISF compression codec: {codec}")
+
+
+def _decompress(codec, data, size):
+  _require(codec)
+  if codec == 'zlib':
+    return zlib.decompress(data)
+  if codec in ('lz4', 'lz4hc'):
+    return lz4_block.decompress(data, uncompressed_size=size)
+  return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+
+
+def _compress(codec, data, level=None):
+  _require(codec)
+  if codec == 'zlib':
+    return zlib.compress(data, 1 if level is None else level)
+  if codec == 'lz4':
+    return lz4_block.compress(data, store_size=False)
+  if codec == 'lz4hc':
+    return lz4_block.compress(data, mode='high_compression', compression=9 if level is None else level, store_size=False)
+  return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+
+
+class DataBlock:
+  """ Location, compression and checksum of a data block as described by its header element
+  """
+
+  def __init__(self, elem: ET.Element):
+    self.elem = elem
+    location = elem.attrib.get('location', '')
+    if m := re.fullmatch(r'attachment:(\d+):(\d+)', location):
+      self.kind = 'attachment'
+      self.position, self.size = int(m.group(1)), int(m.group(2))
+    elif m := re.fullmatch(r'inline:(base64|hex)', location):
+      self.kind, self.encoding = 'inline', m.group(1)
+    elif location == 'embedded':
+      self.kind = 'embedded'
+    else:
+      # url(...) / path(...) point at external files or data blocks files
+      raise NotImplementedError(f"Unsupported XISF data block location: {location}")
+
+    self.codec = None
+    self.shuffled = False
+    if 'compression' in elem.attrib:
+      m = re.fullmatch(r'(zlib|lz4hc|lz4|zstd)(\+sh)?:(\d+)(?::(\d+))?', elem.attrib['compression'])
+      if m is None:
+        raise NotImplementedError(f"Unsupported XISF compression: {elem.attrib['compression']}")
+      self.codec, self.shuffled = m.group(1), m.group(2) is not None
+      self.uncompressed_size = int(m.group(3))
+      self.item_size = int(m.group(4) or 1)
+    self.subblocks = None
+    if 'subblocks' in elem.attrib:
+      self.subblocks = [tuple(map(int, s.split(','))) for s in elem.attrib['subblocks'].split(':')]
+    self.checksum = elem.attrib.get('checksum')
+    self.byte_order = elem.attrib.get('byteOrder', 'little')
+
+  @property
+  def compressed(self):
+    return self.codec is not None
+
+  def stored(self, buf):
+    """ Block bytes as stored in the file; a zero-copy memoryview for attachments """
+    if self.kind == 'attachment':
+      if self.position + self.size > len(buf):
+        raise ValueError("XISF attachment extends past the end of the file")
+      return memoryview(buf)[self.position:self.position + self.size]
+    if self.kind == 'inline':
+      text = self.elem.text or ''
+    else:
+      data = self.elem.find('x:Data', namespaces=ns)
+      if data is None:
+        raise ValueError("XISF embedded block without a Data element")
+      self.encoding = data.attrib.get('encoding', 'base64')
+      text = data.text or ''
+    text = ''.join(text.split())
+    return base64.b64decode(text) if self.encoding == 'base64' else bytes.fromhex(text)
+
+  def verify(self, stored):
+    if self.checksum is None:
+      return
+    algorithm, digest = self.checksum.split(':')
+    algorithm = algorithm.lower().replace('sha3-', 'sha3_').replace('-', '')
+    if hashlib.new(algorithm, stored).hexdigest() != digest.lower():
+      raise ValueError(f"XISF data block checksum mismatch ({self.checksum})")
+
+  def read(self, buf, verify=False):
+    """ Uncompressed block bytes (a view into buf when the block is neither compressed nor encoded)
+    """
+    stored = self.stored(buf)
+    if verify:
+      self.verify(stored)
+    if not self.compressed:
+      return stored
+    if self.subblocks is None:
+      data = _decompress(self.codec, stored, self.uncompressed_size)
+    else:
+      parts, offset = [], 0
+      for compressed_size, size in self.subblocks:
+        parts.append(_decompress(self.codec, stored[offset:offset + compressed_size], size))
+        offset += compressed_size
+      data = b''.join(parts)
+    if len(data) != self.uncompressed_size:
+      raise ValueError(f"XISF block inflated to {len(data)} bytes, expected {self.uncompressed_size}")
+    return unshuffle(data, self.item_size) if self.shuffled else data
+
+
+class XISFImage:
+  """ Image element of an XISF header; pixels are only touched by read()
+  """
+
+  def __init__(self, xisf, elem: ET.Element):
+    self._xisf = xisf
+    self.elem = elem
+    self.block = DataBlock(elem)
+    geometry = list(map(int, elem.attrib['geometry'].split(':')))
+    # width:height[:depth...]:channels
+    self.dims, self.channels = geometry[:-1], geometry[-1]
+    self.sample_format = elem.attrib['sampleFormat']
+    if self.sample_format not in SAMPLE_FORMATS:
+      raise NotImplementedError(f"Unsupported XISF sample format: {self.sample_format}")
+    self.dtype = np.dtype(SAMPLE_FORMATS[self.sample_format]).newbyteorder('<' if self.block.byte_order == 'little' else '>')
+    self.pixel_storage = elem.attrib.get('pixelStorage', 'Planar')
+    self.color_space = elem.attrib.get('colorSpace', 'Gray')
+    self.bounds = tuple(map(float, elem.attrib['bounds'].split(':'))) if 'bounds' in elem.attrib else None
+    self.id = elem.attrib.get('id')
+    self.image_type = elem.attrib.get('imageType')
+
+  @property
+  def shape(self):
+    """ Numpy shape of read(): (height, width, channels) for 2D images """
+    return tuple(reversed(self.dims)) + (self.channels,)
+
+  @property
+  def fits_keywords(self):
+    """ [(name, value, comment)] with the value as written in the FITS card """
+    return [(kw.attrib['name'].strip(), kw.attrib.get('value', '').strip(), kw.attrib.get('comment', ''))
+            for kw in self.elem.iterfind('x:FITSKeyword', namespaces=ns)]
+
+  @property
+  def fits_header(self):
+    """ FITS keyword name -> value (quotes stripped) """
+    return {name: value.strip("' ").replace("''", "'") for name, value, _ in self.fits_keywords}
+
+  @property
+  def properties(self):
+    """ Property id -> value attribute (or element text) of the image properties """
+    return {p.attrib['id']: p.attrib.get('value', p.text) for p in self.elem.iterfind('x:Property', namespaces=ns)}
+
+  @property
+  def cfa_pattern(self):
+    cfa = self.elem.find('x:ColorFilterArray', namespaces=ns)
+    return None if cfa is None else cfa.attrib.get('pattern')
+
+  def read(self, verify=False):
+    """ Pixels as an array of self.shape; uncompressed attachments are read-only views of the file map
+    """
+    data = self.block.read(self._xisf.buf, verify)
+    count = int(np.prod(self.dims)) * self.channels
+    if len(data) < count * self.dtype.itemsize:
+      raise ValueError(f"XISF image block has {len(data)} bytes, expected {count * self.dtype.itemsize}")
+    img = np.frombuffer(data, dtype=self.dtype, count=count)
+    if not self.dtype.isnative:
+      img = img.astype(self.dtype.newbyteorder('='))
+    if self.pixel_storage == 'Normal':
+      return img.reshape(self.shape)
+    # Planar: one plane per channel
+    return np.moveaxis(img.reshape((self.channels,) + self.shape[:-1]), 0, -1)
+
+
+class XISFFile:
+  """ Monolithic XISF file; images[i] gives access to each image in the file
+  """
+
+  def __init__(self, fname):
+    self.fname = str(fname)
+    self._file = open(self.fname, 'rb')
+    try:
+      if self._file.read(8) != SIGNATURE:
+        raise ValueError("Invalid XISF file")
+      hdr_len = unpack("<I", self._file.read(4))[0]
+      if self._file.read(4) != b'\0'*4: # resvd
+        raise ValueError("Invalid XISF file")
+      self.header: ET.Element = ET.fromstring(self._file.read(hdr_len))
+      self._mmap = None
+      self.images = [XISFImage(self, e) for e in self.header.iterfind('x:Image', namespaces=ns)]
+    except Exception:
+      self.close()
+      raise
+
+  @property
+  def buf(self):
+    """ Map of the whole file, created on the first pixel access """
+    if self._mmap is None:
+      self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    return self._mmap
+
+  @property
+  def properties(self):
+    """ Property id -> value of the file Metadata """
+    return {p.attrib['id']: p.attrib.get('value', p.text) for p in self.header.iterfind('x:Metadata/x:Property', namespaces=ns)}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    if getattr(self, '_mmap', None) is not None:
+      try:
+        self._mmap.close()
+      except BufferError:
+        # a caller still holds a view of an attachment; the map goes away with it
+        pass
+      self._mmap = None
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+
+def read_xisf(fname: str, index: int=0):
+  """ Read (image, FITS keyword dict) of one image; the image is (height, width, channels) in its stored sample format
+  """
+  with XISFFile(fname) as f:
+    if index >= len(f.images):
+      raise ValueError(f"{fname} has {len(f.images)} images, no image {index}")
+    image = f.images[index]
+    return np.array(image.read()), image.fits_header
+
+
+def _fits_value(value):
+  if isinstance(value, (bool, np.bool_)):
+    return 'T' if value else 'F'
+  if isinstance(value, str):
+    return "'" + value.replace("'", "''") + "'"
+  return str(value)
+
+
+def _fits_cards(header):
+  """ (name, value, comment) from an astropy Header or a plain dict """
+  if header is None:
+    return []
+  if hasattr(header, 'cards'):
+    return [(c.keyword, '' if c.keyword in ('COMMENT', 'HISTORY') else _fits_value(c.value),
+             str(c.value) if c.keyword in ('COMMENT', 'HISTORY') else c.comment) for c in header.cards]
+  return [(k, _fits_value(v), '') for k, v in header.items()]
+
+
+def _encode_block(data: bytes, item_size: int, codec, shuffled, level):
+  """ Returns (stored bytes, block attributes) """
+  if codec is None:
+    return data, {}
+  sh = shuffled and item_size > 1
+  payload = shuffle(data, item_size) if sh else data
+  chunks = [payload[i:i + MAX_SUBBLOCK] for i in range(0, len(payload), MAX_SUBBLOCK)] or [b'']
+  compressed = [_compress(codec, c, level) for c in chunks]
+  attrib = {'compression': f"{codec}+sh:{len(data)}:{item_size}" if sh else f"{codec}:{len(data)}"}
+  if len(chunks) > 1:
+    attrib['subblocks'] = ':'.join(f"{len(c)},{len(u)}" for c, u in zip(compressed, chunks))
+  return b''.join(compressed), attrib
+
+
+def write_xisf(fname, images, fits_headers=None, codec='zlib', shuffled=True, level=None, creator='AstroCAM'):
+  """ Write a monolithic XISF file
+  images: array or list of arrays, (height, width) or (height, width, channels); stored planar
+  fits_headers: astropy Header / dict, or a list of them, one per image
+  codec: 'zlib', 'lz4', 'lz4hc', 'zstd' or None for uncompressed attachments
+  shuffled: byte shuffle multi byte samples before compressing (much better ratio on 16 bit data)
+  """
+  if isinstance(images, np.ndarray):
+    images, fits_headers = [images], [fits_headers]
+  elif fits_headers is None or isinstance(fits_headers, dict) or hasattr(fits_headers, 'cards'):
+    fits_headers = [fits_headers] * len(images)
+
+  blocks, elems = [], []
+  for img, fits_header in zip(images, fits_headers):
+    img = np.asarray(img)
+    if img.ndim == 2:
+      img = img[:, :, np.newaxis]
+    if img.ndim != 3:
+      raise ValueError(f"Expected a (height, width[, channels]) image, got shape {img.shape}")
+    sample_format = next((k for k, v in SAMPLE_FORMATS.items() if np.dtype(v) == img.dtype.newbyteorder('=')), None)
+    if sample_format is None:
+      raise ValueError(f"No XISF sample format for {img.dtype}")
+    height, width, channels = img.shape
+    planes = np.ascontiguousarray(np.moveaxis(img, -1, 0), dtype=img.dtype.newbyteorder('<'))
+    data, attrib = _encode_block(planes.tobytes(), img.dtype.itemsize, codec, shuffled, level)
+
+    elem = ET.Element(f'{{{XISF_NS}}}Image', geometry=f"{width}:{height}:{channels}", sampleFormat=sample_format,
+                      colorSpace='RGB' if channels == 3 else 'Gray', location='')
+    if img.dtype.kind in 'fc':
+      elem.attrib['bounds'] = '0:1'
+    elem.attrib.update(attrib)
+    cards = _fits_cards(fits_header)
+    pattern = next((v.strip("' ") for k, v, _ in cards if k == 'BAYERPAT'), None)
+    if pattern and channels == 1:
+      ET.SubElement(elem, f'{{{XISF_NS}}}ColorFilterArray', pattern=pattern, width='2', height='2')
+    for name, value, comment in cards:
+      ET.SubElement(elem, f'{{{XISF_NS}}}FITSKeyword', name=name, value=value, comment=comment)
+    blocks.append(data)
+    elems.append(elem)
+
+  root = ET.Element(f'{{{XISF_NS}}}xisf', nsmap={None: XISF_NS}, version='1.0')
+  root.extend(elems)
+  metadata = ET.SubElement(root, f'{{{XISF_NS}}}Metadata')
+  ET.SubElement(metadata, f'{{{XISF_NS}}}Property', id='XISF:CreationTime', type='TimePoint',
+                value=datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'))
+  ET.SubElement(metadata, f'{{{XISF_NS}}}Property', id='XISF:CreatorApplication', type='String', value=creator)
+
+  # attachment positions depend on the header length and vice versa; settles in a couple of passes
+  positions = [0] * len(blocks)
+  while True:
+    for elem, data, position in zip(elems, blocks, positions):
+      elem.attrib['location'] = f"attachment:{position}:{len(data)}"
+    xml = ET.tostring(root, xml_declaration=True, encoding='UTF-8')
+    offset, new_positions = 16 + len(xml), []
+    for data in blocks:
+      offset = -(-offset // BLOCK_ALIGN) * BLOCK_ALIGN
+      new_positions.append(offset)
+      offset += len(data)
+    if new_positions == positions:
+      break
+    positions = new_positions
+
+  with open(fname, 'wb') as f:
+    f.write(SIGNATURE + pack("<I", len(xml)) + b'\0'*4 + xml)
+    for data, position in zip(blocks, positions):
+      f.write(b'\0' * (position - f.tell()))
+      f.write(data)
+
 
 if __name__ == "__main__":
+  import matplotlib.pyplot as plt
   img, ph = read_xisf(r"D:\Astro\Objects\C30\subs\Light_00934_180.0sec_200gain_-0.3C_c_a.xisf")
   plt.imshow(img, cmap='gray')
   plt.waitforbuttonpress()